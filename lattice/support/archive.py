@@ -0,0 +1,184 @@
+import bz2
+import tarfile
+from contextlib import contextmanager
+from distutils.spawn import find_executable
+from subprocess import Popen, PIPE
+
+from bake import path
+
+DEFAULT_FORMAT = 'zstd'
+
+# zstd and pigz are asked for rsyncable output, which resynchronizes after
+# a change in the input and so lets successive versions share chunks
+
+FORMATS = {
+    'bzip2': {
+        'extension': '.tar.bz2',
+        'magic': 'BZh',
+        'compressors': [['pbzip2', '-c', '-q'], ['lbzip2', '-c'], ['bzip2', '-c']],
+        'decompressors': [['pbzip2', '-d', '-c', '-q'], ['lbzip2', '-d', '-c'], ['bzip2', '-d', '-c']],
+    },
+    'gzip': {
+        'extension': '.tar.gz',
+        'magic': '\x1f\x8b',
+        'compressors': [['pigz', '--rsyncable', '-c'], ['gzip', '-c']],
+        'decompressors': [['pigz', '-d', '-c'], ['gzip', '-d', '-c']],
+    },
+    'xz': {
+        'extension': '.tar.xz',
+        'magic': '\xfd7zXZ\x00',
+        'compressors': [['xz', '-T0', '-c']],
+        'decompressors': [['xz', '-d', '-c']],
+    },
+    'zstd': {
+        'extension': '.tar.zst',
+        'magic': '\x28\xb5\x2f\xfd',
+        'compressors': [['zstd', '-T0', '-q', '--rsyncable', '-c']],
+        'decompressors': [['zstd', '-d', '-q', '-c']],
+    },
+}
+
+class ArchiveError(Exception):
+    pass
+
+def detect_format(filepath):
+    """Determines the compression format of ``filepath`` from its content,
+    returning ``None`` for an uncompressed tarball."""
+    with open(str(filepath), 'rb') as openfile:
+        header = openfile.read(8)
+
+    for name, format in FORMATS.iteritems():
+        if header.startswith(format['magic']):
+            return name
+
+def find_archive(directory, basename):
+    """Finds the archive of ``basename`` in ``directory`` in any format,
+    preferring the default format."""
+    names = [DEFAULT_FORMAT] + sorted(name for name in FORMATS if name != DEFAULT_FORMAT)
+    for name in names:
+        candidate = path(directory) / (basename + FORMATS[name]['extension'])
+        if candidate.exists():
+            return candidate
+
+def get_extension(format):
+    return FORMATS[format]['extension']
+
+def resolve_format(format=None):
+    """Returns ``format`` if it can be written on this host. Without a
+    format, the default is returned where it can be written, and otherwise
+    bzip2, which python can always write."""
+    if not format:
+        if _find_command(FORMATS[DEFAULT_FORMAT]['compressors']):
+            return DEFAULT_FORMAT
+        return 'bzip2'
+
+    if format not in FORMATS:
+        raise ArchiveError('unknown archive format %r' % format)
+    if format != 'bzip2' and not _find_command(FORMATS[format]['compressors']):
+        raise ArchiveError('archive format %r cannot be written on this host' % format)
+    return format
+
+def extract_archive(filepath, target, verbose=False):
+    """Extracts ``filepath`` into ``target``, streaming it through the
+    fastest available decompressor for its format. Returns the member names
+    listed by tar when ``verbose`` is true, so that an archive never has to
+    be read twice just to list it."""
+    format = detect_format(filepath)
+    tokens = ['tar', '-x', '-f', '-', '-C', str(target)]
+    if verbose:
+        tokens[1:1] = ['-v', '--quoting-style=literal']
+
+    if format:
+        command = _find_command(FORMATS[format]['decompressors'])
+        if not command:
+            raise ArchiveError('cannot decompress %s archive %s' % (format, filepath))
+        source = Popen(command + [str(filepath)], stdout=PIPE)
+        stdin = source.stdout
+    else:
+        source = None
+        stdin = open(str(filepath), 'rb')
+
+    try:
+        process = Popen(tokens, stdin=stdin, stdout=PIPE)
+        stdin.close()
+        output = process.communicate()[0]
+    finally:
+        if source:
+            source.wait()
+
+    if process.returncode != 0 or (source and source.returncode != 0):
+        raise ArchiveError('extraction of %s failed' % filepath)
+    if verbose:
+        return [line.rstrip('/') for line in output.splitlines() if line]
+
+@contextmanager
+def read_archive(filepath):
+    """Opens ``filepath`` as a streaming tarfile, decompressed by the
+    fastest available decompressor for its format, so members must be read
+    in order."""
+    format = detect_format(filepath)
+    if not format:
+        openfile = tarfile.open(str(filepath), 'r|')
+        try:
+            yield openfile
+        finally:
+            openfile.close()
+        return
+
+    command = _find_command(FORMATS[format]['decompressors'])
+    if not command:
+        raise ArchiveError('cannot decompress %s archive %s' % (format, filepath))
+
+    process = Popen(command + [str(filepath)], stdout=PIPE)
+    try:
+        openfile = tarfile.open(mode='r|', fileobj=process.stdout)
+        try:
+            yield openfile
+        finally:
+            openfile.close()
+    finally:
+        process.stdout.close()
+        process.wait()
+
+class ArchiveWriter(object):
+    """Writes a tarball through an external, multi-threaded compressor where
+    one is available, falling back to python's bz2 module for bzip2."""
+
+    def __init__(self, filename, format=None):
+        self.filename = str(filename)
+        self.format = resolve_format(format)
+        self.process = None
+
+        command = _find_command(FORMATS[self.format]['compressors'])
+        if command:
+            self.outfile = open(self.filename, 'wb')
+            self.process = Popen(command, stdin=PIPE, stdout=self.outfile)
+            self.stream = self.process.stdin
+        else:
+            self.outfile = None
+            self.stream = bz2.BZ2File(self.filename, 'w')
+        self.tarfile = tarfile.open(mode='w|', fileobj=self.stream)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add(self, filepath, arcname):
+        self.tarfile.add(str(filepath), arcname, recursive=False)
+
+    def close(self):
+        self.tarfile.close()
+        self.stream.close()
+        if self.process:
+            self.process.wait()
+            self.outfile.close()
+            if self.process.returncode != 0:
+                raise ArchiveError('compression of %s failed' % self.filename)
+
+def _find_command(commands):
+    for command in commands:
+        executable = find_executable(command[0])
+        if executable:
+            return [executable] + command[1:]
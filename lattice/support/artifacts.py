@@ -0,0 +1,321 @@
+import json
+import os
+import urllib2
+from hashlib import sha1
+from multiprocessing.pool import ThreadPool
+from shutil import copyfileobj
+from threading import Lock
+from urlparse import urlparse
+
+from bake import path
+
+from lattice.util import uniqpath
+
+class ArtifactStore(object):
+    """A store of build artifacts addressed by key, shared between build
+    hosts depending on the implementation."""
+
+    implementations = {}
+
+    def __init__(self, location, jobs=4):
+        self.jobs = jobs
+        self.location = location
+        self.pending = []
+        self._pool = None
+        self._pool_owner = None
+
+    def exists(self, key):
+        raise NotImplementedError()
+
+    def extract_statistics(self):
+        """Returns and resets the statistics gathered by this store in this
+        process, if it gathers any."""
+        return None
+
+    def get(self, key, filepath):
+        """Retrieves the artifact ``key`` into ``filepath``, returning
+        ``False`` if the store does not contain it."""
+        raise NotImplementedError()
+
+    def put(self, key, filepath):
+        raise NotImplementedError()
+
+    def touch(self, key):
+        """Records a use of the artifact ``key``, so that it is not evicted
+        as unused, returning ``False`` if the store does not contain it."""
+        return self.exists(key)
+
+    def get_many(self, items):
+        """Retrieves a sequence of ``(key, filepath)`` pairs concurrently."""
+        return self.pool.map(lambda item: self.get(*item), items)
+
+    def put_many(self, items):
+        """Stores a sequence of ``(key, filepath)`` pairs concurrently."""
+        return self.pool.map(lambda item: self.put(*item), items)
+
+    def put_async(self, key, filepath):
+        """Stores an artifact in the background; ``wait`` blocks until every
+        background transfer has finished."""
+        self.pending.append(self.pool.apply_async(self.put, (key, filepath)))
+
+    def wait(self):
+        pending, self.pending = self.pending, []
+        for transfer in pending:
+            transfer.get()
+
+    @classmethod
+    def instantiate(cls, location, **params):
+        scheme = urlparse(str(location)).scheme or 'file'
+        try:
+            implementation = cls.implementations[scheme]
+        except KeyError:
+            raise ValueError('unsupported artifact store: %s' % location)
+        return implementation(location, **params)
+
+    @property
+    def pool(self):
+        # worker threads do not survive a fork, so each process needs its own
+        if self._pool_owner != os.getpid():
+            self._pool = ThreadPool(self.jobs)
+            self._pool_owner = os.getpid()
+            self.pending = []
+        return self._pool
+
+class FilesystemArtifactStore(ArtifactStore):
+    """An artifact store in a local or network-mounted directory."""
+
+    def __init__(self, location, **params):
+        super(FilesystemArtifactStore, self).__init__(location, **params)
+        if location.startswith('file://'):
+            location = urlparse(location).path
+        self.root = path(location)
+
+    def exists(self, key):
+        return (self.root / key).exists()
+
+    def get(self, key, filepath):
+        source = self.root / key
+        if not source.exists():
+            return False
+
+        source.copy2(filepath)
+        # records the use, so the least recently used artifacts can be evicted
+        os.utime(source, None)
+        return True
+
+    def put(self, key, filepath):
+        target = self.root / key
+        target.parent.makedirs_p()
+
+        staging = uniqpath(target.parent, '.tmp-')
+        path(filepath).copy2(staging)
+        os.rename(staging, target)
+
+    def touch(self, key):
+        try:
+            os.utime(self.root / key, None)
+        except OSError:
+            return False
+        return True
+
+ArtifactStore.implementations['file'] = FilesystemArtifactStore
+
+class HttpArtifactStore(ArtifactStore):
+    """An artifact store behind an HTTP server that supports ``GET``, ``HEAD``
+    and ``PUT`` under a base url."""
+
+    def __init__(self, location, timeout=300, **params):
+        super(HttpArtifactStore, self).__init__(location, **params)
+        self.timeout = timeout
+        self.url = location.rstrip('/')
+
+    def exists(self, key):
+        try:
+            self._request('HEAD', key).close()
+        except urllib2.HTTPError, exception:
+            if exception.code == 404:
+                return False
+            raise
+        return True
+
+    def get(self, key, filepath):
+        try:
+            response = self._request('GET', key)
+        except urllib2.HTTPError, exception:
+            if exception.code == 404:
+                return False
+            raise
+
+        filepath = path(filepath)
+        staging = uniqpath(filepath.parent, '.tmp-')
+        try:
+            with open(staging, 'wb') as openfile:
+                copyfileobj(response, openfile)
+        finally:
+            response.close()
+
+        os.rename(staging, filepath)
+        return True
+
+    def put(self, key, filepath):
+        filepath = path(filepath)
+        with open(filepath, 'rb') as openfile:
+            self._request('PUT', key, openfile, filepath.getsize()).close()
+
+    def _request(self, method, key, data=None, size=None):
+        request = urllib2.Request('%s/%s' % (self.url, key.lstrip('/')), data)
+        request.get_method = lambda: method
+        if size is not None:
+            request.add_header('Content-Length', str(size))
+            request.add_header('Content-Type', 'application/octet-stream')
+        return urllib2.urlopen(request, timeout=self.timeout)
+
+ArtifactStore.implementations['http'] = HttpArtifactStore
+ArtifactStore.implementations['https'] = HttpArtifactStore
+
+class ChunkedArtifactStore(ArtifactStore):
+    """An artifact store which splits artifacts into content-defined chunks
+    and stores each distinct chunk once in a backing store, given by the
+    rest of a ``chunks+`` location such as ``chunks+file:///srv/artifacts``.
+
+    Chunk boundaries follow a marker in the content rather than fixed
+    offsets, so successive versions of an artifact share most of their
+    chunks; only chunks missing from the backing store are transferred.
+    """
+
+    MARKER = '\xa7\x5c'
+    MINIMUM_CHUNK = 16 * 1024
+    MAXIMUM_CHUNK = 1024 * 1024
+    BLOCK_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, location, **params):
+        super(ChunkedArtifactStore, self).__init__(location, **params)
+        self.backing = ArtifactStore.instantiate(location[len('chunks+'):], **params)
+        self.known = set()
+        self.lock = Lock()
+        self.statistics = self._create_statistics()
+
+    def exists(self, key):
+        return self.backing.exists(self._get_recipe_key(key))
+
+    def extract_statistics(self):
+        with self.lock:
+            statistics, self.statistics = self.statistics, self._create_statistics()
+        return statistics
+
+    def get(self, key, filepath):
+        # an artifact with a missing or corrupt recipe or chunk is treated
+        # as missing, so that it is rebuilt and stored again
+        filepath = path(filepath)
+        staging = uniqpath(filepath.parent, '.tmp-')
+        try:
+            if not self.backing.get(self._get_recipe_key(key), staging):
+                return False
+            try:
+                recipe = json.loads(staging.bytes())
+                digests = list(recipe['chunks'])
+            except (KeyError, TypeError, ValueError):
+                return False
+
+            chunkdir = uniqpath(filepath.parent, '.tmp-')
+            chunkdir.makedirs_p()
+            try:
+                chunks = [(self._get_chunk_key(digest), chunkdir / digest)
+                    for digest in set(digests)]
+                if not all(self.backing.get_many(chunks)):
+                    return False
+
+                hasher = sha1()
+                with open(staging, 'wb') as openfile:
+                    for digest in digests:
+                        chunk = (chunkdir / digest).bytes()
+                        hasher.update(chunk)
+                        openfile.write(chunk)
+                if hasher.hexdigest() != recipe.get('digest'):
+                    return False
+            finally:
+                chunkdir.rmtree()
+
+            os.rename(staging, filepath)
+        finally:
+            if staging.exists():
+                staging.unlink()
+        return True
+
+    def put(self, key, filepath):
+        filepath = path(filepath)
+        staging = uniqpath(filepath.parent, '.tmp-')
+        digests = []
+        hasher = sha1()
+        try:
+            for chunk in self._split(filepath):
+                digest = sha1(chunk).hexdigest()
+                hasher.update(chunk)
+                digests.append(digest)
+                stored = self._put_chunk(digest, chunk, staging)
+                self._count(len(chunk), stored)
+
+            recipe = {'chunks': digests, 'digest': hasher.hexdigest(), 'size': filepath.getsize()}
+            staging.write_bytes(json.dumps(recipe))
+            self.backing.put(self._get_recipe_key(key), staging)
+        finally:
+            if staging.exists():
+                staging.unlink()
+
+        with self.lock:
+            self.statistics['artifacts'] += 1
+
+    def _count(self, size, stored):
+        with self.lock:
+            self.statistics['chunks'] += 1
+            self.statistics['bytes'] += size
+            if stored:
+                self.statistics['stored_chunks'] += 1
+                self.statistics['stored_bytes'] += size
+
+    def _create_statistics(self):
+        return {'artifacts': 0, 'bytes': 0, 'chunks': 0, 'stored_bytes': 0, 'stored_chunks': 0}
+
+    def _get_chunk_key(self, digest):
+        return 'chunks/%s/%s' % (digest[:2], digest)
+
+    def _get_recipe_key(self, key):
+        return 'recipes/%s.json' % key
+
+    def _put_chunk(self, digest, chunk, staging):
+        # a chunk shared with a new artifact is touched, so that it is
+        # evicted no earlier than the newest artifact using it
+        chunkkey = self._get_chunk_key(digest)
+        if digest in self.known or self.backing.touch(chunkkey):
+            self.known.add(digest)
+            return False
+
+        staging.write_bytes(chunk)
+        self.backing.put(chunkkey, staging)
+        self.known.add(digest)
+        return True
+
+    def _split(self, filepath):
+        buffer = ''
+        with open(filepath, 'rb') as openfile:
+            while True:
+                block = openfile.read(self.BLOCK_SIZE)
+                buffer += block
+
+                offset = 0
+                while len(buffer) - offset >= self.MAXIMUM_CHUNK or (not block and offset < len(buffer)):
+                    boundary = buffer.find(self.MARKER, offset + self.MINIMUM_CHUNK,
+                        offset + self.MAXIMUM_CHUNK)
+                    if boundary < 0:
+                        boundary = min(offset + self.MAXIMUM_CHUNK, len(buffer))
+                    else:
+                        boundary += len(self.MARKER)
+                    yield buffer[offset:boundary]
+                    offset = boundary
+
+                buffer = buffer[offset:]
+                if not block:
+                    break
+
+for scheme in ('chunks+file', 'chunks+http', 'chunks+https'):
+    ArtifactStore.implementations[scheme] = ChunkedArtifactStore
@@ -0,0 +1,43 @@
+import json
+from hashlib import sha1
+
+from lattice.support.artifacts import ArtifactStore
+
+class BuildCache(object):
+    """A cache of component collations keyed on a digest of the inputs to
+    their builds, rather than on their version strings."""
+
+    IGNORED_ENVIRON = ('ASSEMBLYDIR', 'BUILDPATH', 'HASH', 'MANIFEST_PACKAGES', 'STOREPATH')
+
+    def __init__(self, artifacts):
+        if not isinstance(artifacts, ArtifactStore):
+            artifacts = ArtifactStore.instantiate(artifacts)
+        self.artifacts = artifacts
+
+    def compute_key(self, name, source_hash, build, environ, dependencies):
+        """Computes the cache key of a component build from the hash of its
+        source, its build definition, its build environment and the cache
+        keys of its dependencies, given as a mapping of name to key."""
+        environ = dict((key, value) for key, value in (environ or {}).iteritems()
+            if key not in self.IGNORED_ENVIRON)
+
+        inputs = json.dumps({
+            'name': name,
+            'source': source_hash,
+            'build': build,
+            'environ': environ,
+            'dependencies': dependencies,
+        }, sort_keys=True)
+        return sha1(inputs).hexdigest()
+
+    def restore(self, key, filepath):
+        return self.artifacts.get(self._construct_artifact_key(key), filepath)
+
+    def store(self, key, filepath):
+        self.artifacts.put_async(self._construct_artifact_key(key), filepath)
+
+    def wait(self):
+        self.artifacts.wait()
+
+    def _construct_artifact_key(self, key):
+        return 'builds/%s/%s' % (key[:2], key)
@@ -0,0 +1,318 @@
+import fcntl
+import json
+import os
+import re
+import shutil
+import time
+from contextlib import contextmanager
+
+from bake import path
+
+from lattice.util import uniqpath
+
+ENTRY_EXPR = re.compile(r'^[0-9a-f]{40}$')
+SIZE_EXPR = re.compile(r'^([0-9]+(?:[.][0-9]+)?)\s*([kmgt]?)b?$', re.IGNORECASE)
+
+LOCK_SUFFIX = '.lock'
+SKIPPED = ('mirrors',)
+
+_leases = []
+
+def acquire_lock(lockpath, operation):
+    """Opens and locks ``lockpath``, returning the descriptor. The lock file
+    is reopened if it was replaced while this process waited for it."""
+    while True:
+        fd = os.open(str(lockpath), os.O_RDWR | os.O_CREAT, 0644)
+        fcntl.flock(fd, operation)
+        if _is_current(fd, lockpath):
+            return fd
+        os.close(fd)
+
+def lease(entry):
+    """Marks the cache entry ``entry`` as used, and as in use until the
+    enclosing ``leasing`` block or this process exits, so that it is never
+    evicted from under a running build."""
+    lockpath = path(str(entry) + LOCK_SUFFIX)
+    lockpath.parent.makedirs_p()
+
+    fd = acquire_lock(lockpath, fcntl.LOCK_SH)
+    os.utime(lockpath, None)
+    _leases.append(fd)
+    return fd
+
+@contextmanager
+def leasing():
+    """Releases the leases taken within the block, by ``lease`` or
+    ``populate``, once it exits."""
+    mark = len(_leases)
+    try:
+        yield
+    finally:
+        # only closed, never unlocked, since a forked worker shares the
+        # locks of the descriptors it inherited with its parent
+        while len(_leases) > mark:
+            os.close(_leases.pop())
+
+@contextmanager
+def locked(lockpath):
+    """Holds an exclusive lock on ``lockpath``, across processes."""
+    lockpath = path(lockpath)
+    lockpath.parent.makedirs_p()
+
+    fd = acquire_lock(lockpath, fcntl.LOCK_EX)
+    try:
+        yield
+    finally:
+        os.close(fd)
+
+def populate(entry, function):
+    """Ensures the cache entry ``entry`` exists, then leases it.
+
+    A missing entry is created by calling ``function`` with a staging path,
+    which is then renamed into place, so an entry is either complete or
+    absent. Concurrent callers, in this or any other process, wait for
+    whichever of them populates the entry and then reuse it.
+    """
+    entry = path(entry)
+    lockpath = path(str(entry) + LOCK_SUFFIX)
+    lockpath.parent.makedirs_p()
+
+    while True:
+        fd = acquire_lock(lockpath, fcntl.LOCK_SH)
+        try:
+            if not entry.exists():
+                # converting a flock is not atomic, so everything is checked
+                # again once the exclusive lock is held
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                if _is_current(fd, lockpath) and not entry.exists():
+                    _populate_staged(entry, function)
+                fcntl.flock(fd, fcntl.LOCK_SH)
+        except:
+            os.close(fd)
+            raise
+
+        if entry.exists() and _is_current(fd, lockpath):
+            os.utime(lockpath, None)
+            _leases.append(fd)
+            return entry
+        os.close(fd)
+
+def _is_current(fd, lockpath):
+    try:
+        return os.fstat(fd).st_ino == os.stat(str(lockpath)).st_ino
+    except OSError:
+        return False
+
+def _populate_staged(entry, function):
+    staging = uniqpath(entry.parent, '.tmp-')
+    try:
+        function(staging)
+        try:
+            os.rename(staging, entry)
+        except OSError:
+            if not entry.exists():
+                raise
+    finally:
+        if staging.exists():
+            shutil.rmtree(staging, True)
+
+def parse_size(value):
+    if not value:
+        return None
+
+    match = SIZE_EXPR.match(value.strip())
+    if not match:
+        raise ValueError(value)
+
+    multiplier = 1024 ** ' kmgt'.index(match.group(2).lower() or ' ')
+    return int(float(match.group(1)) * multiplier)
+
+class CacheEntry(object):
+    def __init__(self, path, size, accessed, references=None):
+        self.path = path
+        self.size = size
+        self.accessed = accessed
+        self.references = references
+
+    def __repr__(self):
+        return 'CacheEntry(%r, %r, %r)' % (self.path, self.size, self.accessed)
+
+class CacheManager(object):
+    """Evicts the least recently used entries from a set of cache directories.
+
+    Checkout cache entries are the directories named by a sha1 at the top of
+    a cache directory; anything else is treated as individual files, such as
+    the packages copied into ``cachedir``. Repository mirrors are skipped,
+    since shared clones borrow their objects.
+
+    In a file store, the entries are the stored outputs, each described by
+    a manifest; the objects they share are removed once no remaining
+    manifest refers to them. Likewise, in a chunked artifact store, the
+    entries are the artifacts, each described by a recipe, and a chunk is
+    removed with the last recipe using it.
+    """
+
+    def __init__(self, *roots):
+        self.roots = [path(root) for root in roots if root]
+        self.shared = {}
+
+    def collect(self, max_size=None, max_age=None, dry_run=False):
+        """Evicts entries older than ``max_age`` seconds, then the least
+        recently used entries until the total size is within ``max_size``
+        bytes. Returns the evicted entries, with the size of each including
+        the shared objects which were removed with it."""
+        entries = sorted(self.enumerate_entries(), key=lambda entry: entry.accessed)
+        total = sum(entry.size for entry in entries)
+        total += sum(size for size, count in self.shared.itervalues())
+        threshold = None
+        if max_age is not None:
+            threshold = time.time() - max_age
+
+        evicted = []
+        for entry in entries:
+            expired = threshold is not None and entry.accessed < threshold
+            oversized = max_size is not None and total > max_size
+            if not (expired or oversized):
+                continue
+            if dry_run or self.evict(entry):
+                entry.size += self._release(entry, dry_run)
+                evicted.append(entry)
+                total -= entry.size
+        return evicted
+
+    def enumerate_entries(self):
+        self.shared = {}
+        for root in self.roots:
+            if not root.exists():
+                continue
+            if (root / 'manifests').isdir() and (root / 'objects').isdir():
+                for entry in self._enumerate_shared(root / 'manifests', root / 'objects',
+                        _read_manifest):
+                    yield entry
+                continue
+            if (root / 'recipes').isdir() and (root / 'chunks').isdir():
+                for entry in self._enumerate_shared(root / 'recipes', root / 'chunks',
+                        _read_recipe):
+                    yield entry
+                continue
+            for name in os.listdir(root):
+                candidate = root / name
+                if self._is_ignored(name) or candidate.islink():
+                    continue
+                if candidate.isdir():
+                    if ENTRY_EXPR.match(name):
+                        yield self._describe_entry(candidate)
+                    elif name not in SKIPPED:
+                        for entry in self._enumerate_files(candidate):
+                            yield entry
+                elif candidate.isfile():
+                    yield self._describe_entry(candidate)
+
+    def evict(self, entry):
+        """Removes ``entry`` unless a running build holds a lease on it."""
+        lockpath = str(entry.path) + LOCK_SUFFIX
+        fd = os.open(lockpath, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            os.close(fd)
+            return False
+
+        try:
+            if entry.path.isdir():
+                # renamed first so that nothing ever sees a partially removed entry
+                doomed = uniqpath(entry.path.parent, '.tmp-')
+                os.rename(entry.path, doomed)
+                shutil.rmtree(doomed, True)
+                evicted = True
+            else:
+                try:
+                    os.unlink(entry.path)
+                    evicted = True
+                except OSError:
+                    evicted = False
+            os.unlink(lockpath)
+        finally:
+            os.close(fd)
+        return evicted
+
+    def _describe_entry(self, candidate):
+        accessed = os.lstat(candidate).st_mtime
+        lockpath = str(candidate) + LOCK_SUFFIX
+        if os.path.exists(lockpath):
+            accessed = max(accessed, os.stat(lockpath).st_mtime)
+
+        if candidate.isdir():
+            size = 0
+            for root, dirs, files in os.walk(candidate):
+                for name in files:
+                    try:
+                        size += os.lstat(os.path.join(root, name)).st_size
+                    except OSError:
+                        pass
+        else:
+            size = os.lstat(candidate).st_size
+        return CacheEntry(candidate, size, accessed)
+
+    def _enumerate_files(self, directory):
+        for root, dirs, files in os.walk(directory):
+            dirs[:] = [name for name in dirs if not self._is_ignored(name)]
+            for name in files:
+                if not self._is_ignored(name):
+                    yield self._describe_entry(path(root) / name)
+
+    def _enumerate_shared(self, entrydir, objectdir, read_references):
+        # objects referred to by entries are accounted for separately, and
+        # evicted with the last entry referring to them; objects no entry
+        # refers to, such as those of an interrupted store, are entries of
+        # their own
+        counts = {}
+        for entry in self._enumerate_files(entrydir):
+            try:
+                entry.references = set(str(objectdir / name) for name in read_references(entry.path))
+            except (IOError, KeyError, TypeError, ValueError):
+                entry.references = set()
+            for reference in entry.references:
+                counts[reference] = counts.get(reference, 0) + 1
+            yield entry
+
+        for entry in self._enumerate_files(objectdir):
+            count = counts.get(str(entry.path))
+            if count:
+                self.shared[str(entry.path)] = [entry.size, count]
+            else:
+                yield entry
+
+    def _is_ignored(self, name):
+        return (name.startswith('.') or name.endswith(LOCK_SUFFIX)
+            or name.endswith('.db'))
+
+    def _release(self, entry, dry_run):
+        released = 0
+        for reference in entry.references or ():
+            shared = self.shared.get(reference)
+            if not shared:
+                continue
+
+            shared[1] -= 1
+            if shared[1] == 0:
+                if not dry_run:
+                    try:
+                        os.unlink(reference)
+                    except OSError:
+                        continue
+                released += shared[0]
+        return released
+
+def _read_recipe(filepath):
+    # the chunks of a chunked artifact store recipe, relative to its chunks
+    # directory
+    with open(str(filepath)) as openfile:
+        digests = json.load(openfile)['chunks']
+    return ['%s/%s' % (digest[:2], digest) for digest in digests]
+
+def _read_manifest(filepath):
+    # the objects of a file store manifest, relative to its objects directory
+    with open(str(filepath)) as openfile:
+        entries = json.load(openfile)['entries']
+    return ['%s/%s' % (entry[2][:2], entry[2]) for entry in entries if entry[1] == 'f']
@@ -0,0 +1,207 @@
+import gzip
+import os
+import tarfile
+import time
+from cStringIO import StringIO
+from distutils.spawn import find_executable
+from subprocess import Popen, PIPE
+
+from lattice.support.archive import read_archive
+
+AR_MAGIC = '!<arch>\n'
+AR_HEADER = '%-16s%-12d%-6d%-6d%-8o%-10d`\n'
+AR_HEADER_SIZE = 60
+
+DECOMPRESSORS = {'.xz': ['xz', '-d', '-c'], '.zst': ['zstd', '-d', '-q', '-c']}
+REQUIRED_FIELDS = ('Package', 'Version', 'Architecture', 'Maintainer', 'Description')
+
+class DebError(Exception):
+    pass
+
+class DebWriter(object):
+    """Writes a deb package in process, without dpkg or fakeroot.
+
+    The data member is streamed straight from a component tarball into the
+    package, with ownership set to root in the tar headers, so the tarball
+    is never extracted and its files are read exactly once.
+    """
+
+    def __init__(self, filepath):
+        self.filepath = str(filepath)
+        self.mtime = int(time.time())
+
+    def write(self, control, scripts, archive):
+        """Writes the package, given the content of the control file, a
+        mapping of maintainer script names to content and the path to the
+        component tarball holding the data."""
+        fields = parse_control(control)
+        missing = [name for name in REQUIRED_FIELDS if not fields.get(name)]
+        if missing:
+            raise DebError('the control file of %s has no %s' % (self.filepath, ', '.join(missing)))
+
+        staging = self.filepath + '.tmp'
+        with open(staging, 'wb') as openfile:
+            openfile.write(AR_MAGIC)
+            self._write_member(openfile, 'debian-binary', '2.0\n')
+            self._write_member(openfile, 'control.tar.gz', self._build_control(control, scripts))
+
+            if find_executable('xz'):
+                self._write_streamed_member(openfile, 'data.tar.xz',
+                    lambda fileobj: self._write_data(fileobj, archive), ['xz', '-T0', '-c'])
+            else:
+                self._write_streamed_member(openfile, 'data.tar.gz',
+                    lambda fileobj: self._write_data(fileobj, archive))
+        os.rename(staging, self.filepath)
+
+    def _build_control(self, control, scripts):
+        if not control.endswith('\n'):
+            control += '\n'
+
+        content = StringIO()
+        compressed = gzip.GzipFile('', 'wb', fileobj=content, mtime=self.mtime)
+        openfile = tarfile.open(mode='w', fileobj=compressed, format=tarfile.GNU_FORMAT)
+        openfile.addfile(self._create_info('.', tarfile.DIRTYPE, 0755))
+        self._add_content(openfile, './control', control, 0644)
+        for name, script in sorted(scripts.iteritems()):
+            self._add_content(openfile, './%s' % name, script, 0755)
+        openfile.close()
+        compressed.close()
+        return content.getvalue()
+
+    def _add_content(self, openfile, name, content, mode):
+        info = self._create_info(name, tarfile.REGTYPE, mode)
+        info.size = len(content)
+        openfile.addfile(info, StringIO(content))
+
+    def _create_info(self, name, type, mode):
+        info = tarfile.TarInfo(name)
+        info.type = type
+        info.mode = mode
+        info.mtime = self.mtime
+        info.uid = info.gid = 0
+        info.uname = info.gname = 'root'
+        return info
+
+    def _write_data(self, fileobj, archive):
+        output = tarfile.open(mode='w|', fileobj=fileobj, format=tarfile.GNU_FORMAT)
+        directories = set(['.'])
+        output.addfile(self._create_info('./', tarfile.DIRTYPE, 0755))
+
+        with read_archive(archive) as source:
+            for member in source:
+                name = member.name.lstrip('/')
+                while name.startswith('./'):
+                    name = name[2:].lstrip('/')
+                name = name.rstrip('/')
+                if name in ('', '.'):
+                    continue
+                name = './' + name
+
+                # the tarball of a component only holds what it changed, so
+                # parent directories are supplied when missing
+                parent = os.path.dirname(name)
+                missing = []
+                while parent not in directories:
+                    missing.append(parent)
+                    parent = os.path.dirname(parent)
+                for directory in reversed(missing):
+                    output.addfile(self._create_info(directory + '/', tarfile.DIRTYPE, 0755))
+                    directories.add(directory)
+
+                member.name = name + ('/' if member.isdir() else '')
+                member.uid = member.gid = 0
+                member.uname = member.gname = 'root'
+                if member.isdir():
+                    if name in directories:
+                        continue
+                    directories.add(name)
+                    output.addfile(member)
+                elif member.isfile():
+                    output.addfile(member, source.extractfile(member))
+                else:
+                    output.addfile(member)
+        output.close()
+
+    def _write_member(self, openfile, name, content):
+        openfile.write(AR_HEADER % (name, self.mtime, 0, 0, 0100644, len(content)))
+        openfile.write(content)
+        if len(content) % 2:
+            openfile.write('\n')
+
+    def _write_streamed_member(self, openfile, name, produce, command=None):
+        # the size in the member header is only known once the member has
+        # been written, so it is filled in afterwards
+        header = openfile.tell()
+        openfile.write(AR_HEADER % (name, self.mtime, 0, 0, 0100644, 0))
+        start = openfile.tell()
+
+        if command:
+            openfile.flush()
+            process = Popen(command, stdin=PIPE, stdout=openfile)
+            try:
+                produce(process.stdin)
+            finally:
+                process.stdin.close()
+                if process.wait() != 0:
+                    raise DebError('%s failed while writing %s' % (command[0], self.filepath))
+            openfile.seek(0, os.SEEK_END)
+        else:
+            compressed = gzip.GzipFile('', 'wb', fileobj=openfile, mtime=self.mtime)
+            produce(compressed)
+            compressed.close()
+
+        size = openfile.tell() - start
+        if size % 2:
+            openfile.write('\n')
+
+        end = openfile.tell()
+        openfile.seek(header)
+        openfile.write(AR_HEADER % (name, self.mtime, 0, 0, 0100644, size))
+        openfile.seek(end)
+
+def parse_control(content):
+    """Parses the content of a control file into a mapping of field names
+    to values, with continuation lines joined to their field."""
+    fields = {}
+    name = None
+    for line in content.split('\n'):
+        if line[:1] in (' ', '\t') and name:
+            fields[name] += '\n' + line
+        elif ':' in line:
+            name, value = line.split(':', 1)
+            name = name.strip()
+            fields[name] = value.strip()
+    return fields
+
+def read_control(filepath):
+    """Returns the content of the control file of the deb package at
+    ``filepath``, reading only its control member."""
+    filepath = str(filepath)
+    with open(filepath, 'rb') as openfile:
+        if openfile.read(len(AR_MAGIC)) != AR_MAGIC:
+            raise DebError('%s is not a deb package' % filepath)
+
+        while True:
+            header = openfile.read(AR_HEADER_SIZE)
+            if len(header) != AR_HEADER_SIZE:
+                break
+
+            name, size = header[:16].strip().rstrip('/'), int(header[48:58])
+            if name.startswith('control.tar'):
+                return _extract_control(filepath, name, openfile.read(size))
+            openfile.seek(size + size % 2, os.SEEK_CUR)
+    raise DebError('%s has no control member' % filepath)
+
+def _extract_control(filepath, name, content):
+    extension = os.path.splitext(name)[1]
+    if extension in DECOMPRESSORS:
+        process = Popen(DECOMPRESSORS[extension], stdin=PIPE, stdout=PIPE)
+        content = process.communicate(content)[0]
+        if process.returncode != 0:
+            raise DebError('cannot decompress the control member of %s' % filepath)
+
+    openfile = tarfile.open(fileobj=StringIO(content), mode='r:gz' if extension == '.gz' else 'r:')
+    for member in openfile:
+        if member.isfile() and os.path.normpath(member.name) == 'control':
+            return openfile.extractfile(member).read()
+    raise DebError('%s has no control file' % filepath)
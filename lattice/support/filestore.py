@@ -0,0 +1,185 @@
+import errno
+import fcntl
+import json
+import os
+import shutil
+import stat
+from hashlib import sha1
+
+from bake import path
+
+from lattice.util import uniqpath
+
+FICLONE = 0x40049409
+
+class FileStore(object):
+    """A content-addressed store of unpacked component outputs.
+
+    Each stored output is described by a manifest of its files, links and
+    directories, and is materialized into a tree with reflinks where the
+    filesystem supports them, falling back to copies. Objects are never
+    hardlinked into a tree, since a build modifying the file in place would
+    modify the object as well. Objects are keyed on mode and mtime as well
+    as content, since materialized files take both from the object.
+    """
+
+    METHODS = ('reflink', 'copy')
+
+    def __init__(self, root):
+        self.root = path(root)
+        self.method = None
+
+    def contains(self, key):
+        return self._get_manifest_path(key).exists()
+
+    def ingest(self, key, source, members):
+        """Moves the unpacked output in ``source`` into the store as the
+        output ``key``, recording ``members`` as the names it was archived
+        with."""
+        source = str(source)
+        entries = []
+        for root, dirs, files in os.walk(source):
+            relroot = os.path.relpath(root, source)
+            for name in list(dirs):
+                filepath = os.path.join(root, name)
+                relpath = os.path.normpath(os.path.join(relroot, name))
+                if os.path.islink(filepath):
+                    dirs.remove(name)
+                    entries.append([relpath, 'l', os.readlink(filepath),
+                        int(os.lstat(filepath).st_mtime)])
+                else:
+                    entries.append([relpath, 'd', stat.S_IMODE(os.lstat(filepath).st_mode)])
+
+            for name in files:
+                filepath = os.path.join(root, name)
+                relpath = os.path.normpath(os.path.join(relroot, name))
+                status = os.lstat(filepath)
+                if stat.S_ISLNK(status.st_mode):
+                    entries.append([relpath, 'l', os.readlink(filepath), int(status.st_mtime)])
+                elif stat.S_ISREG(status.st_mode):
+                    entries.append([relpath, 'f', self._store_object(filepath, status),
+                        stat.S_IMODE(status.st_mode), int(status.st_mtime), status.st_size])
+
+        manifest = self._get_manifest_path(key)
+        manifest.parent.makedirs_p()
+        staging = uniqpath(manifest.parent, '.tmp-')
+        staging.write_bytes(json.dumps({'entries': entries, 'members': members}))
+        os.rename(staging, manifest)
+
+    def materialize(self, key, target, keep_newer=False):
+        """Materializes the output ``key`` into ``target``, returning its
+        members, or ``None`` if the store does not hold all of it. Existing
+        files at least as new as stored ones are left alone when
+        ``keep_newer`` is true."""
+        manifestpath = self._get_manifest_path(key)
+        try:
+            with open(manifestpath) as openfile:
+                manifest = json.load(openfile)
+        except IOError:
+            return None
+
+        # records the use, so the least recently used outputs can be evicted
+        os.utime(manifestpath, None)
+
+        entries = manifest['entries']
+        for entry in entries:
+            if entry[1] == 'f' and not self._verify_object(entry):
+                self._get_manifest_path(key).unlink()
+                return None
+
+        target = str(target)
+        for entry in entries:
+            targetpath = os.path.join(target, entry[0])
+            if entry[1] == 'd':
+                if not os.path.isdir(targetpath):
+                    os.makedirs(targetpath, entry[2] | 0700)
+            elif keep_newer and _is_newer(targetpath, entry):
+                continue
+            else:
+                _prepare(targetpath)
+                if entry[1] == 'l':
+                    os.symlink(entry[2], targetpath)
+                else:
+                    self._link_object(entry, targetpath)
+        return manifest['members']
+
+    def _get_manifest_path(self, key):
+        return self.root / 'manifests' / key[:2] / ('%s.json' % key)
+
+    def _get_object_path(self, key):
+        return self.root / 'objects' / key[:2] / key
+
+    def _link_object(self, entry, targetpath):
+        source = str(self._get_object_path(entry[2]))
+        for method in self.METHODS[self.METHODS.index(self.method or 'reflink'):]:
+            try:
+                if method == 'reflink':
+                    _reflink(source, targetpath)
+                else:
+                    shutil.copyfile(source, targetpath)
+            except (IOError, OSError), exception:
+                if exception.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL,
+                        errno.EXDEV, errno.EPERM):
+                    raise
+                if os.path.lexists(targetpath):
+                    os.unlink(targetpath)
+                continue
+
+            os.chmod(targetpath, entry[3])
+            os.utime(targetpath, (entry[4], entry[4]))
+            break
+        else:
+            raise IOError('cannot materialize %s' % targetpath)
+
+        # later materializations go straight to the method which worked
+        self.method = method
+
+    def _store_object(self, filepath, status):
+        hasher = sha1()
+        with open(filepath, 'rb') as openfile:
+            for block in iter(lambda: openfile.read(1024 * 1024), ''):
+                hasher.update(block)
+
+        key = '%s-%o-%d' % (hasher.hexdigest(), stat.S_IMODE(status.st_mode), int(status.st_mtime))
+        objectpath = self._get_object_path(key)
+        if not objectpath.exists():
+            objectpath.parent.makedirs_p()
+            os.utime(filepath, (int(status.st_mtime), int(status.st_mtime)))
+            staging = uniqpath(objectpath.parent, '.tmp-')
+            shutil.move(filepath, staging)
+            os.rename(staging, objectpath)
+        return key
+
+    def _verify_object(self, entry):
+        # an object which was modified or truncated is no longer usable
+        try:
+            status = os.stat(str(self._get_object_path(entry[2])))
+        except OSError:
+            return False
+        return status.st_size == entry[5] and int(status.st_mtime) == entry[4]
+
+def locate_filestore(cachedir):
+    """Returns the root of the file store kept alongside ``cachedir``."""
+    cachedir = path(cachedir).abspath()
+    return cachedir.parent / ('%s-files' % cachedir.basename())
+
+def _is_newer(targetpath, entry):
+    try:
+        return os.lstat(targetpath).st_mtime >= entry[4 if entry[1] == 'f' else 3]
+    except OSError:
+        return False
+
+def _prepare(targetpath):
+    parent = os.path.dirname(targetpath)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    if os.path.lexists(targetpath):
+        if os.path.isdir(targetpath) and not os.path.islink(targetpath):
+            shutil.rmtree(targetpath)
+        else:
+            os.unlink(targetpath)
+
+def _reflink(source, targetpath):
+    with open(source, 'rb') as sourcefile:
+        with open(targetpath, 'wb') as targetfile:
+            fcntl.ioctl(targetfile.fileno(), FICLONE, sourcefile.fileno())
@@ -0,0 +1,102 @@
+import atexit
+import os
+from collections import OrderedDict
+from subprocess import Popen, PIPE
+from threading import Lock
+
+class GitSession(object):
+    """A long-lived ``git cat-file --batch`` process for one repository.
+
+    Objects are read and revisions resolved through the one process instead
+    of spawning ``git show`` or ``git log`` for each query, and results of
+    the remaining metadata queries can be memoized per commit.
+    """
+
+    MAXIMUM_PROCESSES = 16
+
+    sessions = OrderedDict()
+    sessions_lock = Lock()
+
+    def __init__(self, root):
+        self.root = root
+        self.lock = Lock()
+        self.memo = {}
+        self.process = None
+        self.shallow = None
+
+    def close(self):
+        with self.lock:
+            if self.process:
+                self.process.stdin.close()
+                self.process.wait()
+                self.process = None
+
+    @classmethod
+    def get(cls, root):
+        # sessions are never shared with forked children, which would
+        # interleave their requests on the same pipe
+        key = (os.getpid(), os.path.realpath(str(root)))
+        with cls.sessions_lock:
+            session = cls.sessions.pop(key, None)
+            if not session:
+                session = cls(str(root))
+            cls.sessions[key] = session
+
+            # idle processes are closed once too many are open; their
+            # memoized results are kept
+            active = [s for s in cls.sessions.itervalues() if s.process]
+            for idle in active[:-cls.MAXIMUM_PROCESSES]:
+                idle.close()
+            return session
+
+    def invalidate(self):
+        self.memo.clear()
+
+    def memoize(self, key, function):
+        """Returns the memoized result of ``function`` for ``key``, which
+        should include the commit the result depends on."""
+        try:
+            return self.memo[key]
+        except KeyError:
+            value = self.memo[key] = function()
+            return value
+
+    def read(self, name):
+        """Returns the type and content of the object ``name``, which can
+        be anything ``git cat-file`` accepts, or ``None`` if it is missing."""
+        result = self._request(name)
+        if result:
+            return result[1], result[2]
+
+    def resolve(self, revision):
+        result = self._request(revision)
+        if result:
+            return result[0]
+
+    def _request(self, name):
+        with self.lock:
+            if not self.process:
+                self.process = Popen(['git', 'cat-file', '--batch'], cwd=self.root,
+                    stdin=PIPE, stdout=PIPE, stderr=PIPE)
+
+            self.process.stdin.write('%s\n' % name)
+            self.process.stdin.flush()
+
+            header = self.process.stdout.readline()
+            if not header:
+                self.process = None
+                raise RuntimeError('git cat-file exited unexpectedly in %s' % self.root)
+
+            if header.rstrip().endswith((' missing', ' ambiguous')):
+                return None
+
+            tokens = header.split()
+            content = self.process.stdout.read(int(tokens[2]))
+            self.process.stdout.read(1)
+            return tokens[0], tokens[1], content
+
+@atexit.register
+def _close_sessions():
+    for (pid, root), session in GitSession.sessions.items():
+        if pid == os.getpid():
+            session.close()
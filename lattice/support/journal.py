@@ -0,0 +1,102 @@
+import json
+import os
+from hashlib import md5
+
+from bake import path
+
+BLOCK_SIZE = 1024 * 1024
+
+class JournalMismatch(Exception):
+    pass
+
+class BuildJournal(object):
+    """A checkpoint journal for profile builds.
+
+    The first line of the journal describes the build; every following line
+    is the json-encoded result of one completed component, so that an
+    interrupted build can be resumed from where it stopped.
+    """
+
+    def __init__(self, filepath):
+        if not isinstance(filepath, path):
+            filepath = path(filepath)
+        self.filepath = filepath
+
+    def load(self, header):
+        """Loads the recorded results, keyed by component name, after
+        checking that the journal belongs to the build described by
+        ``header``."""
+        if not self.filepath.exists():
+            return None, {}
+
+        with open(self.filepath) as openfile:
+            lines = [line for line in openfile.read().split('\n') if line.strip()]
+        if not lines:
+            return None, {}
+
+        recorded = json.loads(lines[0])
+        for key, value in header.iteritems():
+            if recorded.get(key) != value:
+                raise JournalMismatch('journal %s was recorded for a different build (%s %r != %r)'
+                    % (self.filepath, key, recorded.get(key), value))
+
+        results = {}
+        for line in lines[1:]:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                # a partially written final line from an interrupted build
+                break
+            results[result['name']] = result
+        return recorded, results
+
+    def record(self, result):
+        self._append(result)
+
+    def start(self, header):
+        self.filepath.write_bytes('')
+        self._append(header)
+
+    def _append(self, value):
+        with open(self.filepath, 'a') as openfile:
+            openfile.write(json.dumps(value, sort_keys=True, default=str) + '\n')
+            openfile.flush()
+            os.fsync(openfile.fileno())
+
+def stamp_artifacts(filepaths, checksums=None):
+    """Returns the size and mtime of each artifact in ``filepaths``, along
+    with its md5 where ``checksums`` already holds it, for the journal."""
+    checksums = checksums or {}
+    stamps = {}
+    for filepath in filepaths:
+        status = os.stat(str(filepath))
+        stamps[str(filepath)] = [status.st_size, status.st_mtime, checksums.get(str(filepath))]
+    return stamps
+
+def verify_artifacts(filepaths, stamps):
+    """Indicates whether the artifacts in ``filepaths`` are those recorded
+    in ``stamps``. An artifact is only read when its mtime has changed and
+    its md5 was recorded, as when it was touched or copied over itself."""
+    for filepath in filepaths:
+        try:
+            status = os.stat(str(filepath))
+        except OSError:
+            return False
+
+        stamp = stamps.get(str(filepath))
+        if not stamp:
+            continue
+
+        size, mtime, checksum = stamp
+        if status.st_size != size:
+            return False
+        if status.st_mtime != mtime and not (checksum and _hash_file(filepath) == checksum):
+            return False
+    return True
+
+def _hash_file(filepath):
+    hasher = md5()
+    with open(str(filepath), 'rb') as openfile:
+        for block in iter(lambda: openfile.read(BLOCK_SIZE), ''):
+            hasher.update(block)
+    return hasher.hexdigest()
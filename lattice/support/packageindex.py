@@ -0,0 +1,163 @@
+import os
+import sqlite3
+import struct
+import tarfile
+
+from bake import path
+
+from lattice.support.debfile import DebError, parse_control, read_control
+from lattice.support.rpmfile import RpmError, RpmPackage
+
+BLOCK_SIZE = 1024 * 1024
+
+class PackageIndex(object):
+    """An index of the packages in a package store, keyed on package hash.
+
+    The hashes known to be in the store are loaded once, from the list of
+    existing package hashes when one is given, so that existence checks are
+    set lookups. Packages built since are recorded with their file, component
+    name, version and size in a persistent index, which is opened separately
+    in each process since builds and packaging run in forked workers.
+    Packages put in the store by other means are added by ``backfill``.
+    """
+
+    SCHEMA = [
+        'create table if not exists package (hash text primary key, filename text not null,'
+            ' name text, version text, size integer)',
+        'create table if not exists state (key text primary key, value text not null)',
+    ]
+
+    def __init__(self, filepath=None, storepath=None, hashfile=None):
+        self.filepath = str(filepath) if filepath else None
+        self.storepath = path(storepath) if storepath else None
+        self.connection = None
+        self.pid = None
+
+        self.hashes = None
+        if hashfile and path(hashfile).exists():
+            self.hashes = set(line.strip() for line in path(hashfile).bytes().split('\n')
+                if line.strip())
+
+    def add(self, package_hash, filepath, name=None, version=None):
+        filepath = path(filepath).abspath()
+        with self._connect() as connection:
+            connection.execute('insert or replace into package (hash, filename, name, version, size)'
+                ' values (?, ?, ?, ?, ?)', (package_hash, str(filepath), name, version,
+                filepath.getsize()))
+        if self.hashes is not None:
+            self.hashes.add(package_hash)
+
+    def close(self):
+        if self.connection and self.pid == os.getpid():
+            self.connection.close()
+        self.connection = None
+
+    def contains(self, package_hash):
+        """Indicates whether ``package_hash`` is in the store, or ``None``
+        when no list of existing package hashes was given."""
+        if self.hashes is not None:
+            return package_hash in self.hashes or self.get(package_hash) is not None
+
+    def get(self, package_hash):
+        """Returns the indexed ``filename``, ``name``, ``version`` and
+        ``size`` of ``package_hash``, or ``None``."""
+        row = self._connect().execute('select filename, name, version, size from package'
+            ' where hash = ?', (package_hash,)).fetchone()
+        if row:
+            return dict(zip(('filename', 'name', 'version', 'size'), row))
+
+    def locate(self, package_hash):
+        """Returns the path of the package ``package_hash``, preferring the
+        store, or ``None`` if it cannot be found."""
+        if self.storepath:
+            candidate = self.storepath / package_hash
+            if candidate.exists():
+                return candidate
+
+        entry = self.get(package_hash)
+        if entry and os.path.exists(entry['filename']):
+            return path(entry['filename'])
+
+    def prefetch(self, package_hashes):
+        """Reads the packages ``package_hashes``, so that they are already
+        cached when they are reused, returning the hashes of those which
+        could not be found or read."""
+        failed = []
+        for package_hash in package_hashes:
+            filepath = self.locate(package_hash)
+            if not filepath:
+                failed.append(package_hash)
+                continue
+            try:
+                with open(str(filepath), 'rb') as openfile:
+                    while openfile.read(BLOCK_SIZE):
+                        pass
+            except (IOError, OSError):
+                failed.append(package_hash)
+        return failed
+
+    def backfill(self):
+        """Indexes the packages in the store which are not yet indexed,
+        returning how many were added. The store is only listed when its
+        directory has changed since the last backfill, and only the new
+        packages are read."""
+        if not (self.storepath and self.storepath.isdir()):
+            return 0
+
+        # the stamp is taken before listing, so that packages stored while
+        # the listing is read are picked up by the next backfill
+        key = 'store:%s' % self.storepath.abspath()
+        status = os.stat(str(self.storepath))
+        stamp = '%d:%r' % (status.st_ino, status.st_mtime)
+
+        connection = self._connect()
+        row = connection.execute('select value from state where key = ?', (key,)).fetchone()
+        if row and row[0] == stamp:
+            return 0
+
+        known = set(row[0] for row in connection.execute('select hash from package'))
+        rows = []
+        for package_hash in os.listdir(str(self.storepath)):
+            if package_hash in known or package_hash.startswith('.'):
+                continue
+
+            filepath = os.path.abspath(os.path.join(str(self.storepath), package_hash))
+            if not os.path.isfile(filepath):
+                continue
+            try:
+                name, version = _read_metadata(filepath)
+                rows.append((package_hash, filepath, name, version, os.path.getsize(filepath)))
+            except OSError:
+                continue
+
+        with connection:
+            connection.executemany('insert or ignore into package (hash, filename, name,'
+                ' version, size) values (?, ?, ?, ?, ?)', rows)
+            connection.execute('insert or replace into state (key, value) values (?, ?)',
+                (key, stamp))
+        return len(rows)
+
+    def _connect(self):
+        pid = os.getpid()
+        if self.connection is None or self.pid != pid:
+            self.connection = sqlite3.connect(self.filepath or ':memory:', timeout=60)
+            self.pid = pid
+            for statement in self.SCHEMA:
+                self.connection.execute(statement)
+            self.connection.commit()
+        return self.connection
+
+def _read_metadata(filepath):
+    # stored packages are named by hash alone, so the name and version are
+    # read from the package itself where it can be parsed
+    try:
+        package = RpmPackage(filepath)
+        return package.name, package.version
+    except (RpmError, IOError, ValueError, struct.error):
+        pass
+
+    try:
+        fields = parse_control(read_control(filepath))
+        return fields.get('Package'), fields.get('Version')
+    except (DebError, IOError, ValueError, tarfile.TarError):
+        return None, None
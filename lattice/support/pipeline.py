@@ -0,0 +1,129 @@
+import traceback
+from multiprocessing import Process, Queue
+from Queue import Empty
+
+from lattice.support.scheduler import JobFailed
+
+class PackagingPipeline(object):
+    """Runs packaging jobs in the background in a bounded pool of forked
+    worker processes, so that packaging one component overlaps with
+    building the next.
+
+    Jobs are submitted in groups, one group per component, and the results
+    of a group are handed back in submission order once all of its jobs
+    have finished. As with ``DependencyScheduler``, results must be
+    picklable, and the optional ``prepare`` callable is run before each
+    worker is forked.
+    """
+
+    def __init__(self, jobs=2, poll=1, prepare=None):
+        self.jobs = max(jobs or 1, 1)
+        self.poll = poll
+        self.prepare = prepare
+        self.queue = Queue()
+        self.groups = {}
+        self.order = []
+        self.running = {}
+        self.waiting = []
+        self.failure = None
+
+    def close(self):
+        """Waits for running jobs without starting any more."""
+        self.waiting = []
+        while self.running:
+            try:
+                self._collect(True)
+            except JobFailed:
+                pass
+
+    def poll_completed(self):
+        """Returns the ``(group, results)`` pairs of every group which has
+        completed since the last call, without blocking."""
+        self._collect(False)
+        return self._pop_completed()
+
+    def submit(self, group, function):
+        if group not in self.groups:
+            self.groups[group] = {'submitted': 0, 'results': {}}
+            self.order.append(group)
+
+        entry = self.groups[group]
+        self.waiting.append((group, entry['submitted'], function))
+        entry['submitted'] += 1
+        self._start()
+
+    def wait(self, groups=None):
+        """Blocks until ``groups``, or every group when not given, have
+        completed, returning the ``(group, results)`` pairs of every group
+        which completed meanwhile."""
+        completed = []
+        while True:
+            completed.extend(self._pop_completed())
+            outstanding = [group for group in self.order if groups is None or group in groups]
+            if not outstanding:
+                return completed
+            if not (self.running or self.waiting):
+                raise JobFailed(outstanding[0], 'packaging was abandoned')
+            self._collect(True)
+
+    def _collect(self, block):
+        while self.running:
+            try:
+                message = self.queue.get(timeout=self.poll) if block else self.queue.get_nowait()
+            except Empty:
+                message = None
+
+            if message:
+                key, succeeded, result = message
+                self.running.pop(key).join()
+                if succeeded:
+                    self.groups[key[0]]['results'][key[1]] = result
+                elif not self.failure:
+                    self.failure = JobFailed(key[0], result)
+            else:
+                for key, process in self.running.items():
+                    if not process.is_alive() and process.exitcode != 0:
+                        self.running.pop(key)
+                        if not self.failure:
+                            self.failure = JobFailed(key[0], 'packaging worker exited with'
+                                ' code %s' % process.exitcode)
+
+            self._start()
+            if self.failure:
+                failure, self.failure = self.failure, None
+                self.close()
+                raise failure
+            if bool(message) == block:
+                break
+
+    def _pop_completed(self):
+        completed = []
+        for group in list(self.order):
+            entry = self.groups[group]
+            if len(entry['results']) == entry['submitted']:
+                self.order.remove(group)
+                del self.groups[group]
+                completed.append((group, [entry['results'][i] for i in range(entry['submitted'])]))
+        return completed
+
+    def _start(self):
+        while self.waiting and len(self.running) < self.jobs:
+            group, index, function = self.waiting.pop(0)
+            self.running[(group, index)] = self._spawn((group, index), function)
+
+    def _spawn(self, key, function):
+        queue = self.queue
+        def target():
+            try:
+                result = function()
+            except BaseException:
+                queue.put((key, False, traceback.format_exc()))
+            else:
+                queue.put((key, True, result))
+
+        if self.prepare:
+            self.prepare()
+
+        process = Process(target=target, name='%s-%d' % key)
+        process.start()
+        return process
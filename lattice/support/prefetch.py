@@ -0,0 +1,102 @@
+from multiprocessing import Process, Queue
+from multiprocessing.pool import ThreadPool
+from Queue import Empty
+
+from lattice.support.repository import Repository
+
+class SourcePrefetcher(object):
+    """Populates the repository cache for a set of components in a bounded
+    pool of threads, so that checkouts overlap with builds.
+
+    The pool runs in a forked helper process, so that the builder itself
+    has no threads of its own when it forks build and packaging workers.
+    """
+
+    def __init__(self, cachedir, jobs=4, poll=1):
+        self.cachedir = cachedir
+        self.jobs = jobs
+        self.poll = poll
+        self.completed = {}
+        self.fetches = {}
+        self.process = None
+        self.queue = None
+
+    def close(self):
+        if self.process:
+            self.process.join()
+            self.process = None
+
+    def ready(self, name):
+        key = self.fetches.get(name)
+        if key is None:
+            return True
+
+        self._collect(False)
+        return key in self.completed
+
+    def start(self, components):
+        requests = []
+        for component in components:
+            metadata = component.get('repository')
+            if not metadata or metadata.get('type') not in Repository.implementations:
+                continue
+
+            # a sparse checkout is cached apart from a complete one of the
+            # same revision, so it is fetched separately
+            sparse = None
+            if metadata.get('sparse'):
+                sparse = metadata.get('subfolder')
+
+            key = (metadata['type'], metadata.get('url'), metadata.get('revision'), sparse)
+            if key not in self.fetches.values():
+                requests.append((key, metadata))
+            self.fetches[component['name']] = key
+
+        if requests:
+            self.queue = Queue()
+            self.process = Process(target=self._run, args=(requests,), name='prefetch')
+            self.process.start()
+
+    def wait(self, name):
+        """Blocks until the source of component ``name`` has been fetched,
+        returning an error message if the fetch failed."""
+        key = self.fetches.get(name)
+        if key is None:
+            return
+
+        while key not in self.completed:
+            self._collect(True)
+        return self.completed[key]
+
+    def _collect(self, block):
+        while self.process:
+            try:
+                key, error = self.queue.get(timeout=self.poll) if block else self.queue.get_nowait()
+            except Empty:
+                if self.process.is_alive():
+                    return
+                # the helper is gone, so whatever it did not report never will be
+                for key in self.fetches.itervalues():
+                    self.completed.setdefault(key, 'prefetch process exited with code %s'
+                        % self.process.exitcode)
+                return
+
+            self.completed[key] = error
+            block = False
+
+    def _prefetch(self, metadata):
+        repository = Repository.instantiate(metadata['type'], None, cachedir=self.cachedir)
+        try:
+            repository.prefetch(metadata)
+        except Exception, exception:
+            # the build retries the checkout itself, and reports the failure
+            return str(exception) or exception.__class__.__name__
+
+    def _run(self, requests):
+        queue = self.queue
+        pool = ThreadPool(self.jobs)
+        for key, metadata in requests:
+            pool.apply_async(self._prefetch, (metadata,),
+                callback=lambda error, key=key: queue.put((key, error)))
+        pool.close()
+        pool.join()
@@ -0,0 +1,312 @@
+import gzip
+import os
+import sqlite3
+import stat
+import struct
+import tarfile
+import time
+from cStringIO import StringIO
+from hashlib import md5, sha1, sha256
+from xml.sax.saxutils import escape, quoteattr
+
+from bake import path
+
+from lattice.support import rpmfile
+from lattice.support.debfile import DebError, read_control
+from lattice.util import uniqpath
+
+BLOCK_SIZE = 1024 * 1024
+
+COMMON_NAMESPACE = 'http://linux.duke.edu/metadata/common'
+FILELISTS_NAMESPACE = 'http://linux.duke.edu/metadata/filelists'
+REPO_NAMESPACE = 'http://linux.duke.edu/metadata/repo'
+RPM_NAMESPACE = 'http://linux.duke.edu/metadata/rpm'
+
+FLAGS = {2: 'LT', 4: 'GT', 8: 'EQ', 10: 'LE', 12: 'GE'}
+PREREQ_FLAGS = (1 << 6) | (1 << 9) | (1 << 10)
+
+# the ways in which reading a corrupt or truncated package can fail
+PACKAGE_ERRORS = (rpmfile.RpmError, DebError, struct.error, tarfile.TarError, IOError, OSError,
+    ValueError, IndexError, KeyError)
+
+DEPENDENCIES = (
+    ('provides', rpmfile.RPMTAG_PROVIDENAME, rpmfile.RPMTAG_PROVIDEFLAGS,
+        rpmfile.RPMTAG_PROVIDEVERSION),
+    ('requires', rpmfile.RPMTAG_REQUIRENAME, rpmfile.RPMTAG_REQUIREFLAGS,
+        rpmfile.RPMTAG_REQUIREVERSION),
+    ('conflicts', rpmfile.RPMTAG_CONFLICTNAME, rpmfile.RPMTAG_CONFLICTFLAGS,
+        rpmfile.RPMTAG_CONFLICTVERSION),
+    ('obsoletes', rpmfile.RPMTAG_OBSOLETENAME, rpmfile.RPMTAG_OBSOLETEFLAGS,
+        rpmfile.RPMTAG_OBSOLETEVERSION),
+)
+
+class RepositoryIndex(object):
+    """A persistent cache of the repository metadata of each package under
+    a distribution directory.
+
+    Packages are recorded with their size and mtime and the rendered yum or
+    apt metadata for them, so only new or changed packages are read when the
+    index is updated; ``repodata`` and ``Packages.gz`` are then assembled
+    from the cached entries.
+    """
+
+    FILENAME = '.lattice-repoindex.db'
+    SCHEMA = [
+        'create table if not exists package (filename text primary key, size integer not null,'
+            ' mtime integer not null, kind text not null, entry text not null, filelist text)',
+    ]
+
+    def __init__(self, root):
+        self.root = path(root).abspath()
+        self.connection = sqlite3.connect(str(self.root / self.FILENAME), timeout=60)
+        for statement in self.SCHEMA:
+            self.connection.execute(statement)
+        self.connection.commit()
+
+    @classmethod
+    def open(cls, root):
+        """Opens the index of ``root`` if it has one, so that builders only
+        record packages when the repository is indexed."""
+        if (path(root) / cls.FILENAME).exists():
+            return cls(root)
+
+    def close(self):
+        self.connection.close()
+
+    def record(self, filepath, checksums=None):
+        """Reads and records the package at ``filepath``, using ``checksums``
+        where they are already known."""
+        filepath = path(filepath).abspath()
+        filename = os.path.relpath(str(filepath), str(self.root))
+        status = os.stat(str(filepath))
+
+        if filename.endswith('.rpm'):
+            kind = 'rpm'
+            entry, filelist = _render_rpm(filepath, filename, status, checksums or {})
+        else:
+            kind = 'deb'
+            entry, filelist = _render_deb(filepath, filename, status, checksums or {}), None
+
+        with self.connection:
+            self.connection.execute('insert or replace into package (filename, size, mtime, kind,'
+                ' entry, filelist) values (?, ?, ?, ?, ?, ?)', (filename, status.st_size,
+                int(status.st_mtime), kind, entry.decode('utf8', 'replace'),
+                filelist.decode('utf8', 'replace') if filelist else None))
+
+    def update(self):
+        """Brings the index up to date with the packages under the root,
+        returning the names of the packages which were recorded and those
+        which were removed, and the names of those which could not be read
+        paired with the reason. Unreadable packages are left out of the
+        index, and are read again on the next update."""
+        known = dict((filename, (size, mtime)) for filename, size, mtime
+            in self.connection.execute('select filename, size, mtime from package'))
+
+        found = {}
+        for dirpath, dirnames, filenames in os.walk(str(self.root)):
+            dirnames[:] = [d for d in dirnames if d != 'repodata' and not d.startswith('.')]
+            for name in filenames:
+                if name.endswith('.rpm') or name.endswith('.deb'):
+                    status = os.stat(os.path.join(dirpath, name))
+                    filename = os.path.relpath(os.path.join(dirpath, name), str(self.root))
+                    found[filename] = (status.st_size, int(status.st_mtime))
+
+        recorded, skipped = [], []
+        for filename in sorted(f for f in found if known.get(f) != found[f]):
+            try:
+                self.record(self.root / filename)
+            except PACKAGE_ERRORS, exception:
+                skipped.append((filename, str(exception) or exception.__class__.__name__))
+            else:
+                recorded.append(filename)
+
+        removed = sorted(f for f in known if f not in found)
+        with self.connection:
+            self.connection.executemany('delete from package where filename = ?',
+                [(filename,) for filename in removed + [f for f, reason in skipped]])
+        return recorded, removed, skipped
+
+    def write_packages(self):
+        """Writes ``Packages`` and ``Packages.gz`` for the deb packages."""
+        entries = [row[0].encode('utf8') for row in self.connection.execute('select entry'
+            ' from package where kind = ? order by filename', ('deb',))]
+        content = '\n'.join(entries)
+
+        _write_atomically(self.root / 'Packages', content)
+        _write_atomically(self.root / 'Packages.gz', _compress(content))
+        return len(entries)
+
+    def write_repodata(self):
+        """Writes ``repodata`` for the rpm packages, replacing the metadata
+        files it previously referenced once the new ``repomd.xml`` is in
+        place. Nothing is written when there are no rpm packages, unless
+        ``repodata`` already exists and so must no longer list them."""
+        rows = self.connection.execute('select entry, filelist from package where kind = ?'
+            ' order by filename', ('rpm',)).fetchall()
+
+        repodata = self.root / 'repodata'
+        if not rows and not repodata.exists():
+            return 0
+
+        primary = ['<?xml version="1.0" encoding="UTF-8"?>\n<metadata xmlns="%s" xmlns:rpm="%s"'
+            ' packages="%d">\n' % (COMMON_NAMESPACE, RPM_NAMESPACE, len(rows))]
+        primary.extend(row[0].encode('utf8') for row in rows)
+        primary.append('</metadata>\n')
+
+        filelists = ['<?xml version="1.0" encoding="UTF-8"?>\n<filelists xmlns="%s"'
+            ' packages="%d">\n' % (FILELISTS_NAMESPACE, len(rows))]
+        filelists.extend(row[1].encode('utf8') for row in rows)
+        filelists.append('</filelists>\n')
+
+        repodata.makedirs_p()
+
+        timestamp = int(time.time())
+        data, referenced = [], set(['repomd.xml'])
+        for type, content in (('primary', ''.join(primary)), ('filelists', ''.join(filelists))):
+            compressed = _compress(content)
+            checksum = sha256(compressed).hexdigest()
+            filename = '%s-%s.xml.gz' % (checksum, type)
+            _write_atomically(repodata / filename, compressed)
+            referenced.add(filename)
+            data.append('  <data type="%s">\n    <checksum type="sha256">%s</checksum>\n'
+                '    <open-checksum type="sha256">%s</open-checksum>\n'
+                '    <location href="repodata/%s"/>\n    <timestamp>%d</timestamp>\n'
+                '    <size>%d</size>\n    <open-size>%d</open-size>\n  </data>\n'
+                % (type, checksum, sha256(content).hexdigest(), filename, timestamp,
+                len(compressed), len(content)))
+
+        repomd = ('<?xml version="1.0" encoding="UTF-8"?>\n<repomd xmlns="%s" xmlns:rpm="%s">\n'
+            '  <revision>%d</revision>\n%s</repomd>\n' % (REPO_NAMESPACE, RPM_NAMESPACE,
+            timestamp, ''.join(data)))
+        _write_atomically(repodata / 'repomd.xml', repomd)
+
+        for filename in os.listdir(str(repodata)):
+            if filename not in referenced and not filename.startswith('.'):
+                os.unlink(str(repodata / filename))
+        return len(rows)
+
+def _compress(content):
+    buffer = StringIO()
+    openfile = gzip.GzipFile('', 'wb', 9, buffer, 0)
+    openfile.write(content)
+    openfile.close()
+    return buffer.getvalue()
+
+def _hash_file(filepath, checksums, names):
+    hashers = dict((name, {'md5': md5, 'sha1': sha1, 'sha256': sha256}[name]())
+        for name in names if name not in checksums)
+    if hashers:
+        with open(str(filepath), 'rb') as openfile:
+            for block in iter(lambda: openfile.read(BLOCK_SIZE), ''):
+                for hasher in hashers.itervalues():
+                    hasher.update(block)
+    return dict(checksums, **dict((name, h.hexdigest()) for name, h in hashers.iteritems()))
+
+def _render_deb(filepath, filename, status, checksums):
+    checksums = _hash_file(filepath, checksums, ('md5', 'sha1', 'sha256'))
+    control = read_control(filepath).rstrip('\n')
+    return ('%s\nFilename: %s\nSize: %d\nMD5sum: %s\nSHA1: %s\nSHA256: %s\n' % (control,
+        filename, status.st_size, checksums['md5'], checksums['sha1'], checksums['sha256']))
+
+def _render_rpm(filepath, filename, status, checksums):
+    package = rpmfile.RpmPackage(filepath)
+    tags = package.tags
+    checksum = _hash_file(filepath, checksums, ('sha256',))['sha256']
+
+    def text(tag):
+        value = tags.get(tag) or ''
+        if isinstance(value, list):
+            value = value[0] if value else ''
+        return escape(value)
+
+    name, arch = tags.get(rpmfile.RPMTAG_NAME) or '', tags.get(rpmfile.RPMTAG_ARCH) or ''
+    epoch = str((tags.get(rpmfile.RPMTAG_EPOCH) or [0])[0])
+    version = '<version epoch="%s" ver=%s rel=%s/>' % (epoch,
+        quoteattr(tags.get(rpmfile.RPMTAG_VERSION) or ''),
+        quoteattr(tags.get(rpmfile.RPMTAG_RELEASE) or ''))
+
+    archive = tags.get(rpmfile.RPMTAG_ARCHIVESIZE) or package.signature.get(
+        rpmfile.SIGTAG_PAYLOADSIZE) or [0]
+    entry = [
+        '<package type="rpm">\n',
+        '  <name>%s</name>\n  <arch>%s</arch>\n  %s\n' % (escape(name), escape(arch), version),
+        '  <checksum type="sha256" pkgid="YES">%s</checksum>\n' % checksum,
+        '  <summary>%s</summary>\n' % text(rpmfile.RPMTAG_SUMMARY),
+        '  <description>%s</description>\n' % text(rpmfile.RPMTAG_DESCRIPTION),
+        '  <packager>%s</packager>\n  <url>%s</url>\n' % (text(rpmfile.RPMTAG_PACKAGER),
+            text(rpmfile.RPMTAG_URL)),
+        '  <time file="%d" build="%d"/>\n' % (int(status.st_mtime),
+            (tags.get(rpmfile.RPMTAG_BUILDTIME) or [0])[0]),
+        '  <size package="%d" installed="%d" archive="%d"/>\n' % (status.st_size,
+            (tags.get(rpmfile.RPMTAG_SIZE) or [0])[0], archive[0]),
+        '  <location href=%s/>\n' % quoteattr(filename),
+        '  <format>\n',
+        '    <rpm:license>%s</rpm:license>\n' % text(rpmfile.RPMTAG_LICENSE),
+        '    <rpm:vendor>%s</rpm:vendor>\n' % text(rpmfile.RPMTAG_VENDOR),
+        '    <rpm:group>%s</rpm:group>\n' % text(rpmfile.RPMTAG_GROUP),
+        '    <rpm:buildhost>%s</rpm:buildhost>\n' % text(rpmfile.RPMTAG_BUILDHOST),
+        '    <rpm:sourcerpm>%s</rpm:sourcerpm>\n' % text(rpmfile.RPMTAG_SOURCERPM),
+        '    <rpm:header-range start="%d" end="%d"/>\n' % (package.header_offset,
+            package.payload_offset),
+    ]
+
+    for element, nametag, flagstag, versiontag in DEPENDENCIES:
+        entries = _render_dependencies(element, tags.get(nametag) or [],
+            tags.get(flagstag) or [], tags.get(versiontag) or [])
+        if entries:
+            entry.append('    <rpm:%s>\n%s    </rpm:%s>\n' % (element, ''.join(entries), element))
+
+    files = _list_files(tags)
+    for filepath, isdir in files:
+        if _is_primary_file(filepath):
+            entry.append('    <file%s>%s</file>\n' % (' type="dir"' if isdir else '',
+                escape(filepath)))
+    entry.append('  </format>\n</package>\n')
+
+    filelist = ['<package pkgid="%s" name=%s arch=%s>\n  %s\n' % (checksum, quoteattr(name),
+        quoteattr(arch), version)]
+    for filepath, isdir in files:
+        filelist.append('  <file%s>%s</file>\n' % (' type="dir"' if isdir else '',
+            escape(filepath)))
+    filelist.append('</package>\n')
+    return ''.join(entry), ''.join(filelist)
+
+def _render_dependencies(element, names, flags, versions):
+    entries = []
+    for name, flag, version in zip(names, flags, versions):
+        if name.startswith('rpmlib('):
+            continue
+
+        attributes = ['name=%s' % quoteattr(name)]
+        if flag & 0xf in FLAGS:
+            attributes.append('flags="%s"' % FLAGS[flag & 0xf])
+            epoch, release = '0', None
+            if ':' in version:
+                epoch, version = version.split(':', 1)
+            if '-' in version:
+                version, release = version.rsplit('-', 1)
+            attributes.append('epoch=%s ver=%s' % (quoteattr(epoch), quoteattr(version)))
+            if release:
+                attributes.append('rel=%s' % quoteattr(release))
+        if element == 'requires' and flag & PREREQ_FLAGS:
+            attributes.append('pre="1"')
+        entries.append('      <rpm:entry %s/>\n' % ' '.join(attributes))
+    return entries
+
+def _is_primary_file(filepath):
+    return (filepath.startswith('/etc/') or '/bin/' in filepath
+        or filepath == '/usr/lib/sendmail')
+
+def _list_files(tags):
+    dirnames = tags.get(rpmfile.RPMTAG_DIRNAMES) or []
+    modes = tags.get(rpmfile.RPMTAG_FILEMODES) or []
+    files = []
+    for index, basename in enumerate(tags.get(rpmfile.RPMTAG_BASENAMES) or []):
+        dirindex = tags[rpmfile.RPMTAG_DIRINDEXES][index]
+        files.append((dirnames[dirindex] + basename, stat.S_ISDIR(modes[index])))
+    return files
+
+def _write_atomically(filepath, content):
+    staging = uniqpath(filepath.parent, '.tmp-')
+    staging.write_bytes(content)
+    os.rename(staging, filepath)
@@ -1,11 +1,15 @@
 import os
 from collections import defaultdict
 from hashlib import sha1
+from string import hexdigits
 from bake.path import path
 from bake.process import Process
 from datetime import datetime, timedelta
 from time import sleep
+from lattice.support.cache import locked, populate
+from lattice.support.gitsession import GitSession
 from lattice.support.specification import Specification
+from lattice.support.specindex import SpecificationIndex
 from lattice.support.versioning import VersionToken
 
 class Repository(object):
@@ -20,6 +24,16 @@ class Repository(object):
     def checkout(self, metadata):
         raise NotImplementedError()
 
+    def get_remote_commit_log(self, metadata, starting_commit=None):
+        """Returns the commit log since ``starting_commit`` of the revision
+        ``metadata`` names, from local history only, or ``None``."""
+        raise NotImplementedError()
+
+    def prefetch(self, metadata):
+        """Populates the cache for ``metadata`` without linking it into the
+        root of this repository, returning the cached path."""
+        raise NotImplementedError()
+
     @classmethod
     def fingerprint(cls, root=None):
         root = path(root or os.getcwd()).abspath()
@@ -37,31 +51,114 @@ class Repository(object):
 class GitRepository(Repository):
     SUPPORTED_SYMBOLS = ['HEAD']
     def checkout(self, metadata):
-        url = metadata['url']
-        branch = metadata.get('branch')
-        revision = metadata.get('revision')
         self.subfolder = metadata.get('subfolder')
+        if not self.cachedir:
+            self._clone(metadata, self.root)
+            return
+
+        cached = self.prefetch(metadata)
+        if self.subfolder:
+            cached = cached / self.subfolder
+        cached.symlink(self.root)
+
+    def prefetch(self, metadata):
+        if metadata.get('mirror'):
+            function = lambda root: self._clone_from_mirror(metadata, root)
+        else:
+            function = lambda root: self._clone(metadata, root)
+        return populate(self._get_cache_entry(metadata), function)
 
-        cached = None
-        root = self.root
-        runtime = self.runtime
-
+    def _get_cache_entry(self, metadata):
+        if not self.cachedir:
+            return None
+        values = [metadata['url'], metadata.get('revision')]
+        if metadata.get('sparse') and metadata.get('subfolder'):
+            # a sparse checkout cannot stand in for a complete one
+            values.append('sparse:%s' % metadata['subfolder'])
+        return self._construct_cache_path(*values)
+
+    def _clone(self, metadata, root):
+        tokens = ['clone', '--no-checkout']
+        if metadata.get('depth'):
+            tokens.extend(['--depth', str(metadata['depth'])])
+            if metadata.get('branch'):
+                tokens.extend(['--branch', metadata['branch']])
+        if metadata.get('filter'):
+            tokens.append('--filter=%s' % metadata['filter'])
+
+        self._run_with_retries(tokens + [metadata['url'], root])
+        self._populate_worktree(metadata, root)
+
+    def _clone_from_mirror(self, metadata, root):
+        mirror = self._update_mirror(metadata)
+
+        # the clone borrows its objects from the mirror rather than copying them
+        self._run_command(['clone', '--shared', '--no-checkout', mirror, root], False, True)
+        self._run_command(['remote', 'set-url', 'origin', metadata['url']], root=root)
+        self._populate_worktree(dict(metadata, depth=None), root)
+
+    def _get_mirror(self, metadata):
         if self.cachedir:
-            cached = self._construct_cache_path(url, revision)
-            if cached.exists():
-                if self.subfolder:
-                    cached = cached / self.subfolder
-                cached.symlink(root)
-                return
-            else:
-                root = cached
+            return self.cachedir / 'mirrors' / ('%s.git' % sha1(metadata['url']).hexdigest())
+
+    def _update_mirror(self, metadata):
+        revision = metadata.get('revision')
+
+        mirror = self._get_mirror(metadata)
+        if mirror.exists():
+            current = revision and revision != 'HEAD' and self._has_commit(mirror, revision)
+            if not current:
+                with locked(mirror + '.fetch.lock'):
+                    self._run_command(['fetch', '--tags', 'origin'], passthrough=True, root=mirror)
+        return populate(mirror, lambda root: self._create_mirror(metadata, root))
+
+    def _create_mirror(self, metadata, root):
+        self._run_with_retries(['clone', '--mirror', metadata['url'], root])
+        # objects must never be pruned from under the clones sharing them
+        self._run_command(['config', 'gc.pruneExpire', 'never'], root=root)
+
+    def _has_commit(self, root, revision):
+        process = self._run_command(['cat-file', '-e', '%s^{commit}' % revision],
+            root=root, passive=True)
+        return process.returncode == 0
+
+    def _resolve_local_revision(self, root, revision):
+        process = self._run_command(['rev-parse', '-q', '--verify', '%s^{commit}' % revision],
+            root=root, passive=True)
+        if process.returncode == 0:
+            return process.stdout.strip()
+
+    def _resolve_remote_revision(self, metadata):
+        # the revision checked out by _populate_worktree, which wins over the branch
+        revision = metadata.get('revision')
+        if revision == 'HEAD':
+            revision = None
+        if revision and len(revision) == 40 and all(c in hexdigits for c in revision):
+            return revision
+
+        name = revision or metadata.get('branch') or 'HEAD'
+        process = self._run_command(['ls-remote', metadata['url'], name, name + '^{}'], False)
+        refs = dict(reversed(line.split('\t', 1)) for line in process.stdout.splitlines()
+            if '\t' in line)
+
+        # annotated tags are peeled to the commit they name
+        for candidate in ('refs/tags/%s^{}' % name, 'refs/tags/%s' % name,
+                'refs/heads/%s' % name, name):
+            if candidate in refs:
+                return refs[candidate]
+        if revision and all(c in hexdigits for c in revision):
+            # an abbreviated commit, which only local history can resolve
+            return revision
+        raise RuntimeError('cannot resolve %s in %s' % (name, metadata['url']))
+
+    def _run_with_retries(self, tokens):
         # make an attempt at cloning several times before giving up
         end_time = datetime.now() + timedelta(minutes=5)
         success = False
-        f = None
+        checkout_error = None
         while datetime.now() < end_time:
             try:
-                self._run_command(['clone', url, root], False, True)
+                self._run_command(tokens, False, True)
                 success = True
                 break
             except Exception, checkout_error:
@@ -72,24 +169,77 @@ class GitRepository(Repository):
         if not success:
             msg = 'caught auto-retry timeout'
             if checkout_error:
-                msg = msg + " " + checkout_error
+                msg = msg + " " + str(checkout_error)
             raise RuntimeError(msg)
-                
-        if branch:
-            self._run_command(['checkout', branch], passthrough=True, root=root)
-        if revision and revision != 'HEAD':
-            self._run_command(['checkout', '-q', revision],
-                passthrough=True, root=root)
-
-        if cached:
-            if self.subfolder:
-                cached = cached / self.subfolder
-            cached.symlink(self.root)
+
+    def _populate_worktree(self, metadata, root):
+        if metadata.get('sparse') and metadata.get('subfolder'):
+            self._run_command(['sparse-checkout', 'set', metadata['subfolder']], root=root)
+
+        targets = [metadata.get('branch'), metadata.get('revision')]
+        targets = [target for target in targets if target and target != 'HEAD'] or ['HEAD']
+        for target in targets:
+            if metadata.get('depth') and not self._has_commit(root, target):
+                self._run_command(['fetch', '--depth', str(metadata['depth']), 'origin', target],
+                    passthrough=True, root=root)
+                target = 'FETCH_HEAD'
+
+            # forced, since the index of a clone without a checkout is empty
+            self._run_command(['checkout', '-q', '-f', target], passthrough=True, root=root)
+
+    def _deepen(self):
+        if not self._get_shallow_commits():
+            return False
+
+        # checkouts in the cache are shared by concurrent builds, so only one
+        # of them unshallows an entry; the others find it already deepened
+        gitdir = self._run_command(['rev-parse', '--absolute-git-dir']).stdout.strip()
+        with locked(os.path.join(gitdir, 'lattice-deepen.lock')):
+            if os.path.exists(os.path.join(gitdir, 'shallow')):
+                # shallow clones track a single branch; queries such as rev-list
+                # --all expect the history of every branch
+                self._run_command(['remote', 'set-branches', 'origin', '*'])
+                self._run_command(['fetch', '--unshallow', '--tags', 'origin'], passthrough=True)
+
+        session = self.session
+        session.invalidate()
+        session.shallow = []
+        return True
+
+    def _get_shallow_commits(self):
+        # the boundary of a shallow clone is only read once per checkout
+        session = self.session
+        if session.shallow is None:
+            session.shallow = []
+            process = self._run_command(['rev-parse', '--absolute-git-dir'], passive=True)
+            if process.returncode == 0:
+                filepath = os.path.join(process.stdout.strip(), 'shallow')
+                if os.path.exists(filepath):
+                    with open(filepath) as openfile:
+                        session.shallow = openfile.read().split()
+        return session.shallow
+
+    def _is_truncated(self, subfolder=None):
+        # history touching the subfolder is cut off only if the subfolder
+        # already exists at a boundary commit; the whole tree always does
+        for commit in self._get_shallow_commits():
+            if not subfolder or self.session.resolve('%s:%s' % (commit, subfolder)):
+                return True
+        return False
 
     def enumerate_components(self):
+        index = self._get_specification_index()
+        if index:
+            try:
+                specifications = list(self._enumerate_indexed_specifications(index))
+            finally:
+                index.close()
+        else:
+            specifications = (self._get_specification(tag)
+                for tag in self._get_tags() + self.SUPPORTED_SYMBOLS)
+
         components = defaultdict(dict)
-        for tag in self._get_tags() + self.SUPPORTED_SYMBOLS:
-            specification = self._get_specification(tag)
+        for specification in specifications:
             if specification:
                 for component in specification.enumerate_components():
                     components[component['name']][component['version']] = component
@@ -104,18 +254,50 @@ class GitRepository(Repository):
     def get_commit_log(self, starting_commit=None):
         tokens = ['log']
         if starting_commit:
+            if not self.session.resolve('%s^{commit}' % starting_commit):
+                self._deepen()
             tokens.append('%s..' % starting_commit)
         tokens.append('--')
         tokens.append('.')
 
-        process = self._run_command(tokens, passive=True)
-        if process.returncode == 0:
-            return process.stdout
+        def query():
+            process = self._run_command(tokens, passive=True)
+            if process.returncode == 0:
+                return process.stdout
+        return self.session.memoize(('log', self._get_head(), starting_commit), query)
+
+    def get_remote_commit_log(self, metadata, starting_commit=None):
+        """Returns the log ``get_commit_log`` would give for a checkout of
+        ``metadata``, without checking it out: the revision is resolved with
+        ``git ls-remote`` and its history read from the mirror or cache entry
+        already holding it. Returns ``None`` when neither holds it."""
+        revision = self._resolve_remote_revision(metadata)
+        if revision == starting_commit:
+            return ''
+
+        for root in (self._get_mirror(metadata), self._get_cache_entry(metadata)):
+            if not root or not root.exists():
+                continue
+            commit = self._resolve_local_revision(root, revision)
+            if not commit:
+                continue
+            if starting_commit and not self._has_commit(root, starting_commit):
+                continue
+
+            tokens = ['log', '%s..%s' % (starting_commit, commit) if starting_commit else commit]
+            tokens.extend(['--', metadata.get('subfolder') or '.'])
+            return self._run_command(tokens, root=root).stdout
 
     def get_current_version(self, unknown_version='0.0.0'):
-        process = self._run_command(['describe', '--tags'], passive=True)
-        if process.returncode == 0:
-            version = process.stdout.strip()
+        def describe():
+            process = self._run_command(['describe', '--tags'], passive=True)
+            if process.returncode != 0 and self._deepen():
+                process = self._run_command(['describe', '--tags'], passive=True)
+            if process.returncode == 0:
+                return process.stdout.strip()
+
+        version = self.session.memoize(('describe', self._get_head()), describe)
+        if version:
             # HACK
             if version[0] == 'v':
                 version = version[1:]
@@ -129,8 +311,10 @@ class GitRepository(Repository):
         return '%s+%s' % (unknown_version, rev_count)
 
     def get_current_hash(self):
-        process = self._run_command(['log', '-1', '--pretty=format:%H'])
-        return process.stdout.strip()
+        head = self._get_head()
+        if not head:
+            raise RuntimeError('unable to resolve HEAD in %s' % self.root)
+        return head
     
     def get_rev_count(self, subfolder=None):
         args = ['rev-list', '--all', '--count', '--']
@@ -138,8 +322,20 @@ class GitRepository(Repository):
             args.append(subfolder)
         else:
             args.append('.')
-        process = self._run_command(args)
-        return int(process.stdout.strip())
+
+        if self._is_truncated(subfolder):
+            self._deepen()
+
+        # rev-list --all counts the history of every ref, which a fetch or a
+        # deepening can move without moving HEAD
+        def query():
+            return int(self._run_command(args).stdout.strip())
+        return self.session.memoize(('rev-count', self._get_head(), self._get_refs(), subfolder),
+            query)
+
+    @property
+    def session(self):
+        return GitSession.get(self.root)
 
     @classmethod
     def is_repository(cls, root):
@@ -150,17 +346,70 @@ class GitRepository(Repository):
         self._run_command(['clean', '-dx'], passthrough=True)
 
     def _get_file(self, filename, commit=None):
-        filename = '%s:%s' % (commit or 'HEAD', filename)
-        try:
-            return self._run_command(['show', filename]).stdout
-        except RuntimeError:
-            return None
+        result = self.session.read('%s:%s' % (commit or 'HEAD', filename))
+        if result and result[0] == 'blob':
+            return result[1]
+
+    def _get_head(self):
+        return self.session.resolve('HEAD')
+
+    def _get_refs(self):
+        process = self._run_command(['for-each-ref', '--format=%(objectname) %(refname)'])
+        return sha1(process.stdout).hexdigest()
 
     def _get_specification(self, commit='HEAD'):
         candidate = self._get_file(self.lfile, commit)
         if candidate:
             return Specification(version=commit).parse(candidate)
 
+    def _enumerate_indexed_specifications(self, index):
+        repository = os.path.realpath(str(self.root))
+        known = index.get_tags(repository)
+
+        tags = {}
+        for tag, obj in self._get_tag_objects():
+            if tag in known and known[tag][0] == obj:
+                tags[tag] = known[tag]
+            else:
+                tags[tag] = (obj, self.session.resolve('%s:%s' % (tag, self.lfile)))
+        if tags != known:
+            index.set_tags(repository, tags)
+
+        targets = [(tag, tags[tag][1]) for tag in sorted(tags)]
+        for symbol in self.SUPPORTED_SYMBOLS:
+            targets.append((symbol, self.session.resolve('%s:%s' % (symbol, self.lfile))))
+
+        for tag, blob in targets:
+            if not blob:
+                continue
+
+            content = index.get_content(blob)
+            if content is None:
+                result = self.session.read(blob)
+                if not (result and result[0] == 'blob' and result[1]):
+                    continue
+                content = Specification.unserialize(result[1])
+                index.set_content(blob, content)
+
+            yield Specification(version=tag).parse(content, None)
+
+    def _get_specification_index(self):
+        if self.cachedir:
+            filepath = path(self.cachedir) / 'specifications.db'
+        else:
+            gitdir = path(self.root) / '.git'
+            if not gitdir.isdir():
+                return None
+            filepath = gitdir / 'lattice-specifications.db'
+        return SpecificationIndex(filepath)
+
+    def _get_tag_objects(self):
+        process = self._run_command(['for-each-ref', '--format=%(refname:short) %(objectname)',
+            'refs/tags'])
+        for line in process.stdout.strip().split('\n'):
+            if line:
+                yield tuple(line.rsplit(' ', 1))
+
     def _get_tags(self):
         tags = self._run_command(['tag']).stdout.strip()
         if tags:
@@ -185,37 +434,94 @@ Repository.implementations['git'] = GitRepository
 
 class SubversionRepository(Repository):
     SUPPORTED_SYMBOLS = ['HEAD']
+    INFO_FILENAME = '.svn-info'
 
     def checkout(self, metadata):
-        url = metadata['url']
+        if not self.cachedir:
+            self._checkout(metadata, self.root)
+            return
+
+        cached = self.prefetch(metadata)
+        cached.symlink(self.root)
+
+    def prefetch(self, metadata):
+        # cached trees are keyed on a concrete revision, so a moved HEAD or
+        # a changed revision is never answered with a stale tree
+        revision = self._resolve_revision(metadata)
+        return populate(self._construct_cache_path(metadata['url'], revision),
+            lambda root: self._export(metadata, revision, root))
+
+    def _checkout(self, metadata, root):
         revision = metadata.get('revision')
         if not revision:
             revision = 'HEAD'
+        self._run_command(['co', '-r', str(revision), metadata['url'], root], False, True)
 
-        cached = None
-        root = self.root
-
-        if self.cachedir:
-            cached = self._construct_cache_path(url)
-            if cached.exists():
-                cached.symlink(root)
-                return
+    def _export(self, metadata, revision, root):
+        """Moves the working copy kept for the url to ``revision`` and
+        exports it to ``root``, along with its ``svn info``."""
+        url = metadata['url']
+        workingcopy = self.cachedir / 'mirrors' / ('%s.svn' % sha1(url).hexdigest())
+
+        with locked(workingcopy + '.update.lock'):
+            if workingcopy.exists():
+                try:
+                    self._run_command(['update', '-q', '-r', revision], passthrough=True,
+                        root=workingcopy)
+                except RuntimeError:
+                    # recovers from an update interrupted by an earlier build
+                    self._run_command(['cleanup'], root=workingcopy)
+                    self._run_command(['update', '-q', '-r', revision], passthrough=True,
+                        root=workingcopy)
             else:
-                root = cached
+                populate(workingcopy, lambda staging:
+                    self._checkout(dict(metadata, revision=revision), staging))
+
+            self._run_command(['export', '-q', workingcopy, root], False, True)
+            info = self._run_command(['info'], root=workingcopy).stdout
+        (root / self.INFO_FILENAME).write_bytes(info)
 
-        self._run_command(['co', '-r', str(revision), url, root], False, True)
-        if cached:
-            cached.symlink(self.root)
+    def _get_info(self):
+        filepath = path(self.root) / self.INFO_FILENAME
+        if not filepath.exists():
+            return None
+
+        info = {}
+        for line in filepath.bytes().splitlines():
+            if ': ' in line:
+                key, value = line.split(': ', 1)
+                info[key] = value.strip()
+        return info
+
+    def _resolve_revision(self, metadata):
+        revision = str(metadata.get('revision') or 'HEAD')
+        if revision.lstrip('r').isdigit():
+            return revision.lstrip('r')
+
+        process = self._run_command(['info', '-r', revision, metadata['url']], False)
+        for line in process.stdout.splitlines():
+            if line.startswith('Last Changed Rev:'):
+                return line.split(':', 1)[1].strip()
+        raise RuntimeError('cannot resolve revision %s of %s' % (revision, metadata['url']))
 
     @classmethod
     def is_repository(cls, root):
         fingerprint = root / '.svn'
+        if (root / cls.INFO_FILENAME).exists():
+            return True
         return fingerprint.exists() and fingerprint.isdir()
     
     def get_commit_log(self, starting_commit=None):
         return ''
 
+    def get_remote_commit_log(self, metadata, starting_commit=None):
+        return ''
+
     def get_current_version(self, unknown_version='0.0.0'):
+        info = self._get_info()
+        if info and info.get('Last Changed Rev'):
+            return info['Last Changed Rev']
+
         process = self._run_command(['log', '-l', '1', '.'], cmd='svn')
         if process.returncode == 0:
             version = process.stdout.split('\n')[1].split(' ')[0]
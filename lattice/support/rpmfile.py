@@ -0,0 +1,661 @@
+import bz2
+import gzip
+import os
+import re
+import socket
+import stat
+import struct
+import time
+import zlib
+from distutils.spawn import find_executable
+from hashlib import md5, sha1, sha256
+from itertools import chain
+from subprocess import Popen, PIPE
+
+from bake import path
+
+from lattice.support.archive import read_archive
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+LEAD_MAGIC = '\xed\xab\xee\xdb'
+HEADER_MAGIC = '\x8e\xad\xe8\x01'
+LEAD_SIZE = 96
+
+RPMTAG_HEADERSIGNATURES = 62
+RPMTAG_HEADERIMMUTABLE = 63
+RPMTAG_HEADERI18NTABLE = 100
+RPMTAG_NAME = 1000
+RPMTAG_VERSION = 1001
+RPMTAG_RELEASE = 1002
+RPMTAG_EPOCH = 1003
+RPMTAG_SUMMARY = 1004
+RPMTAG_DESCRIPTION = 1005
+RPMTAG_BUILDTIME = 1006
+RPMTAG_BUILDHOST = 1007
+RPMTAG_SIZE = 1009
+RPMTAG_VENDOR = 1011
+RPMTAG_LICENSE = 1014
+RPMTAG_PACKAGER = 1015
+RPMTAG_GROUP = 1016
+RPMTAG_URL = 1020
+RPMTAG_OS = 1021
+RPMTAG_ARCH = 1022
+RPMTAG_PREIN = 1023
+RPMTAG_POSTIN = 1024
+RPMTAG_PREUN = 1025
+RPMTAG_POSTUN = 1026
+RPMTAG_FILESIZES = 1028
+RPMTAG_FILEMODES = 1030
+RPMTAG_FILERDEVS = 1033
+RPMTAG_FILEMTIMES = 1034
+RPMTAG_FILEDIGESTS = 1035
+RPMTAG_FILELINKTOS = 1036
+RPMTAG_FILEFLAGS = 1037
+RPMTAG_FILEUSERNAME = 1039
+RPMTAG_FILEGROUPNAME = 1040
+RPMTAG_SOURCERPM = 1044
+RPMTAG_FILEVERIFYFLAGS = 1045
+RPMTAG_ARCHIVESIZE = 1046
+RPMTAG_PROVIDENAME = 1047
+RPMTAG_REQUIREFLAGS = 1048
+RPMTAG_REQUIRENAME = 1049
+RPMTAG_REQUIREVERSION = 1050
+RPMTAG_CONFLICTFLAGS = 1053
+RPMTAG_CONFLICTNAME = 1054
+RPMTAG_CONFLICTVERSION = 1055
+RPMTAG_PREINPROG = 1085
+RPMTAG_POSTINPROG = 1086
+RPMTAG_PREUNPROG = 1087
+RPMTAG_POSTUNPROG = 1088
+RPMTAG_OBSOLETENAME = 1090
+RPMTAG_FILEDEVICES = 1095
+RPMTAG_FILEINODES = 1096
+RPMTAG_FILELANGS = 1097
+RPMTAG_PROVIDEFLAGS = 1112
+RPMTAG_PROVIDEVERSION = 1113
+RPMTAG_OBSOLETEFLAGS = 1114
+RPMTAG_OBSOLETEVERSION = 1115
+RPMTAG_DIRINDEXES = 1116
+RPMTAG_BASENAMES = 1117
+RPMTAG_DIRNAMES = 1118
+RPMTAG_PAYLOADFORMAT = 1124
+RPMTAG_PAYLOADCOMPRESSOR = 1125
+RPMTAG_PAYLOADFLAGS = 1126
+
+SIGTAG_SHA1 = 269
+SIGTAG_SHA256 = 273
+SIGTAG_SIZE = 1000
+SIGTAG_MD5 = 1004
+SIGTAG_PAYLOADSIZE = 1007
+
+INT16_TYPE = 3
+INT32_TYPE = 4
+STRING_TYPE = 6
+BIN_TYPE = 7
+STRING_ARRAY_TYPE = 8
+I18NSTRING_TYPE = 9
+
+RPMSENSE_LESS = 1 << 1
+RPMSENSE_GREATER = 1 << 2
+RPMSENSE_EQUAL = 1 << 3
+RPMSENSE_INTERP = 1 << 8
+RPMSENSE_RPMLIB = 1 << 24
+RPMSENSE_OPERATORS = {'<': RPMSENSE_LESS, '<=': RPMSENSE_LESS | RPMSENSE_EQUAL,
+    '=': RPMSENSE_EQUAL, '>=': RPMSENSE_GREATER | RPMSENSE_EQUAL, '>': RPMSENSE_GREATER}
+
+SCRIPTLETS = {
+    'pre': (RPMTAG_PREIN, RPMTAG_PREINPROG, 1 << 9),
+    'post': (RPMTAG_POSTIN, RPMTAG_POSTINPROG, 1 << 10),
+    'preun': (RPMTAG_PREUN, RPMTAG_PREUNPROG, 1 << 11),
+    'postun': (RPMTAG_POSTUN, RPMTAG_POSTUNPROG, 1 << 12),
+}
+
+DEPENDENCY_EXPR = re.compile(r'^(\S+)(?:\s*(<=|>=|<|>|=)\s*(\S+))?$')
+
+CPIO_MAGIC = '070701'
+CPIO_MAGICS = (CPIO_MAGIC, '070702')
+CPIO_HEADER_SIZE = 110
+CPIO_TRAILER = 'TRAILER!!!'
+
+BLOCK_SIZE = 1024 * 1024
+
+class RpmError(Exception):
+    pass
+
+class RpmPackage(object):
+    """A reader for rpm packages which extracts the cpio payload in
+    process, without rpm2cpio or cpio."""
+
+    def __init__(self, filepath):
+        self.filepath = str(filepath)
+        with open(self.filepath, 'rb') as openfile:
+            lead = openfile.read(LEAD_SIZE)
+            if not lead.startswith(LEAD_MAGIC):
+                raise RpmError('%s is not an rpm package' % self.filepath)
+
+            self.signature = self._read_header(openfile, True)
+            self.header_offset = openfile.tell()
+            self.tags = self._read_header(openfile)
+            self.payload_offset = openfile.tell()
+
+    @property
+    def name(self):
+        return self.tags.get(RPMTAG_NAME)
+
+    @property
+    def version(self):
+        return self.tags.get(RPMTAG_VERSION)
+
+    @property
+    def compressor(self):
+        return self.tags.get(RPMTAG_PAYLOADCOMPRESSOR) or 'gzip'
+
+    def extract(self, target):
+        """Extracts the payload into ``target``, returning the names of the
+        extracted members. As with ``cpio -idm``, parent directories are
+        created, modification times are preserved and existing files which
+        are at least as new as the archived ones are left alone."""
+        target = path(target)
+        openfile = open(self.filepath, 'rb')
+        try:
+            openfile.seek(self.payload_offset)
+            stream = _open_stream(openfile, self.compressor)
+            try:
+                return _extract_cpio(stream, target)
+            finally:
+                stream.close()
+        finally:
+            openfile.close()
+
+    def _read_header(self, openfile, signature=False):
+        preamble = openfile.read(16)
+        if len(preamble) != 16 or not preamble.startswith(HEADER_MAGIC):
+            raise RpmError('%s has a corrupt header' % self.filepath)
+
+        count, size = struct.unpack('>II', preamble[8:])
+        index = openfile.read(count * 16)
+        data = openfile.read(size)
+        if signature and size % 8:
+            openfile.read(8 - size % 8)
+
+        tags = {}
+        for offset in range(0, count * 16, 16):
+            tag, type, position, items = struct.unpack('>IIII', index[offset:offset + 16])
+            if type == STRING_TYPE:
+                tags[tag] = data[position:data.index('\x00', position)]
+            elif type in (STRING_ARRAY_TYPE, I18NSTRING_TYPE):
+                values = []
+                for i in range(items):
+                    end = data.index('\x00', position)
+                    values.append(data[position:end])
+                    position = end + 1
+                tags[tag] = values
+            elif type == INT16_TYPE:
+                tags[tag] = list(struct.unpack('>%dH' % items, data[position:position + items * 2]))
+            elif type == INT32_TYPE:
+                tags[tag] = list(struct.unpack('>%dI' % items, data[position:position + items * 4]))
+            elif type == BIN_TYPE:
+                tags[tag] = data[position:position + items]
+        return tags
+
+class RpmWriter(object):
+    """Writes a binary rpm package in process, without rpmbuild or fakeroot.
+
+    The cpio payload is streamed straight from a component tarball, with
+    ownership set to root, and the digests of the finished package are
+    computed while it is written and left in ``md5`` and ``sha256``.
+    Hardlinks are not supported.
+    """
+
+    def __init__(self, filepath, name, version, release, arch):
+        self.filepath = str(filepath)
+        self.name = name
+        self.version = version
+        self.release = release
+        self.arch = arch
+        self.md5 = None
+        self.sha256 = None
+
+    def write(self, archive, requires=(), provides=(), obsoletes=(), scripts=None,
+            summary=None, description=None, packager=None, group=None, license=None):
+        """Writes the package, given the path to the component tarball
+        holding its files. Dependencies are given as strings such as
+        ``'name'`` or ``'name >= version'``, and ``scripts`` maps scriptlet
+        names, such as ``'post'``, to their content."""
+        payloadpath = self.filepath + '.payload'
+        staging = self.filepath + '.tmp'
+        try:
+            with open(payloadpath, 'w+b') as payload:
+                if find_executable('xz'):
+                    compressor = 'xz'
+                    files, payloadsize = self._write_payload(payload, archive, ['xz', '-T0', '-c'])
+                else:
+                    compressor = 'gzip'
+                    files, payloadsize = self._write_payload(payload, archive)
+
+                header = self._build_header(files, compressor, requires, provides, obsoletes,
+                    scripts or {}, summary, description, packager, group, license)
+                signature = self._build_signature(header, payload, payloadsize)
+
+                hashers = [md5(), sha256()]
+                with open(staging, 'wb') as openfile:
+                    payload.seek(0)
+                    leading = [self._build_lead(), signature, header]
+                    for block in chain(leading, iter(lambda: payload.read(BLOCK_SIZE), '')):
+                        openfile.write(block)
+                        for hasher in hashers:
+                            hasher.update(block)
+            os.rename(staging, self.filepath)
+        finally:
+            for filepath in (payloadpath, staging):
+                if os.path.exists(filepath):
+                    os.unlink(filepath)
+
+        self.md5, self.sha256 = [hasher.hexdigest() for hasher in hashers]
+        return self.md5
+
+    def _build_lead(self):
+        fullname = '%s-%s-%s' % (self.name, self.version, self.release)
+        return struct.pack('>4sBBhh66shh16s', LEAD_MAGIC, 3, 0, 0, 1, fullname[:65], 1, 5, '')
+
+    def _build_header(self, files, compressor, requires, provides, obsoletes, scripts,
+            summary, description, packager, group, license):
+        fullversion = '%s-%s' % (self.version, self.release)
+        provides = [self.name + ' = ' + fullversion] + list(provides)
+        requires = [parse_dependency(requirement) for requirement in requires]
+        requires += [('rpmlib(CompressedFileNames)', RPMSENSE_LESS | RPMSENSE_EQUAL | RPMSENSE_RPMLIB,
+            '3.0.4-1'), ('rpmlib(PayloadFilesHavePrefix)', RPMSENSE_LESS | RPMSENSE_EQUAL
+            | RPMSENSE_RPMLIB, '4.0-1')]
+        if compressor == 'xz':
+            requires.append(('rpmlib(PayloadIsXz)', RPMSENSE_LESS | RPMSENSE_EQUAL
+                | RPMSENSE_RPMLIB, '5.2-1'))
+
+        tags = [
+            (RPMTAG_HEADERI18NTABLE, STRING_ARRAY_TYPE, ['C']),
+            (RPMTAG_NAME, STRING_TYPE, self.name),
+            (RPMTAG_VERSION, STRING_TYPE, self.version),
+            (RPMTAG_RELEASE, STRING_TYPE, self.release),
+            (RPMTAG_SUMMARY, I18NSTRING_TYPE, [summary or self.name]),
+            (RPMTAG_DESCRIPTION, I18NSTRING_TYPE, [description or summary or self.name]),
+            (RPMTAG_BUILDTIME, INT32_TYPE, [int(time.time())]),
+            (RPMTAG_BUILDHOST, STRING_TYPE, socket.gethostname()),
+            (RPMTAG_SIZE, INT32_TYPE, [sum(entry[2] for entry in files)]),
+            (RPMTAG_LICENSE, STRING_TYPE, license or 'Commercial'),
+            (RPMTAG_GROUP, I18NSTRING_TYPE, [group or 'Unspecified']),
+            (RPMTAG_OS, STRING_TYPE, 'linux'),
+            (RPMTAG_ARCH, STRING_TYPE, self.arch),
+            (RPMTAG_SOURCERPM, STRING_TYPE, '%s-%s.src.rpm' % (self.name, fullversion)),
+            (RPMTAG_PAYLOADFORMAT, STRING_TYPE, 'cpio'),
+            (RPMTAG_PAYLOADCOMPRESSOR, STRING_TYPE, compressor),
+            (RPMTAG_PAYLOADFLAGS, STRING_TYPE, '6' if compressor == 'xz' else '9'),
+        ]
+        if packager:
+            tags.append((RPMTAG_PACKAGER, STRING_TYPE, packager))
+
+        for scriptlet, content in scripts.iteritems():
+            tag, progtag, sense = SCRIPTLETS[scriptlet]
+            tags.append((tag, STRING_TYPE, content))
+            tags.append((progtag, STRING_TYPE, '/bin/sh'))
+            requires.append(('/bin/sh', RPMSENSE_INTERP | sense, ''))
+
+        self._add_dependencies(tags, requires, RPMTAG_REQUIRENAME, RPMTAG_REQUIREFLAGS,
+            RPMTAG_REQUIREVERSION)
+        self._add_dependencies(tags, [parse_dependency(p) for p in provides],
+            RPMTAG_PROVIDENAME, RPMTAG_PROVIDEFLAGS, RPMTAG_PROVIDEVERSION)
+        self._add_dependencies(tags, [parse_dependency(o) for o in obsoletes],
+            RPMTAG_OBSOLETENAME, RPMTAG_OBSOLETEFLAGS, RPMTAG_OBSOLETEVERSION)
+
+        if files:
+            dirnames, dirindexes, basenames = [], [], []
+            positions = {}
+            for entry in files:
+                dirname, basename = entry[0].rsplit('/', 1)
+                dirname += '/'
+                if dirname not in positions:
+                    positions[dirname] = len(dirnames)
+                    dirnames.append(dirname)
+                dirindexes.append(positions[dirname])
+                basenames.append(basename)
+
+            count = len(files)
+            tags.extend([
+                (RPMTAG_FILESIZES, INT32_TYPE, [entry[2] for entry in files]),
+                (RPMTAG_FILEMODES, INT16_TYPE, [entry[1] for entry in files]),
+                (RPMTAG_FILERDEVS, INT16_TYPE, [0] * count),
+                (RPMTAG_FILEMTIMES, INT32_TYPE, [entry[3] for entry in files]),
+                (RPMTAG_FILEDIGESTS, STRING_ARRAY_TYPE, [entry[4] for entry in files]),
+                (RPMTAG_FILELINKTOS, STRING_ARRAY_TYPE, [entry[5] for entry in files]),
+                (RPMTAG_FILEFLAGS, INT32_TYPE, [0] * count),
+                (RPMTAG_FILEUSERNAME, STRING_ARRAY_TYPE, ['root'] * count),
+                (RPMTAG_FILEGROUPNAME, STRING_ARRAY_TYPE, ['root'] * count),
+                (RPMTAG_FILEVERIFYFLAGS, INT32_TYPE, [0xffffffff] * count),
+                (RPMTAG_FILEDEVICES, INT32_TYPE, [1] * count),
+                (RPMTAG_FILEINODES, INT32_TYPE, range(1, count + 1)),
+                (RPMTAG_FILELANGS, STRING_ARRAY_TYPE, [''] * count),
+                (RPMTAG_DIRINDEXES, INT32_TYPE, dirindexes),
+                (RPMTAG_BASENAMES, STRING_ARRAY_TYPE, basenames),
+                (RPMTAG_DIRNAMES, STRING_ARRAY_TYPE, dirnames),
+            ])
+        return _build_header(tags, RPMTAG_HEADERIMMUTABLE)
+
+    def _add_dependencies(self, tags, dependencies, nametag, flagstag, versiontag):
+        if dependencies:
+            tags.append((nametag, STRING_ARRAY_TYPE, [d[0] for d in dependencies]))
+            tags.append((flagstag, INT32_TYPE, [d[1] for d in dependencies]))
+            tags.append((versiontag, STRING_ARRAY_TYPE, [d[2] for d in dependencies]))
+
+    def _build_signature(self, header, payload, payloadsize):
+        # the signature covers the payload as well as the header, and so is
+        # only known once the payload has been written
+        hasher = md5(header)
+        payload.seek(0)
+        for block in iter(lambda: payload.read(BLOCK_SIZE), ''):
+            hasher.update(block)
+
+        signature = _build_header([
+            (SIGTAG_SHA1, STRING_TYPE, sha1(header).hexdigest()),
+            (SIGTAG_SHA256, STRING_TYPE, sha256(header).hexdigest()),
+            (SIGTAG_SIZE, INT32_TYPE, [len(header) + payload.tell()]),
+            (SIGTAG_MD5, BIN_TYPE, hasher.digest()),
+            (SIGTAG_PAYLOADSIZE, INT32_TYPE, [payloadsize]),
+        ], RPMTAG_HEADERSIGNATURES)
+        return signature + '\x00' * (-len(signature) % 8)
+
+    def _write_payload(self, payload, archive, command=None):
+        if command:
+            payload.flush()
+            process = Popen(command, stdin=PIPE, stdout=payload)
+            try:
+                files, size = self._write_cpio(process.stdin, archive)
+            finally:
+                process.stdin.close()
+                if process.wait() != 0:
+                    raise RpmError('%s failed while writing %s' % (command[0], self.filepath))
+            payload.seek(0, os.SEEK_END)
+        else:
+            compressed = gzip.GzipFile('', 'wb', 9, payload)
+            files, size = self._write_cpio(compressed, archive)
+            compressed.close()
+        return files, size
+
+    def _write_cpio(self, fileobj, archive):
+        files = []
+        written = [0]
+        def write(data):
+            fileobj.write(data)
+            written[0] += len(data)
+
+        with read_archive(archive) as source:
+            for member in source:
+                name = _normalize_name(member.name)
+                if not name:
+                    continue
+                if member.islnk():
+                    raise RpmError('cannot write the hardlink %s of %s' % (name, archive))
+
+                permissions = member.mode & 07777
+                content = linkto = ''
+                if member.isdir():
+                    mode, size = stat.S_IFDIR | permissions, 0
+                elif member.issym():
+                    mode, size = stat.S_IFLNK | 0777, len(member.linkname)
+                    linkto = member.linkname
+                elif member.isfile():
+                    mode, size = stat.S_IFREG | permissions, member.size
+                else:
+                    continue
+
+                write(_build_cpio_header(len(files) + 1, mode, 2 if member.isdir() else 1,
+                    member.mtime, size, './' + name))
+                if member.isfile():
+                    hasher = md5()
+                    sourcefile = source.extractfile(member)
+                    for block in iter(lambda: sourcefile.read(BLOCK_SIZE), ''):
+                        hasher.update(block)
+                        write(block)
+                    content = hasher.hexdigest()
+                elif linkto:
+                    write(linkto)
+                write('\x00' * (-size % 4))
+                files.append(('/' + name, mode, size, int(member.mtime), content, linkto))
+
+        write(_build_cpio_header(0, 0, 1, 0, 0, CPIO_TRAILER))
+
+        # the header lists files sorted by path, while the payload follows
+        # the order of the tarball, which rpm allows
+        files.sort()
+        return files, written[0]
+
+class _Stream(object):
+    def __init__(self, read, close=None):
+        self.buffer = ''
+        self.position = 0
+        self.exhausted = False
+        self._read = read
+        self._close = close
+
+    def close(self):
+        if self._close:
+            self._close()
+
+    def read(self, size):
+        while len(self.buffer) - self.position < size and not self.exhausted:
+            block = self._read()
+            if block is None:
+                self.exhausted = True
+            else:
+                self.buffer = self.buffer[self.position:] + block
+                self.position = 0
+
+        data = self.buffer[self.position:self.position + size]
+        self.position += len(data)
+        if len(data) != size:
+            raise RpmError('truncated rpm payload')
+        return data
+
+def _open_stream(openfile, compressor):
+    # xz and lzma payloads are decompressed with the lzma module, which is
+    # backports.lzma on python 2, and zstd payloads with zstandard; only
+    # when those are not installed is the payload piped through xz or zstd
+    if compressor == 'gzip':
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif compressor == 'bzip2':
+        decompressor = bz2.BZ2Decompressor()
+    elif compressor == 'xz' and lzma:
+        decompressor = lzma.LZMADecompressor(lzma.FORMAT_XZ)
+    elif compressor == 'lzma' and lzma:
+        decompressor = lzma.LZMADecompressor(lzma.FORMAT_ALONE)
+    elif compressor == 'zstd' and zstandard:
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+    elif compressor in ('xz', 'lzma', 'zstd'):
+        return _open_process_stream(openfile, compressor)
+    else:
+        raise RpmError('unsupported payload compression %r' % compressor)
+
+    def read():
+        block = openfile.read(BLOCK_SIZE)
+        if block:
+            return decompressor.decompress(block)
+    return _Stream(read)
+
+def _open_process_stream(openfile, compressor):
+    command = {'xz': ['xz', '-d', '-c'], 'lzma': ['xz', '--format=lzma', '-d', '-c'],
+        'zstd': ['zstd', '-d', '-q', '-c']}[compressor]
+    if not find_executable(command[0]):
+        module = ('zstandard' if compressor == 'zstd' else 'lzma')
+        raise RpmError('cannot decompress %s payload without the %s module or %s'
+            % (compressor, module, command[0]))
+
+    # the child reads the payload directly from the package, so the
+    # descriptor itself must be positioned at the start of the payload
+    os.lseek(openfile.fileno(), openfile.tell(), os.SEEK_SET)
+    process = Popen(command, stdin=openfile, stdout=PIPE)
+
+    def close():
+        process.stdout.close()
+        process.wait()
+    return _Stream(lambda: process.stdout.read(BLOCK_SIZE) or None, close)
+
+def _extract_cpio(stream, target):
+    root = os.path.realpath(str(target))
+    members = []
+    links = {}
+    while True:
+        header = stream.read(CPIO_HEADER_SIZE)
+        if header[:6] not in CPIO_MAGICS:
+            raise RpmError('unsupported cpio payload')
+
+        fields = [int(header[i:i + 8], 16) for i in range(6, CPIO_HEADER_SIZE, 8)]
+        inode, mode, nlink, mtime, size, namesize = (fields[0], fields[1], fields[4],
+            fields[5], fields[6], fields[11])
+
+        name = stream.read(namesize)[:-1]
+        stream.read(-(CPIO_HEADER_SIZE + namesize) % 4)
+        if name == CPIO_TRAILER:
+            break
+
+        name = _member_name(name)
+        filepath = os.path.join(target, name)
+        if name:
+            if not _is_within(root, os.path.realpath(os.path.dirname(filepath))):
+                raise RpmError('cpio member %s would be extracted outside %s' % (name, target))
+            members.append(name)
+
+        if stat.S_ISDIR(mode):
+            if not os.path.isdir(filepath):
+                os.makedirs(filepath, stat.S_IMODE(mode) | 0700)
+        elif stat.S_ISLNK(mode):
+            linktarget = stream.read(size)
+            if _is_replaceable(filepath, mtime):
+                _prepare(filepath)
+                os.symlink(linktarget, filepath)
+        elif stat.S_ISREG(mode):
+            if nlink > 1 and size == 0:
+                # the content of a hardlinked file follows its last link
+                links.setdefault(inode, []).append((filepath, mode, mtime))
+                continue
+
+            replaceable = _is_replaceable(filepath, mtime)
+            if replaceable:
+                _prepare(filepath)
+                _write_file(stream, filepath, size, mode, mtime)
+            else:
+                _skip(stream, size)
+            for linkpath, linkmode, linkmtime in links.pop(inode, []):
+                if _is_replaceable(linkpath, linkmtime):
+                    _prepare(linkpath)
+                    os.link(filepath, linkpath)
+        else:
+            _skip(stream, size)
+
+        stream.read(-size % 4)
+
+    for entries in links.itervalues():
+        for filepath, mode, mtime in entries:
+            if _is_replaceable(filepath, mtime):
+                _prepare(filepath)
+                _write_file(None, filepath, 0, mode, mtime)
+    return members
+
+def _member_name(name):
+    # payload names are relative to the root, usually with a leading './';
+    # anything absolute or climbing out of the root is refused
+    if name.startswith('./'):
+        name = name[2:]
+    if os.path.isabs(name):
+        raise RpmError('cpio member %s is absolute' % name)
+
+    name = os.path.normpath(name) if name else '.'
+    if name == '..' or name.startswith('../'):
+        raise RpmError('cpio member %s is outside the payload root' % name)
+    return name if name != '.' else ''
+
+def _is_within(root, filepath):
+    return filepath == root or filepath.startswith(root.rstrip('/') + '/')
+
+def _is_replaceable(filepath, mtime):
+    try:
+        return os.lstat(filepath).st_mtime < mtime
+    except OSError:
+        return True
+
+def _prepare(filepath):
+    parent = os.path.dirname(filepath)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    if os.path.lexists(filepath) and not os.path.isdir(filepath):
+        os.unlink(filepath)
+
+def _skip(stream, size):
+    while size:
+        size -= len(stream.read(min(size, BLOCK_SIZE)))
+
+def _write_file(stream, filepath, size, mode, mtime):
+    with open(filepath, 'wb') as openfile:
+        while size:
+            block = stream.read(min(size, BLOCK_SIZE))
+            openfile.write(block)
+            size -= len(block)
+    os.chmod(filepath, stat.S_IMODE(mode))
+    os.utime(filepath, (mtime, mtime))
+
+def parse_dependency(dependency):
+    """Parses a dependency such as ``'name >= version'`` into its name,
+    sense flags and version."""
+    match = DEPENDENCY_EXPR.match(dependency.strip())
+    if not match:
+        raise RpmError('invalid dependency %r' % dependency)
+
+    name, operator, version = match.groups()
+    if operator:
+        return name, RPMSENSE_OPERATORS[operator], version
+    return name, 0, ''
+
+def _build_cpio_header(inode, mode, nlink, mtime, size, name):
+    fields = (inode, mode, 0, 0, nlink, int(mtime), size, 0, 0, 0, 0, len(name) + 1, 0)
+    header = CPIO_MAGIC + ''.join('%08x' % field for field in fields) + name + '\x00'
+    return header + '\x00' * (-len(header) % 4)
+
+def _build_header(tags, region):
+    index = []
+    data = ''
+    for tag, type, value in sorted(tags):
+        if type == INT16_TYPE:
+            data += '\x00' * (len(data) % 2)
+            content, count = struct.pack('>%dH' % len(value), *value), len(value)
+        elif type == INT32_TYPE:
+            data += '\x00' * (-len(data) % 4)
+            content, count = struct.pack('>%dI' % len(value), *value), len(value)
+        elif type == STRING_TYPE:
+            content, count = value + '\x00', 1
+        elif type == BIN_TYPE:
+            content, count = value, len(value)
+        else:
+            content, count = ''.join(item + '\x00' for item in value), len(value)
+        index.append(struct.pack('>IIII', tag, type, len(data), count))
+        data += content
+
+    # the region tag marks every entry as part of the immutable header
+    index.insert(0, struct.pack('>IIII', region, BIN_TYPE, len(data), 16))
+    data += struct.pack('>IIiI', region, BIN_TYPE, -len(index) * 16, 16)
+    return HEADER_MAGIC + '\x00' * 4 + struct.pack('>II', len(index), len(data)) + ''.join(index) + data
+
+def _normalize_name(name):
+    name = name.lstrip('/')
+    while name.startswith('./'):
+        name = name[2:].lstrip('/')
+    name = name.rstrip('/')
+    if name != '.':
+        return name
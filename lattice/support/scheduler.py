@@ -0,0 +1,119 @@
+import traceback
+from multiprocessing import Process, Queue
+from Queue import Empty
+
+class JobFailed(Exception):
+    def __init__(self, name, details):
+        Exception.__init__(self, name, details)
+        self.name = name
+        self.details = details
+
+    def __str__(self):
+        return 'job %r failed:\n%s' % (self.name, self.details)
+
+class DependencyScheduler(object):
+    """Runs a graph of jobs in a bounded pool of forked worker processes.
+
+    Jobs are started in the order they were added as soon as every job they
+    depend on has completed. Workers are forked rather than threaded because
+    tasks change the working directory of the process they run in. The
+    result returned by each job must be picklable, and is handed back to the
+    parent through ``complete`` in completion order.
+
+    The optional ``prepare`` callable is run before each worker is forked,
+    to quiesce any threads whose locks the worker could otherwise inherit.
+    """
+
+    def __init__(self, jobs=1, poll=1, prepare=None):
+        self.jobs = max(jobs or 1, 1)
+        self.poll = poll
+        self.prepare = prepare
+        self.payloads = {}
+        self.pending = []
+        self.requires = {}
+
+    def add(self, name, dependencies=None, payload=None):
+        self.pending.append(name)
+        self.payloads[name] = payload
+        self.requires[name] = set(dependencies or [])
+
+    def run(self, execute, complete, ready=None):
+        """Runs every job.
+
+        ``execute`` is called in a worker with the job's payload; ``complete``
+        is called in this process with the job's name and result. The
+        optional ``ready`` predicate can hold back a job whose dependencies
+        are satisfied until some external condition is met.
+        """
+        queue = Queue()
+        known = set(self.pending)
+        finished = set()
+        running = {}
+        failure = None
+
+        while self.pending or running:
+            if not failure:
+                for name in list(self.pending):
+                    if len(running) >= self.jobs:
+                        break
+                    if not (self.requires[name] & known) <= finished:
+                        continue
+                    if ready and not ready(name):
+                        continue
+                    self.pending.remove(name)
+                    running[name] = self._spawn(queue, name, execute)
+            elif not running:
+                break
+
+            if not running:
+                if ready:
+                    ready_blocked = [n for n in self.pending
+                        if (self.requires[n] & known) <= finished]
+                    if ready_blocked:
+                        self._wait(queue)
+                        continue
+                raise JobFailed(self.pending[0], 'unsatisfiable dependencies')
+
+            message = self._wait(queue)
+            if message:
+                name, succeeded, result = message
+                running.pop(name).join()
+                if succeeded:
+                    finished.add(name)
+                    complete(name, result)
+                elif not failure:
+                    failure = JobFailed(name, result)
+                continue
+
+            for name, process in running.items():
+                if not process.is_alive() and process.exitcode != 0:
+                    running.pop(name)
+                    if not failure:
+                        failure = JobFailed(name, 'worker exited with code %s'
+                            % process.exitcode)
+
+        if failure:
+            raise failure
+
+    def _spawn(self, queue, name, execute):
+        payload = self.payloads[name]
+        def target():
+            try:
+                result = execute(payload)
+            except BaseException:
+                queue.put((name, False, traceback.format_exc()))
+            else:
+                queue.put((name, True, result))
+
+        if self.prepare:
+            self.prepare()
+
+        process = Process(target=target, name=name)
+        process.start()
+        return process
+
+    def _wait(self, queue):
+        try:
+            return queue.get(timeout=self.poll)
+        except Empty:
+            return None
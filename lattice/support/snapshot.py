@@ -0,0 +1,209 @@
+import cPickle
+import os
+import shutil
+import stat
+
+from bake import path
+
+from lattice.support.archive import ArchiveWriter
+from lattice.util import uniqpath
+
+class Changes(object):
+    """The files, links and directories added or changed in a tree between
+    two updates of a snapshot, as paths relative to the root of the tree.
+    Those which did not exist before are also listed in ``created``."""
+
+    def __init__(self, root):
+        self.root = root
+        self.created = []
+        self.directories = []
+        self.files = []
+        self.links = []
+
+    def __len__(self):
+        return len(self.directories) + len(self.files) + len(self.links)
+
+    @property
+    def names(self):
+        """The paths of all changes, sorted so that directories precede
+        their contents."""
+        return sorted(self.directories + self.files + self.links)
+
+    def revert(self):
+        """Removes the entries created between the two updates. Entries which
+        were changed rather than created cannot be restored, and are left."""
+        for name in sorted(self.created, reverse=True):
+            abspath = os.path.join(self.root, name)
+            if os.path.isdir(abspath) and not os.path.islink(abspath):
+                shutil.rmtree(abspath)
+            elif os.path.lexists(abspath):
+                os.unlink(abspath)
+
+    def report(self, filename):
+        with open(str(filename), 'w') as openfile:
+            for name in self.names:
+                openfile.write('/%s\n' % name)
+
+    def tar(self, filename, format=None):
+        with ArchiveWriter(filename, format) as writer:
+            for name in self.names:
+                writer.add(os.path.join(self.root, name), name)
+
+class Snapshot(object):
+    """An incremental snapshot of a directory tree, persisted to disk.
+
+    The index records the mtime and inode of every directory along with the
+    entries it contains. An update only lists the entries of directories
+    whose mtime has changed; in the others, which can have no new or removed
+    entries, it stat()s the files already indexed to catch those rewritten
+    in place, and descends into the subdirectories.
+    """
+
+    snapshots = {}
+
+    def __init__(self, root, indexpath=None):
+        self.root = path(root).abspath()
+        self.indexpath = path(indexpath or (self.root + '.snapshot'))
+        self.directories = None
+        self.signature = None
+
+    @classmethod
+    def open(cls, root, indexpath=None):
+        key = (os.getpid(), str(path(root).abspath()))
+        snapshot = cls.snapshots.get(key)
+        if not snapshot:
+            snapshot = cls.snapshots[key] = cls(root, indexpath)
+        return snapshot
+
+    def update(self):
+        """Brings the index up to date with the tree, returning the changes
+        made since the last update. The first update of a missing index
+        reports nothing."""
+        self._load()
+        initial = self.directories is None
+
+        changes = Changes(self.root)
+        directories = self.directories or {}
+        if os.path.isdir(self.root):
+            self._scan(directories, '', changes)
+        self.directories = directories
+
+        if initial:
+            changes = Changes(self.root)
+        if initial or changes:
+            self._save()
+        return changes
+
+    def _load(self):
+        signature = self._get_signature()
+        if signature is None:
+            self.directories = None
+        elif signature != self.signature:
+            with open(self.indexpath, 'rb') as openfile:
+                index = cPickle.load(openfile)
+            if index.get('root') == str(self.root):
+                self.directories = index['directories']
+            else:
+                self.directories = None
+        self.signature = signature
+
+    def _get_signature(self):
+        try:
+            status = os.stat(self.indexpath)
+        except OSError:
+            return None
+        return (status.st_ino, status.st_size, status.st_mtime)
+
+    def _save(self):
+        staging = uniqpath(self.indexpath.parent, '.tmp-')
+        with open(staging, 'wb') as openfile:
+            cPickle.dump({'root': str(self.root), 'directories': self.directories},
+                openfile, cPickle.HIGHEST_PROTOCOL)
+        os.rename(staging, self.indexpath)
+        self.signature = self._get_signature()
+
+    def _scan(self, directories, relpath, changes):
+        abspath = os.path.join(self.root, relpath)
+        try:
+            status = os.lstat(abspath)
+        except OSError:
+            self._forget(directories, relpath)
+            return
+
+        known = directories.get(relpath)
+        if known and known[0] == status.st_mtime and known[1] == status.st_ino:
+            if self._rescan_files(known[2], relpath, changes):
+                for name, entry in known[2].iteritems():
+                    if entry[0] == 'd':
+                        self._scan(directories, os.path.join(relpath, name), changes)
+                return
+
+        previous = known[2] if known else {}
+        entries = {}
+        for name in os.listdir(abspath):
+            child = os.path.join(relpath, name)
+            current = self._describe(os.path.join(abspath, name))
+            if current is None:
+                continue
+
+            entries[name] = current
+            entry = previous.get(name)
+            if not (entry and entry[0] == current[0]):
+                changes.created.append(child)
+            if current[0] == 'd':
+                if not (entry and entry[0] == 'd'):
+                    changes.directories.append(child)
+                self._scan(directories, child, changes)
+            elif current != entry:
+                self._record(changes, child, current)
+
+        for name, entry in previous.iteritems():
+            if entry[0] == 'd' and entries.get(name, ('',))[0] != 'd':
+                self._forget(directories, os.path.join(relpath, name))
+
+        directories[relpath] = (status.st_mtime, status.st_ino, entries)
+
+    def _rescan_files(self, entries, relpath, changes):
+        # an unchanged directory mtime rules out new and removed entries, but
+        # not files rewritten in place; if an indexed file is somehow gone or
+        # no longer a file, the directory is listed again instead
+        modified = {}
+        for name, entry in entries.iteritems():
+            if entry[0] == 'f':
+                current = self._describe(os.path.join(self.root, relpath, name))
+                if current != entry:
+                    if not (current and current[0] == 'f'):
+                        return False
+                    modified[name] = current
+
+        for name, current in modified.iteritems():
+            entries[name] = current
+            self._record(changes, os.path.join(relpath, name), current)
+        return True
+
+    def _describe(self, abspath):
+        try:
+            status = os.lstat(abspath)
+        except OSError:
+            return None
+
+        mode = status.st_mode
+        if stat.S_ISDIR(mode):
+            return ('d',)
+        elif stat.S_ISLNK(mode):
+            return ('l', os.readlink(abspath))
+        elif stat.S_ISREG(mode):
+            return ('f', status.st_ino, status.st_size, status.st_mtime, mode)
+
+    def _forget(self, directories, relpath):
+        known = directories.pop(relpath, None)
+        if known:
+            for name, entry in known[2].iteritems():
+                if entry[0] == 'd':
+                    self._forget(directories, os.path.join(relpath, name))
+
+    def _record(self, changes, relpath, current):
+        if current[0] == 'l':
+            changes.links.append(relpath)
+        else:
+            changes.files.append(relpath)
@@ -40,7 +40,7 @@ class Specification(object):
         return self.components.get(name)
 
     def parse(self, content, format='yaml'):
-        content = Schema.unserialize(content, format)
+        content = self.unserialize(content, format)
         for component in content.get('components', []):
             if 'version' in component:
                 component['version'] = VersionToken(component['version'])
@@ -52,6 +52,10 @@ class Specification(object):
 
         return self
 
+    @classmethod
+    def unserialize(cls, content, format='yaml'):
+        return Schema.unserialize(content, format)
+
     def read(self, filepath='.'):
         filepath = path(filepath).abspath()
         if filepath.isdir():
@@ -0,0 +1,50 @@
+import json
+import sqlite3
+
+class SpecificationIndex(object):
+    """A persistent index of the specifications declared at each tag of a
+    repository.
+
+    Tags are recorded with the object they point at and the sha of their
+    specification blob, so only new or moved tags need to be resolved on a
+    later scan; specification content is stored once per blob, so a blob
+    shared by many tags is only ever parsed once.
+    """
+
+    SCHEMA = [
+        'create table if not exists blob (sha text primary key, content text not null)',
+        'create table if not exists tag (repository text not null, tag text not null,'
+            ' object text not null, blob text, primary key (repository, tag))',
+    ]
+
+    def __init__(self, filepath):
+        self.connection = sqlite3.connect(str(filepath), timeout=60)
+        for statement in self.SCHEMA:
+            self.connection.execute(statement)
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def get_content(self, sha):
+        row = self.connection.execute('select content from blob where sha = ?', (sha,)).fetchone()
+        if row:
+            return json.loads(row[0])
+
+    def get_tags(self, repository):
+        """Returns a mapping of tag to ``(object, blob)`` for ``repository``."""
+        rows = self.connection.execute('select tag, object, blob from tag where repository = ?',
+            (repository,))
+        return dict((tag, (obj, blob)) for tag, obj, blob in rows)
+
+    def set_content(self, sha, content):
+        self.connection.execute('insert or replace into blob (sha, content) values (?, ?)',
+            (sha, json.dumps(content)))
+        self.connection.commit()
+
+    def set_tags(self, repository, tags):
+        with self.connection:
+            self.connection.execute('delete from tag where repository = ?', (repository,))
+            self.connection.executemany('insert into tag (repository, tag, object, blob)'
+                ' values (?, ?, ?, ?)', [(repository, tag, obj, blob)
+                for tag, (obj, blob) in tags.iteritems()])
@@ -0,0 +1,90 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+
+@contextmanager
+def untimed():
+    yield
+
+class Timings(object):
+    """Records wall and cpu time per phase per component, along with other
+    measurements such as bytes written and cache outcomes.
+
+    Cpu time is taken from ``os.times`` and so includes waited-for child
+    processes, which is where almost all of the work of a build happens.
+    """
+
+    def __init__(self):
+        self.components = {}
+
+    def add(self, component, phase, wall, cpu):
+        phases = self._get_component(component)['phases']
+        if phase in phases:
+            entry = phases[phase]
+            entry['wall'] += wall
+            entry['cpu'] += cpu
+            entry['count'] += 1
+        else:
+            phases[phase] = {'wall': wall, 'cpu': cpu, 'count': 1}
+
+    def add_bytes(self, component, count):
+        entry = self._get_component(component)
+        entry['bytes_written'] = entry.get('bytes_written', 0) + count
+
+    def dump(self, filename, order=None, **params):
+        """Writes the report as json to ``filename``, listing components in
+        ``order`` where given."""
+        names = list(order or [])
+        names.extend(sorted(name for name in self.components if name not in names))
+
+        report = dict(params)
+        report['components'] = []
+        for name in names:
+            if name in self.components:
+                entry = dict(self.components[name])
+                entry['name'] = name
+                report['components'].append(entry)
+
+        with open(str(filename), 'w') as openfile:
+            json.dump(report, openfile, indent=2, sort_keys=True)
+
+    def extract(self, component):
+        return self.components.pop(component, None)
+
+    def merge(self, component, entry):
+        if not entry:
+            return
+
+        for phase, values in entry.pop('phases', {}).iteritems():
+            target = self._get_component(component)['phases'].get(phase)
+            if target:
+                for key in ('wall', 'cpu', 'count'):
+                    target[key] += values[key]
+            else:
+                self._get_component(component)['phases'][phase] = values
+
+        if 'bytes_written' in entry:
+            self.add_bytes(component, entry.pop('bytes_written'))
+        self._get_component(component).update(entry)
+
+    @contextmanager
+    def phase(self, component, phase):
+        wall, cpu = time.time(), self._get_cpu_time()
+        try:
+            yield
+        finally:
+            self.add(component, phase, time.time() - wall, self._get_cpu_time() - cpu)
+
+    def record(self, component, key, value):
+        self._get_component(component)[key] = value
+
+    def _get_component(self, component):
+        entry = self.components.get(component)
+        if entry is None:
+            entry = self.components[component] = {'phases': {}}
+        return entry
+
+    def _get_cpu_time(self):
+        times = os.times()
+        return times[0] + times[1] + times[2] + times[3]
@@ -1,4 +1,6 @@
+import lattice.tasks.cache
 import lattice.tasks.component
 import lattice.tasks.profile
 import lattice.tasks.deb
 import lattice.tasks.rpm
+import lattice.tasks.repo
@@ -0,0 +1,45 @@
+from bake import *
+from scheme import *
+
+from lattice.support.cache import CacheManager, parse_size
+from lattice.support.filestore import locate_filestore
+
+class CollectCache(Task):
+    name = 'lattice.cache.gc'
+    description = 'evicts least recently used entries from the checkout, package and file caches'
+    parameters = {
+        'artifacts': Path(nonnull=True),
+        'cachedir': Path(nonnull=True),
+        'dry_run': Boolean(default=False),
+        'max_age': Integer(minimum=0),
+        'max_size': Text(nonnull=True),
+        'repodir': Path(nonnull=True),
+    }
+
+    def run(self, runtime):
+        filestore = None
+        if self['cachedir']:
+            filestore = locate_filestore(self['cachedir'])
+
+        manager = CacheManager(self['repodir'], self['cachedir'], filestore, self['artifacts'])
+        if not manager.roots:
+            raise TaskError('no cache directories were specified')
+
+        try:
+            max_size = parse_size(self['max_size'])
+        except ValueError:
+            raise TaskError('invalid cache size %r' % self['max_size'])
+
+        max_age = self['max_age']
+        if max_age is not None:
+            max_age *= 86400
+        if max_size is None and max_age is None:
+            raise TaskError('either max_size or max_age must be specified')
+
+        evicted = manager.collect(max_size, max_age, self['dry_run'])
+        action = ('evicting' if self['dry_run'] else 'evicted')
+        for entry in evicted:
+            runtime.report('%s %s (%d bytes)' % (action, entry.path, entry.size))
+
+        runtime.report('%s %d entries, %d bytes' % (action, len(evicted),
+            sum(entry.size for entry in evicted)))
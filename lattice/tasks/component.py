@@ -1,11 +1,58 @@
 import tarfile
 from os import getenv
 from bake import *
-from bake.filesystem import Collation
 from scheme import *
+from lattice.support.archive import ArchiveError, extract_archive, get_extension, resolve_format
+from lattice.support.cache import leasing
+from lattice.support.filestore import FileStore, locate_filestore
 from lattice.support.repository import Repository
+from lattice.support.rpmfile import RpmPackage
+from lattice.support.snapshot import Snapshot
 from lattice.support.specification import Specification
-from lattice.util import uniqpath
+from lattice.support.timing import untimed
+from lattice.util import merge_tree, uniqpath
+
+def is_forced(component):
+    forced = getenv('FORCE_COMPONENTS')
+    return bool(forced and (component['name'] in forced))
+
+def filter_commits(commits, ignore=None):
+    """Removes the commits by authors in ``ignore`` from the log ``commits``,
+    returning ``None`` when nothing is left."""
+    if commits and ignore:
+        culled = str()
+        block = True
+        for part in commits.split('\n'):
+            if part.lower().startswith('author'):
+                author = part.split(' ')[1]
+                if author not in ignore:
+                    block = False
+                else:
+                    block = True
+            if block:
+                continue
+            else:
+                culled += '%s\n' % part
+        commits = culled
+    return commits or None
+
+def must_build(component, built):
+    if component.get('must-build'):
+        return True
+    elif not built and not component.get('volatile', False):
+        return False
+
+    required = []
+    if 'dependencies' in component:
+        required.extend(component['dependencies'])
+    if 'ephemeral-dependencies' in component:
+        required.extend(component['ephemeral-dependencies'])
+    if not required:
+        return False
+
+    for dependency in required:
+        if dependency in built:
+            return True
 
 class ComponentTask(Task):
     parameters = {
@@ -15,6 +62,7 @@ class ComponentTask(Task):
         'specification': Field(hidden=True),
         'target': Text(nonnull=True, default='default'),
         'timestamp': Field(hidden=True),
+        'timings': Field(hidden=True),
     }
 
     @property
@@ -48,6 +96,22 @@ class ComponentTask(Task):
         environ['BUILDPATH'] = self['path']
         return environ
 
+    def _record_timing(self, key, value):
+        timings = self['timings']
+        if timings:
+            timings.record(self['name'], key, value)
+
+    def _record_written(self, filepath):
+        timings = self['timings']
+        if timings and filepath.exists():
+            timings.add_bytes(self['name'], filepath.getsize())
+
+    def _timed(self, phase):
+        timings = self['timings']
+        if timings:
+            return timings.phase(self['name'], phase)
+        return untimed()
+
 class ComponentAssembler(object):
     def build(self, runtime, name, path, target, environ, component, manifest):
         pass
@@ -58,6 +122,9 @@ class ComponentAssembler(object):
     def get_rev_count(self, component):
         raise NotImplementedError()
 
+    def get_source_hash(self, component):
+        return None
+
     def populate_commit_log(self, commit_log, component, starting_commit, runtime):
         pass
 
@@ -86,30 +153,15 @@ class StandardAssembler(ComponentAssembler):
             return
         return self.repository.get_rev_count()
 
+    def get_source_hash(self, component):
+        return self.repository.get_current_hash()
+
     def populate_commit_log(self, commit_log, component, starting_commit, runtime):
         heading = '%(name)s %(version)s' % component
         metadata = component['repository']
         commit_log.append('%s\n%s\n' % (heading, '-' * len(heading)))
-        commits = self.repository.get_commit_log(starting_commit)
-        if commits:
-            if metadata.has_key('ignore'):
-                ignore = metadata.get('ignore')
-                culled = str()
-                block = True
-                for part in commits.split('\n'):
-                    if part.lower().startswith('author'):
-                        author = part.split(' ')[1]
-                        if author not in ignore:
-                            block = False
-                        else:
-                            block = True
-                    if block:
-                        continue
-                    else:
-                        culled += '%s\n' % part
-                commits = culled
-            if commits == '':
-                commits = None
+        commits = filter_commits(self.repository.get_commit_log(starting_commit),
+            metadata.get('ignore'))
         if commits:
             runtime.report('commits: %s' % commits)
             commit_log.append(commits)
@@ -160,15 +212,23 @@ class AssembleComponent(ComponentTask):
     name = 'lattice.component.assemble'
     description = 'assembles a lattice-based component'
     parameters = {
+        'archive_format': Text(nonnull=True),
+        'artifacts': Field(hidden=True),
         'assembler': Field(hidden=True),
+        'buildcache': Field(hidden=True),
         'buildfile': Field(hidden=True),
+        'buildlock': Field(hidden=True),
         'built': Field(hidden=True),
+        'cache_keys': Field(hidden=True),
         'cachedir': Path(nonnull=True),
         'commit_log': Field(hidden=True),
         'distpath': Path(nonnull=True),
         'assemblydir': Field(hidden=True),
+        'filestore': Boolean(default=False),
         'manifest': Field(hidden=True),
         'package_checksums': Field(hidden=True),
+        'packages': Field(hidden=True),
+        'packaging': Field(hidden=True),
         'post_tasks': Sequence(Text(nonnull=True)),
         'repodir': Path(nonnull=True),
         'revision': Text(nonnull=True),
@@ -181,6 +241,12 @@ class AssembleComponent(ComponentTask):
     }
 
     def run(self, runtime):
+        # the cache entries checked out for the component are only leased
+        # until it has been assembled
+        with leasing():
+            self._assemble(runtime)
+
+    def _assemble(self, runtime):
         assembler = self['assembler']
         if not assembler:
             assembler = StandardAssembler()
@@ -197,12 +263,14 @@ class AssembleComponent(ComponentTask):
             environ = self.environ
             environ['ASSEMBLYDIR'] = self['assemblydir']
        
-        curdir = assembler.prepare_source(runtime, component, self['repodir'])
+        with self._timed('checkout'):
+            curdir = assembler.prepare_source(runtime, component, self['repodir'])
         if curdir:
             curdir = runtime.chdir(curdir)
 
         if component['version'] == 'HEAD':
-            component['version'] = assembler.get_version(component)
+            with self._timed('version'):
+                component['version'] = assembler.get_version(component)
         #elif 'p' in component['version']:
         #    splitchars = 'p'
         #    if 'pre' in component['version']: # doing this for npyscreen which has unique format
@@ -218,12 +286,15 @@ class AssembleComponent(ComponentTask):
         commit_log = self['commit_log']
 
         if commit_log is not None:
-            has_commits = assembler.populate_commit_log(commit_log, component,
-                self['starting_commit'], runtime, )
+            with self._timed('commit_log'):
+                has_commits = assembler.populate_commit_log(commit_log, component,
+                    self['starting_commit'], runtime, )
         else:
             has_commits = True
         runtime.report('has_commits: %s' % has_commits)
 
+        cache_key = self._compute_cache_key(assembler, component)
+
         built = self['built']
         if component.get('ephemeral') and not component.get('builds'):
             if (built != None) and has_commits:
@@ -232,11 +303,13 @@ class AssembleComponent(ComponentTask):
                 runtime.chdir(curdir)
             return
         building = self._must_build(component, built)
-        if has_commits or (getenv("FORCE_COMPONENTS") and (component['name'] in getenv("FORCE_COMPONENTS"))):
+        if has_commits or is_forced(component):
             building = True
         # re-use existing rpm.. explode package into BUILDPATH, update manifest with last_manifest values
         if (last_package_hash and last_package_hash != 'missing') and not (has_commits or building):
-            self._extract_rpm(last_package_hash)
+            self._record_timing('outcome', 'reused')
+            with self._timed('rpm_extract'):
+                self._extract_rpm(last_package_hash)
             if manifest is not None:
                 params=[manifest, component]
                 if last_package_hash is not None:
@@ -259,43 +332,144 @@ class AssembleComponent(ComponentTask):
         elif not component.get('ephemeral'):
             #cachedir.makedirs_p()
             self['tarfile'] = True
-            #building = self._check_cachedir(cachedir, component, distpath)
             building = True
 
+        if cache_key:
+            self['tarfile'] = True
+
+        # the members of the tarball, when known without reading it again
+        self.members = None
+
         tarpath = distpath / self._get_component_tarfile(component)
         reportpath = distpath / self._get_component_reportfile(component)
         if building:
-            self._run_build(runtime, assembler, component, tarpath, reportpath, manifest)
+            if cache_key and self._restore_cached_build(runtime, cache_key, tarpath):
+                self._record_timing('outcome', 'cached')
+            else:
+                self._record_timing('outcome', 'built')
+                self._run_build(runtime, assembler, component, tarpath, reportpath, manifest)
+                if cache_key and tarpath.exists():
+                    self['buildcache'].store(cache_key, tarpath)
             if built != None:
                 built.append(component['name'])
+        else:
+            self._record_timing('outcome', 'skipped')
 
         if self['post_tasks']: # "packaging" post tasks...
             timestamp = self['timestamp']
+            packaging = self['packaging']
             for post_task in self['post_tasks']:
-                runtime.execute(post_task, environ=self['environ'], assembler=assembler, name=self['name'],
+                params = dict(environ=self['environ'], assembler=assembler, name=self['name'],
                     path=self['path'], distpath=distpath, specification=component,
-                    target=self['target'], cachedir=cachedir, timestamp=timestamp, manifest=manifest)
+                    target=self['target'], cachedir=cachedir, timestamp=timestamp, manifest=manifest,
+                    artifacts=self['artifacts'], timings=self['timings'], members=self.members,
+                    packages=self['packages'])
+                if packaging:
+                    packaging.submit(component['name'],
+                        self._create_packaging_job(runtime, post_task, params))
+                else:
+                    runtime.execute(post_task, **params)
 
         if curdir:
             runtime.chdir(curdir)
         #if cachedir and not (component.get('nocache', False) or component.get('ephemeral')):
         #    tarpath.copy2(cachedir)
+        artifacts = self['artifacts']
+        if artifacts and building and tarpath.exists():
+            if not (component.get('nocache', False) or component.get('ephemeral')):
+                artifacts.put_async(tarpath.basename(), tarpath)
+
+    def _compute_cache_key(self, assembler, component):
+        buildcache = self['buildcache']
+        if not buildcache:
+            return
 
-    def _check_cachedir(self, cachedir, component, distpath):
-        cached = cachedir / self._get_component_tarfile(component)
-        if cached.exists():
-            cached.copy2(distpath)
-        else:
-            return True
+        source_hash = assembler.get_source_hash(component)
+        if not source_hash:
+            return
+
+        cache_keys = self['cache_keys']
+        if cache_keys is None:
+            cache_keys = {}
 
-        openfile = tarfile.open(cached, 'r')
+        if component.get('nocache') or component.get('ephemeral'):
+            # components which are never cached are still identified by their
+            # source revision, so that their dependents can be
+            cache_keys[component['name']] = 'source:%s' % source_hash
+            return
+
+        dependencies = {}
+        for key in ('dependencies', 'ephemeral-dependencies'):
+            for dependency in component.get(key) or []:
+                dependencies[dependency] = cache_keys.get(dependency)
+                if dependencies[dependency] is None:
+                    # without an identity for the dependency, a cached build
+                    # could have been made against a different version of it
+                    return
+
+        build = (component.get('builds') or {}).get(self['target'])
+        cache_key = buildcache.compute_key(component['name'], source_hash, build,
+            self.environ, dependencies)
+
+        cache_keys[component['name']] = cache_key
+        return cache_key
+
+    def _restore_cached_build(self, runtime, cache_key, tarpath):
+        with self._timed('cache_restore'):
+            if not self['buildcache'].restore(cache_key, tarpath):
+                runtime.report('build cache miss for %s' % cache_key)
+                self._record_timing('cache', 'miss')
+                return False
+
+            runtime.report('restoring build from cache entry %s' % cache_key)
+            self._record_timing('cache', 'hit')
+
+            filestore = self._get_filestore()
+            if filestore:
+                self.members = self._materialize(filestore, cache_key, self['path'],
+                    lambda staging: extract_archive(tarpath, staging, True))
+                return True
+
+            lock = self._lock_buildpath()
+            try:
+                self.members = extract_archive(tarpath, self['path'], True)
+            finally:
+                if lock:
+                    lock.release()
+        return True
+
+    def _create_packaging_job(self, runtime, post_task, params):
+        name = params['specification']['name']
+        def package():
+            # runs in a forked packaging worker, so the manifest entry and
+            # timings it produces are handed back rather than shared
+            timings = params['timings']
+            if timings:
+                timings.extract(name)
+
+            runtime.execute(post_task, **params)
+            if params['artifacts']:
+                params['artifacts'].wait()
+
+            result = {}
+            if params['manifest'] is not None:
+                entries = [entry for entry in params['manifest'] if entry['name'] == name]
+                if entries:
+                    result['manifest'] = entries[-1]
+            if timings:
+                result['timings'] = timings.extract(name)
+            return result
+        return package
+
+    def _get_archive_format(self):
         try:
-            openfile.extractall(str(self['path']))
-        finally:
-            openfile.close()
+            return resolve_format(self['archive_format'])
+        except ArchiveError, exception:
+            raise TaskError(str(exception))
 
     def _get_component_tarfile(self, component):
-        return '%(name)s-%(version)s.tar.bz2' % component
+        extension = get_extension(self._get_archive_format())
+        return '%(name)s-%(version)s' % component + extension
 
     def _get_component_reportfile(self, component):
         return '%(name)s-%(version)s_collation-report.txt' % component
@@ -321,45 +495,113 @@ class AssembleComponent(ComponentTask):
             raise TaskError('repository not specified')
 
     def _must_build(self, component, built):
-        if component.get('must-build'):
-            return True
-        elif not built and not component.get('volatile', False):
-            return False
+        return must_build(component, built)
 
-        required = []
-        if 'dependencies' in component:
-            required.extend(component['dependencies'])
-        if 'ephemeral-dependencies' in component:
-            required.extend(component['ephemeral-dependencies'])
-        if not required:
-            return False
-
-        for dependency in required:
-            if dependency in built:
-                return True
+    def _lock_buildpath(self):
+        # when components are assembled concurrently, anything that modifies
+        # BUILDPATH must be serialized so that each build sees a consistent tree
+        lock = self['buildlock']
+        if lock:
+            lock.acquire()
+        return lock
 
     def _run_build(self, runtime, assembler, component, tarpath, reportpath, manifest):
         path = self['path']
         environ = self.environ
 
-        original = Collation(path)
-        assembler.build(runtime, self['name'], path, self['target'], environ, component, manifest)
-        #self._prune_pycpyo()
-        now = Collation(path).prune(original)
+        # when components are assembled concurrently, builds still run in
+        # BUILDPATH itself, one at a time, so that paths into it embedded in
+        # their output are the same as in a serial build; the lock is held
+        # until the output is collated, so that the snapshot and the tarball
+        # only capture this build's files, as they were when it finished
+        lock = self._lock_buildpath()
+        try:
+            # the snapshot index persists between components, so only what
+            # changed since the previous update is scanned
+            snapshot = Snapshot.open(path)
+            with self._timed('collation'):
+                snapshot.update()
+            with self._timed('build'):
+                assembler.build(runtime, self['name'], path, self['target'], environ, component,
+                    manifest)
+            #self._prune_pycpyo()
+            with self._timed('collation'):
+                now = snapshot.update()
+
+            self._collate(now, tarpath, reportpath)
+        finally:
+            if lock:
+                lock.release()
+
+    def _collate(self, now, tarpath, reportpath):
         if self['tarfile']:
-            now.tar(str(tarpath), {environ['BUILDPATH']: ''})
+            with self._timed('compression'):
+                now.tar(tarpath, self._get_archive_format())
+            self._record_written(tarpath)
+            self.members = now.names
 
         if self['reportfile']:
-            now.report(str(reportpath), {environ['BUILDPATH']: ''})
+            now.report(reportpath)
 
     def _extract_rpm(self, package_hash):
         environ = self.environ
-        runtime = self.runtime
-        curdir = runtime.curdir
-        root = self.runtime.chdir(environ['BUILDPATH'])
-        shellargs = ['bash', '-c', 'rpm2cpio %s/%s |cpio -idmv' % (environ['STOREPATH'], package_hash)]
-        runtime.shell(shellargs, merge_output=True)
-        runtime.chdir(curdir)
+        buildpath = path(environ['BUILDPATH'])
+
+        packagepath = None
+        if self['packages']:
+            packagepath = self['packages'].locate(package_hash)
+        package = RpmPackage(packagepath or (path(environ['STOREPATH']) / package_hash))
+
+        filestore = self._get_filestore()
+        if filestore:
+            members = self._materialize(filestore, package_hash, buildpath, package.extract, True)
+            self.runtime.report('materialized %d entries of %s' % (len(members), package_hash))
+            return
+
+        # packages are unpacked next to BUILDPATH without holding the lock,
+        # so that reused components unpack concurrently; only moving the
+        # files into BUILDPATH is serialized
+        staging = uniqpath(buildpath.parent, '.rpm-')
+        try:
+            members = package.extract(staging)
+            lock = self._lock_buildpath()
+            try:
+                merge_tree(staging, buildpath)
+            finally:
+                if lock:
+                    lock.release()
+        finally:
+            if staging.exists():
+                staging.rmtree()
+        self.runtime.report('extracted %d entries from %s' % (len(members), package_hash))
+
+    def _get_filestore(self):
+        if self['filestore'] and self['cachedir']:
+            return FileStore(locate_filestore(self['cachedir']))
+
+    def _materialize(self, filestore, key, target, unpack, keep_newer=False):
+        """Materializes the cached output ``key`` into ``target`` from the
+        file store, first calling ``unpack`` with a staging directory to add
+        it to the store if needed. Returns the members of the output."""
+        for attempt in range(2):
+            if not filestore.contains(key):
+                staging = uniqpath(path(target).parent, '.unpack-')
+                try:
+                    filestore.ingest(key, staging, unpack(staging))
+                finally:
+                    if staging.exists():
+                        staging.rmtree()
+
+            lock = self._lock_buildpath()
+            try:
+                members = filestore.materialize(key, target, keep_newer)
+            finally:
+                if lock:
+                    lock.release()
+            if members is not None:
+                return members
+
+        raise TaskError('cannot materialize %s from the file store' % key)
 
     def _prune_pycpyo(self):
         environ = self.environ
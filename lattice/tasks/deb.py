@@ -2,6 +2,10 @@ from bake import *
 from bake.util import get_package_data
 from scheme import *
 
+from lattice.support.archive import extract_archive, find_archive
+from lattice.support.cache import lease, leasing
+from lattice.support.debfile import DebError, DebWriter
+from lattice.support.repoindex import RepositoryIndex
 from lattice.tasks.component import ComponentTask
 from lattice.util import interpolate_env_vars
 
@@ -9,8 +13,10 @@ class BuildDeb(ComponentTask):
     name = 'lattice.deb.build'
     description = 'builds a deb file of a built component'
     parameters = {
+        'artifacts': Field(hidden=True),
         'cachedir': Path(nonnull=True),
         'distpath': Path(nonempty=True),
+        'native': Boolean(default=False),
         'prefix': Text(nonnull=True),
     }
 
@@ -27,7 +33,9 @@ class BuildDeb(ComponentTask):
 
         name = component['name']
         version = component['version']
-        self.tgzname = '%s-%s.tar.bz2' % (name, version)
+        self.tgzpath = find_archive(self['distpath'], '%s-%s' % (name, version))
+        if not self.tgzpath:
+            raise TaskError('cannot find the built archive of %s-%s' % (name, version))
 
         prefix = self['prefix']
         if prefix:
@@ -40,12 +48,6 @@ class BuildDeb(ComponentTask):
 
         self.pkgname = '%s-%s.deb' % (name, version)
 
-        self.workpath = runtime.curdir / ('build_%s_deb' % name)
-        self.workpath.makedirs_p()
-
-        controldir = self.workpath / 'DEBIAN'
-        controldir.mkdir_p()
-
         dependencies = component.get('dependencies')
         if dependencies:
             if prefix:
@@ -60,14 +62,13 @@ class BuildDeb(ComponentTask):
             'component_maintainer_email': 'acolichia@storediq.com',
             'component_depends': dependencies or '',
             'component_description': 'Package generated by lattice.deb.build'}
-        
-        path('%s/control' % str(controldir)).write_bytes(controlfile)
 
         try:
             build = self.build
         except TaskError:
             build = {}
 
+        scripts = {}
         for file_token, script_token, script_name in self.SCRIPTS:
             script = None
             if file_token in build:
@@ -77,25 +78,64 @@ class BuildDeb(ComponentTask):
             elif script_token in build:
                 script = build[script_token]
             if script:
-                script = interpolate_env_vars(script, environ)
-                scriptfile = controldir / script_name
-                scriptfile.write_bytes(script)
-                scriptfile.chmod(0755)
+                scripts[script_name] = interpolate_env_vars(script, environ)
+
+        if self['native']:
+            self._write_deb(runtime, controlfile, scripts)
+            return
+
+        self.workpath = runtime.curdir / ('build_%s_deb' % name)
+        self.workpath.makedirs_p()
+
+        controldir = self.workpath / 'DEBIAN'
+        controldir.mkdir_p()
+
+        path('%s/control' % str(controldir)).write_bytes(controlfile)
+        for script_name, script in scripts.iteritems():
+            scriptfile = controldir / script_name
+            scriptfile.write_bytes(script)
+            scriptfile.chmod(0755)
 
         curdir = runtime.chdir(self.workpath)
-        self._run_tar(runtime)
+        with self._timed('deb_unpack'):
+            self._run_tar(runtime)
 
         runtime.chdir(curdir)
         self._run_dpkg(runtime)
 
     def _run_tar(self, runtime):
-        shellargs = ['tar', '-xjf', str(self['distpath'] / self.tgzname)]
-        runtime.shell(shellargs, merge_output=True)
+        extract_archive(self.tgzpath, runtime.curdir)
 
     def _run_dpkg(self, runtime):
         pkgpath = self['distpath'] / self.pkgname
-        runtime.shell(['fakeroot', 'dpkg', '-b', str(self.workpath), str(pkgpath)], merge_output=True)
+        with self._timed('dpkg'):
+            runtime.shell(['fakeroot', 'dpkg', '-b', str(self.workpath), str(pkgpath)], merge_output=True)
+        self._publish(pkgpath)
+
+    def _write_deb(self, runtime, controlfile, scripts):
+        pkgpath = self['distpath'] / self.pkgname
+        with self._timed('deb_write'):
+            try:
+                DebWriter(pkgpath).write(controlfile, scripts, self.tgzpath)
+            except DebError, exception:
+                raise TaskError(str(exception))
+        self._publish(pkgpath)
+
+    def _publish(self, pkgpath):
+        self._record_written(pkgpath)
+
+        index = RepositoryIndex.open(self['distpath'])
+        if index:
+            index.record(pkgpath)
+            index.close()
 
         cachedir = self['cachedir']
         if cachedir:
-            pkgpath.copy2(cachedir)
+            # leased while it is copied, so that it is not evicted half written
+            with leasing():
+                lease(cachedir / pkgpath.basename())
+                pkgpath.copy2(cachedir)
+
+        artifacts = self['artifacts']
+        if artifacts:
+            artifacts.put_async(pkgpath.basename(), pkgpath)
@@ -1,10 +1,25 @@
+import json
+import os
 from datetime import datetime
+from multiprocessing import Lock
+from multiprocessing.pool import ThreadPool
 from os import getenv
 from bake import *
 from scheme import *
 
+from lattice.support.archive import ArchiveError, find_archive, resolve_format
+from lattice.support.artifacts import ArtifactStore
+from lattice.support.buildcache import BuildCache
 from lattice.support.buildfile import BuildFile
-from lattice.tasks.component import ComponentAssembler
+from lattice.support.journal import BuildJournal, JournalMismatch, stamp_artifacts, verify_artifacts
+from lattice.support.packageindex import PackageIndex
+from lattice.support.pipeline import PackagingPipeline
+from lattice.support.prefetch import SourcePrefetcher
+from lattice.support.repository import Repository
+from lattice.support.scheduler import DependencyScheduler, JobFailed
+from lattice.support.snapshot import Snapshot
+from lattice.support.timing import Timings, untimed
+from lattice.tasks.component import ComponentAssembler, filter_commits, is_forced, must_build
 
 class AssembleProfile(Task):
     name = 'lattice.profile.assemble'
@@ -15,31 +30,31 @@ class AssembleProfile(Task):
 
     }
 
-class BuildProfile(Task):
-    name = 'lattice.profile.build'
-    description = 'builds a lattice profile'
+class ProfileTask(Task):
     parameters = {
-        'cachedir': Path(nonnull=True),
         'buildfile': Path(),
-        'build_manifest_component': Boolean(default=False),
-        'distpath': Path(nonnull=True),
+        'cachedir': Path(nonnull=True),
         'dump_commit_log': Text(),
-        'dump_manifest': Text(),
         'environ': Map(Text(nonnull=True)),
-        'last_manifest': Text(),
-        'pkg_names': Text(),
         'existing_package_hashes': Text(),
+        'last_manifest': Text(),
         'override_version': Text(),
-        'overwrite_existing': Boolean(default=False),
-        'path': Text(nonempty=True),
-        'post_tasks': Sequence(Text(nonnull=True), nonnull=True),
         'profile': Path(nonnull=True),
         'repodir': Path(nonnull=True),
         'specification': Field(hidden=True),
         'target': Text(nonnull=True, default='default'),
     }
 
-    def run(self, runtime):
+    def _existing_package(self, runtime, package_hash):
+        if not package_hash:
+            return
+
+        existing = self.packages.contains(package_hash)
+        if existing is None:
+            return
+        return package_hash if existing else 'missing'
+
+    def _load_profile(self):
         profile = self['specification']
         if not profile:
             if self['profile']:
@@ -51,73 +66,432 @@ class BuildProfile(Task):
             else:
                 raise TaskError('nope')
 
+        if self['override_version']:
+            profile['version'] = self['override_version']
+        return profile
+
+    def _open_package_index(self):
+        indexpath = None
+        cachedir = self['cachedir']
+        if cachedir:
+            cachedir = path(cachedir).abspath()
+            indexpath = cachedir.parent / ('%s-packages.db' % cachedir.basename())
+
+        environ = self['environ'] or {}
+        return PackageIndex(indexpath, environ.get('STOREPATH'), self['existing_package_hashes'])
+
+    def _parse_last_manifest(self, field='hash'):
+        filename = self['last_manifest']
+        if not filename:
+            return {}
+
+        filename = path(filename)
+        if not filename.exists():
+            return {}
+
+        if field != 'hash':
+            exec('%s=None' % field)
+
+        last_manifest = {}
+        for line in filename.bytes().strip().split('\n'):
+            parts = line.split(':')
+            if len(parts) < 2:
+                continue
+            name = parts[0]
+            version = parts[1]
+            hash = parts[2]
+            if len(parts) > 3:
+                package_hash = parts[3]
+            else:
+                package_hash = None
+            if len(parts) > 4:
+                package_file = parts[4]
+            else:
+                package_file = None
+
+            last_manifest[name] = eval(field)
+        return last_manifest
+
+class BuildProfile(ProfileTask):
+    name = 'lattice.profile.build'
+    description = 'builds a lattice profile'
+    parameters = {
+        'archive_format': Text(nonnull=True),
+        'artifact_jobs': Integer(default=4),
+        'artifacts': Text(nonnull=True),
+        'buildcache': Text(nonnull=True),
+        'build_manifest_component': Boolean(default=False),
+        'distpath': Path(nonnull=True),
+        'dump_manifest': Text(),
+        'dump_timings': Text(),
+        'filestore': Boolean(default=False),
+        'pkg_names': Text(),
+        'git_mirror': Boolean(default=False),
+        'jobs': Integer(default=1),
+        'journal': Text(),
+        'overwrite_existing': Boolean(default=False),
+        'packaging_jobs': Integer(default=0),
+        'path': Text(nonempty=True),
+        'post_tasks': Sequence(Text(nonnull=True), nonnull=True),
+        'prefetch': Integer(default=0),
+        'resume': Boolean(default=False),
+    }
+
+    JOURNAL_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+    def run(self, runtime):
+        profile = self._load_profile()
+
         self.environ = self['environ']
         for key in self.environ.keys():
             if 'str(' in self.environ[key]:
                 sval = self.environ[key].lstrip('str(').rstrip(')')
                 self.environ[key] = sval
 
-        if self['override_version']:
-            profile['version'] = self['override_version']
+        # an archive format which cannot be written fails the build up front,
+        # rather than once the first component has been built
+        try:
+            resolve_format(self['archive_format'])
+        except ArchiveError, exception:
+            raise TaskError(str(exception))
 
         buildpath = path(self['path'])
         if buildpath.exists():
-            if not self['overwrite_existing']:
+            if not (self['overwrite_existing'] or self['resume']):
                 raise TaskError('buildpath already exists, aborting')
         else:
             buildpath.mkdir()
 
-        buildfile = None
+        self.buildfile = None
         if self['buildfile']:
-            buildfile = BuildFile(self['buildfile'])
-
-        timestamp = datetime.utcnow()
-        last_manifest = self._parse_last_manifest()
-        last_package_names = self._parse_last_manifest('package_file')
-        last_package_hashes = self._parse_last_manifest('package_hash')
-
+            self.buildfile = BuildFile(self['buildfile'])
+
+        self.timestamp = datetime.utcnow()
+        self.last_manifest = self._parse_last_manifest()
+        self.last_package_names = self._parse_last_manifest('package_file')
+        self.last_package_hashes = self._parse_last_manifest('package_hash')
+        self.packages = self._open_package_index()
+        backfilled = self.packages.backfill()
+        if backfilled:
+            runtime.report('indexed %d packages found in the package store' % backfilled)
+
+        self.artifacts = None
+        if self['artifacts']:
+            self.artifacts = ArtifactStore.instantiate(self['artifacts'], jobs=self['artifact_jobs'])
+
+        self.buildcache = None
+        if self['buildcache']:
+            self.buildcache = BuildCache(ArtifactStore.instantiate(self['buildcache'],
+                jobs=self['artifact_jobs']))
+
+        self.timings = None
+        if self['dump_timings']:
+            self.timings = Timings()
+
+        self.buildlock = None
+        self.built = []
+        self.cache_keys = {}
+        self.results = {}
+        self.artifact_statistics = {}
+
+        components = [c for c in profile['components'] if not c.get('disabled')]
+        self.order = [c['name'] for c in components]
+
+        if self['git_mirror']:
+            for component in components:
+                metadata = component.get('repository')
+                if metadata and metadata.get('type') == 'git':
+                    metadata.setdefault('mirror', True)
+
+        self.journal = BuildJournal(self['journal'] or (runtime.curdir / 'lattice-journal.json'))
+        components = self._open_journal(runtime, profile, components)
+
+        self.prefetcher = None
+        if self['prefetch'] and self['repodir']:
+            runtime.report('prefetching sources with %d workers' % self['prefetch'])
+            self.prefetcher = SourcePrefetcher(self['repodir'], self['prefetch'])
+            self.prefetcher.start(components)
+        self._prefetch_packages(runtime, components)
+
+        # parallel builds already package in their workers
+        self.packaging = None
+        self.packaged = {}
+        if self['packaging_jobs'] and self['jobs'] <= 1:
+            # as with build workers, packaging workers are forked once pending
+            # uploads have drained
+            self.packaging = PackagingPipeline(self['packaging_jobs'],
+                prepare=self._wait_for_transfers)
+
+        try:
+            if self['jobs'] > 1:
+                self._build_parallel(runtime, components)
+            else:
+                self._build_serial(runtime, components)
+        finally:
+            if self.prefetcher:
+                self.prefetcher.close()
+            if self.packaging:
+                self.packaging.close()
+            self._wait_for_transfers()
+
+        manifest = self._collect_manifest()
+        if self.buildfile:
+            self.buildfile.write()
+        if self['build_manifest_component'] and (self.built or getenv("FORCECHANNEL")):
+            self._build_manifest(runtime, profile, self.timestamp, manifest)
+        if self['dump_commit_log']:
+            self._dump_commit_log(self._collect_commit_log(), self['dump_commit_log'])
+        if self['dump_manifest']:
+            self._dump_manifest(manifest, self['dump_manifest'])
+        artifact_statistics = self._collect_artifact_statistics(runtime)
+        if self.timings:
+            self.timings.dump(self['dump_timings'], self.order, profile=profile.get('name'),
+                target=self['target'], jobs=self['jobs'], started=self.timestamp.isoformat(),
+                wall=(datetime.utcnow() - self.timestamp).total_seconds(),
+                artifacts=artifact_statistics)
+
+    def _assemble_component(self, runtime, component):
+        name = component['name']
+        starting_commit = self.last_manifest.get(name)
+        last_package_hash = None
+        last_pkgname = None
+        if not component.get('ephemeral'):
+            last_package_hash = self._existing_package(runtime, self.last_package_hashes.get(name))
+            if self.last_package_names is not None:
+                last_pkgname = self.last_package_names.get(name)
+
+        built = list(self.built)
+        manifest = self._collect_manifest()
         commit_log = None
         if self['dump_commit_log']:
             commit_log = []
 
-        manifest = None
+        oldtarget = None
+        target = self['target']
+        if (('builds' in component) and (target not in component['builds'])):
+            oldtarget = self['target']
+            self['target'] = 'default'
+        with self._timed(name, 'total'):
+            self._build_component(runtime, component, built, self.timestamp, manifest,
+                commit_log, starting_commit, last_package_hash, last_pkgname, self.buildfile)
+        if oldtarget:
+            self['target'] = oldtarget
+
+        result = {'name': name, 'built': name in built, 'commit_log': commit_log,
+            'cache_key': self.cache_keys.get(name)}
+        if manifest is not None:
+            entries = [entry for entry in manifest if entry['name'] == name]
+            if entries:
+                result['manifest'] = entries[-1]
+        if self.buildfile:
+            result['buildfile'] = self.buildfile.get(name)
+
+        result['version'] = str(component['version'])
+        result['artifacts'] = self._find_artifacts(runtime, component, result.get('manifest'))
+        return result
+
+    def _open_journal(self, runtime, profile, components):
+        header = {'profile': profile.get('name'), 'version': str(profile.get('version')),
+            'target': self['target'], 'components': self.order}
+
+        if self['resume']:
+            try:
+                recorded, results = self.journal.load(header)
+            except JournalMismatch, exception:
+                raise TaskError(str(exception))
+
+            if recorded:
+                self.timestamp = datetime.strptime(recorded['timestamp'],
+                    self.JOURNAL_TIMESTAMP_FORMAT)
+                for name in self.order:
+                    if name in results and not self._verify_result(results[name]):
+                        runtime.report('rebuilding %s, since its artifacts have changed' % name)
+                        results.pop(name)
+                    elif name in results:
+                        self._merge_result(results[name], False)
+
+                self._revert_interrupted(runtime)
+
+                remaining = [c for c in components if c['name'] not in results]
+                runtime.report('resuming build, %d of %d components already completed'
+                    % (len(components) - len(remaining), len(components)))
+                return remaining
+
+        header['timestamp'] = self.timestamp.strftime(self.JOURNAL_TIMESTAMP_FORMAT)
+        self.journal.start(header)
+        self._checkpoint()
+        return components
+
+    def _checkpoint(self):
+        # the snapshot of BUILDPATH is brought up to date as each component is
+        # journaled, so that a resumed build can tell what was written since
+        lock = self.buildlock
+        if lock:
+            lock.acquire()
+        try:
+            Snapshot.open(self['path']).update()
+        finally:
+            if lock:
+                lock.release()
+
+    def _revert_interrupted(self, runtime):
+        # the components interrupted while building are built again, so the
+        # files they had written to BUILDPATH are removed; components which
+        # completed without being journaled rewrite their files when rebuilt
+        buildpath = path(self['path'])
+        snapshot = Snapshot.open(buildpath)
+        if snapshot.indexpath.exists():
+            changes = snapshot.update()
+            if changes.created:
+                runtime.report('removing %d entries written by interrupted components'
+                    % len(changes.created))
+                changes.revert()
+                snapshot.update()
+
+    def _verify_result(self, result):
+        return verify_artifacts(result.get('artifacts') or [], result.get('stamps') or {})
+
+    def _build_parallel(self, runtime, components):
+        self.buildlock = Lock()
+        names = set(self.order)
+
+        # workers are forked once pending uploads have drained, so that none
+        # inherits a lock held by an upload thread
+        scheduler = DependencyScheduler(self['jobs'], prepare=self._wait_for_transfers)
+        for component in components:
+            required = []
+            required.extend(component.get('dependencies') or [])
+            required.extend(component.get('ephemeral-dependencies') or [])
+            scheduler.add(component['name'], [r for r in required if r in names], component)
+
+        runtime.report('building %d components with %d jobs' % (len(components), self['jobs']))
+        try:
+            scheduler.run(lambda component: self._assemble_in_worker(runtime, component),
+                lambda name, result: self._merge_result(result), self._is_ready)
+        except JobFailed, exception:
+            raise TaskError('failed to build %s\n%s' % (exception.name, exception.details))
+
+    def _build_serial(self, runtime, components):
+        try:
+            for component in components:
+                self._wait_for_source(runtime, component)
+                self._wait_for_packaging(runtime, component)
+                result = self._assemble_component(runtime, component)
+                if self.packaging and result['name'] in self.packaging.groups:
+                    self.packaged[result['name']] = (component, result)
+                else:
+                    self._merge_result(result)
+                if self.packaging:
+                    self._merge_packaged(runtime, self.packaging.poll_completed())
+            if self.packaging:
+                self._merge_packaged(runtime, self.packaging.wait())
+        except JobFailed, exception:
+            raise TaskError('failed to package %s\n%s' % (exception.name, exception.details))
+
+    def _is_ready(self, name):
+        if self.prefetcher and not self.prefetcher.ready(name):
+            return False
+
+        # a build sees the manifest entries of every component before it in
+        # the profile, so when a manifest is kept it waits for all of them,
+        # exactly as a serial build would
         if self['build_manifest_component'] or self['dump_manifest']:
-            manifest = []
+            for preceding in self.order[:self.order.index(name)]:
+                if preceding not in self.results:
+                    return False
+        return True
+
+    def _assemble_in_worker(self, runtime, component):
+        try:
+            result = self._assemble_component(runtime, component)
+        finally:
+            self._wait_for_transfers()
+
+        if self.timings:
+            result['timings'] = self.timings.extract(component['name'])
+        if self.artifacts:
+            result['artifact_statistics'] = self.artifacts.extract_statistics()
+        return result
+
+    def _collect_artifact_statistics(self, runtime):
+        if not self.artifacts:
+            return None
+
+        statistics = self.artifacts.extract_statistics()
+        if statistics is None:
+            return None
+        for key, value in self.artifact_statistics.iteritems():
+            statistics[key] = statistics.get(key, 0) + value
+
+        if statistics['bytes']:
+            runtime.report('artifact store received %d bytes in %d chunks, of which %d bytes'
+                ' in %d chunks were new (%.1f%% deduplicated)' % (statistics['bytes'],
+                statistics['chunks'], statistics['stored_bytes'], statistics['stored_chunks'],
+                100.0 * (statistics['bytes'] - statistics['stored_bytes']) / statistics['bytes']))
+        return statistics
+
+    def _collect_commit_log(self):
+        commit_log = []
+        for name in self.order:
+            result = self.results.get(name)
+            if result and result.get('commit_log'):
+                commit_log.extend(result['commit_log'])
+        return commit_log
+
+    def _collect_manifest(self):
+        if not (self['build_manifest_component'] or self['dump_manifest']):
+            return None
+
+        manifest = []
+        for name in self.order:
+            result = self.results.get(name)
+            if result and result.get('manifest'):
+                manifest.append(dict(result['manifest']))
+        return manifest
+
+    def _merge_packaged(self, runtime, completed):
+        for name, results in completed:
+            component, result = self.packaged.pop(name)
+            for packaged in results:
+                if packaged.get('manifest'):
+                    result['manifest'] = packaged['manifest']
+                if self.timings and packaged.get('timings'):
+                    self.timings.merge(name, packaged['timings'])
+            result['artifacts'] = self._find_artifacts(runtime, component, result.get('manifest'))
+            self._merge_result(result)
+
+    def _merge_result(self, result, record=True):
+        name = result['name']
+        self.results[name] = result
+        if result['built']:
+            self.built.append(name)
+        if result.get('cache_key'):
+            self.cache_keys[name] = result['cache_key']
+        if self.timings and result.get('timings'):
+            self.timings.merge(name, result.pop('timings'))
+        statistics = result.pop('artifact_statistics', None)
+        if statistics:
+            for key, value in statistics.iteritems():
+                self.artifact_statistics[key] = self.artifact_statistics.get(key, 0) + value
+        if record:
+            # the md5 of the package was computed as it was written, and is
+            # not read again; the tarball is known by its size and mtime
+            checksums = {}
+            entry = result.get('manifest') or {}
+            package_file, package_hash = entry.get('package_file'), entry.get('package_hash')
+            for filepath in result.get('artifacts') or []:
+                if package_hash and os.path.basename(filepath) == package_file:
+                    checksums[filepath] = package_hash
+            result['stamps'] = stamp_artifacts(result.get('artifacts') or [], checksums)
+            self._checkpoint()
+            self.journal.record(result)
+        if self.buildfile and result.get('buildfile'):
+            self.buildfile.set(name, result['buildfile'])
 
-        built = []
-        for component in profile['components']:
-            if component.get('disabled'):
-                continue
-            starting_commit = last_manifest.get(component['name'])
-            oldtarget = None
-            last_package_hash = None
-            last_pkgname = None
-            self.environ
-            if not component.get('ephemeral'):
-                last_package_hash = self._existing_package(runtime, last_package_hashes.get(component['name']))
-                if last_package_names is not None:
-                    last_pkgname = last_package_names.get(component['name'])
-            target = self['target']
-            if (('builds' in component) and (target not in component['builds'])):
-                oldtarget = self['target']
-                self['target'] = 'default'
-            self._build_component(runtime, component, built, timestamp, manifest,
-                commit_log, starting_commit, last_package_hash, last_pkgname, buildfile)
-            if oldtarget:
-                self['target'] = oldtarget
-            if self['dump_commit_log']:
-                self._dump_commit_log(commit_log, self['dump_commit_log'])
-            if self['dump_manifest']:
-                self._dump_manifest(manifest, self['dump_manifest'])
-
-        if buildfile:
-            buildfile.write()
-        if self['build_manifest_component'] and (built or getenv("FORCECHANNEL")):
-            self._build_manifest(runtime, profile, timestamp, manifest)
         if self['dump_commit_log']:
-            self._dump_commit_log(commit_log, self['dump_commit_log'])
+            self._dump_commit_log(self._collect_commit_log(), self['dump_commit_log'])
         if self['dump_manifest']:
-            self._dump_manifest(manifest, self['dump_manifest'])
+            self._dump_manifest(self._collect_manifest(), self['dump_manifest'])
 
     def _build_component(self, runtime, component, built, timestamp, manifest,
             commit_log, starting_commit, last_package_hash, last_pkgname, buildfile):
@@ -132,6 +506,9 @@ class BuildProfile(Task):
         assemblydir = str(runtime.curdir)
 
         buildpath = runtime.curdir / component['name']
+        if self['resume'] and buildpath.exists():
+            # left behind by the interrupted build being resumed
+            buildpath.rmtree()
         buildpath.mkdir()
 
         runtime.linefeed(2)
@@ -144,10 +521,62 @@ class BuildProfile(Task):
             post_tasks=self['post_tasks'], built=built, timestamp=timestamp,
             manifest=manifest, commit_log=commit_log, starting_commit=starting_commit,
             last_package_hash=last_package_hash, last_pkgname=last_pkgname, repodir=self['repodir'], buildfile=buildfile,
-            assemblydir=assemblydir)
+            assemblydir=assemblydir, buildlock=self.buildlock, buildcache=self.buildcache,
+            cache_keys=self.cache_keys, artifacts=self.artifacts, timings=self.timings,
+            archive_format=self['archive_format'], filestore=self['filestore'],
+            packaging=self.packaging, packages=self.packages)
 
         runtime.chdir(curdir)
 
+    def _prefetch_packages(self, runtime, components):
+        # packages are only reused when the commit log is tracked, and then
+        # only for components which are not rebuilt regardless of commits
+        if not self['dump_commit_log']:
+            return
+
+        candidates = []
+        for component in components:
+            if component.get('ephemeral') or component.get('must-build') or is_forced(component):
+                continue
+            package_hash = self.last_package_hashes.get(component['name'])
+            if package_hash and self.packages.contains(package_hash):
+                candidates.append(package_hash)
+
+        if candidates:
+            runtime.report('prefetching %d packages which may be reused' % len(candidates))
+            for package_hash in self.packages.prefetch(candidates):
+                runtime.report('cannot prefetch package %s' % package_hash)
+
+    def _timed(self, name, phase):
+        if self.timings:
+            return self.timings.phase(name, phase)
+        return untimed()
+
+    def _wait_for_transfers(self):
+        if self.buildcache:
+            self.buildcache.wait()
+        if self.artifacts:
+            self.artifacts.wait()
+
+    def _wait_for_packaging(self, runtime, component):
+        # a build only sees the packages of the components it depends on,
+        # so only their packaging has to finish before it starts
+        if not self.packaging:
+            return
+
+        required = set(component.get('dependencies') or [])
+        required.update(component.get('ephemeral-dependencies') or [])
+        if required & set(self.packaging.groups):
+            runtime.report('waiting for packaging of %s' % ', '.join(sorted(required
+                & set(self.packaging.groups))))
+        self._merge_packaged(runtime, self.packaging.wait(required))
+
+    def _wait_for_source(self, runtime, component):
+        if self.prefetcher:
+            error = self.prefetcher.wait(component['name'])
+            if error:
+                runtime.report('prefetch of %s failed: %s' % (component['name'], error))
+
     def _build_manifest(self, runtime, profile, timestamp, manifest):
         assembler = ManifestComponentAssembler(profile, manifest, timestamp)
         name = '%s-manifest' % profile['name']
@@ -161,7 +590,21 @@ class BuildProfile(Task):
         runtime.execute('lattice.component.assemble', environ=self['environ'],
             distpath=self['distpath'], name=name, path=self['path'], specification=component,
             target=self['target'], cachedir=self['cachedir'], post_tasks=self['post_tasks'],
-            built=None, timestamp=timestamp, assembler=assembler)
+            built=None, timestamp=timestamp, assembler=assembler, artifacts=self.artifacts,
+            timings=self.timings, archive_format=self['archive_format'])
+        self._wait_for_transfers()
+
+    def _find_artifacts(self, runtime, component, entry):
+        distpath = self['distpath'] or (runtime.curdir / component['name'] / 'dist')
+        candidates = []
+        archive = find_archive(distpath, '%(name)s-%(version)s' % component)
+        if archive:
+            candidates.append(archive.basename())
+        if entry and entry.get('package_file'):
+            candidates.append(entry['package_file'])
+            candidates.append('%s/%s' % (component.get('arch') or 'x86_64', entry['package_file']))
+        return [str(distpath / candidate) for candidate in candidates
+            if (distpath / candidate).exists()]
 
     def _dump_commit_log(self, commit_log, filename):
         filename = path(filename)
@@ -179,56 +622,147 @@ class BuildProfile(Task):
         filename = path(filename)
         filename.write_bytes('\n'.join(output) + '\n')
 
-    def _existing_package(self, runtime, package_hash):
-        if not package_hash:
-            return
-
-        filename = self['existing_package_hashes']
-        if not filename:
-            return
-
-        filename = path(filename)
-        if not filename.exists():
-            return
+class PlanProfile(ProfileTask):
+    name = 'lattice.profile.plan'
+    description = 'predicts which components of a lattice profile will be built'
+    parameters = {
+        'dump_plan': Text(),
+        'query_jobs': Integer(default=8),
+    }
 
-        res = [ line for line in filename.bytes().strip().split('\n') if line == package_hash ]
+    def run(self, runtime):
+        profile = self._load_profile()
 
-        if len(res):
-            return res[0]
-        else:
-            return 'missing'
+        self.buildfile = None
+        if self['buildfile']:
+            self.buildfile = BuildFile(self['buildfile'])
 
-    def _parse_last_manifest(self, field='hash'):
-        filename = self['last_manifest']
-        if not filename:
-            return {}
+        self.last_manifest = self._parse_last_manifest()
+        self.last_package_names = self._parse_last_manifest('package_file')
+        self.last_package_hashes = self._parse_last_manifest('package_hash')
+        self.packages = self._open_package_index()
 
-        filename = path(filename)
-        if not filename.exists():
-            return {}
+        components = [c for c in profile['components'] if not c.get('disabled')]
 
-        if field != 'hash':
-            exec('%s=None' % field)
+        self.remote_changes = {}
+        if self['dump_commit_log']:
+            pool = ThreadPool(self['query_jobs'])
+            try:
+                changes = pool.map(self._has_commits, components)
+            finally:
+                pool.close()
+            for component, change in zip(components, changes):
+                self.remote_changes[component['name']] = change
 
-        last_manifest = {}
-        for line in filename.bytes().strip().split('\n'):
-            parts = line.split(':')
-            if len(parts) < 2:
-                continue
-            name = parts[0]
-            version = parts[1]
-            hash = parts[2]
-            if len(parts) > 3:
-                package_hash = parts[3]
-            else:
-                package_hash = None
-            if len(parts) > 4:
-                package_file = parts[4]
-            else:
-                package_file = None
+        built = []
+        plan = []
+        for component in components:
+            entry = self._plan_component(runtime, component, built)
+            if entry['action'] == 'build':
+                built.append(component['name'])
+
+            runtime.report('%s: %s (%s)' % (entry['name'], entry['action'],
+                '; '.join(entry['reasons'])))
+            plan.append(entry)
+
+        summary = {}
+        for entry in plan:
+            summary[entry['action']] = summary.get(entry['action'], 0) + 1
+        runtime.report(', '.join('%d to %s' % (count, action)
+            for action, count in sorted(summary.iteritems())))
+
+        if self['dump_plan']:
+            content = {'profile': profile.get('name'), 'target': self['target'],
+                'components': plan, 'summary': summary}
+            path(self['dump_plan']).write_bytes(json.dumps(content, indent=2, sort_keys=True))
+
+    def _plan_component(self, runtime, component, built):
+        # mirrors the decisions made by lattice.component.assemble, using
+        # remote refs and the repository history already cached locally
+        name = component['name']
+        entry = {'name': name, 'version': str(component['version']), 'reasons': []}
+        reasons = entry['reasons']
 
-            last_manifest[name] = eval(field)
-        return last_manifest
+        if self['dump_commit_log']:
+            has_commits, unknown, error = self.remote_changes[name]
+            if error:
+                entry['error'] = error
+                runtime.report('%s: unable to query repository: %s' % (name, error))
+            if has_commits is None:
+                has_commits = True
+                reasons.append('%s, assuming new commits' % unknown)
+            elif has_commits:
+                reasons.append('new commits since %s' % (self.last_manifest.get(name) or 'ever'))
+        else:
+            has_commits = True
+            reasons.append('commit log not tracked')
+
+        if component.get('ephemeral') and not component.get('builds'):
+            entry['action'] = 'build' if has_commits else 'skip'
+            reasons.append('ephemeral component without builds')
+            return entry
+
+        building = must_build(component, built)
+        if component.get('must-build'):
+            reasons.append('marked must-build')
+        elif building:
+            required = (component.get('dependencies') or []) + (component.get('ephemeral-dependencies') or [])
+            reasons.append('dependencies rebuilt: %s' % ', '.join(d for d in required if d in built))
+        if is_forced(component):
+            reasons.append('listed in FORCE_COMPONENTS')
+        building = building or has_commits or is_forced(component)
+
+        last_package_hash = None
+        if not component.get('ephemeral'):
+            last_package_hash = self._existing_package(runtime, self.last_package_hashes.get(name))
+            if last_package_hash == 'missing':
+                reasons.append('previous package missing from package store')
+
+        if (last_package_hash and last_package_hash != 'missing') and not building:
+            entry['action'] = 'reuse'
+            entry['package_hash'] = last_package_hash
+            if self.last_package_names:
+                entry['package_file'] = self.last_package_names.get(name)
+            reasons.append('unchanged, reusing existing package')
+            return entry
+
+        if self.buildfile:
+            if not building:
+                if component['version'] == 'HEAD':
+                    building = True
+                    reasons.append('version of HEAD is only known after checkout')
+                elif self.buildfile.get(name) != component['version']:
+                    building = True
+                    reasons.append('version differs from buildfile')
+                else:
+                    reasons.append('version matches buildfile')
+        elif not component.get('ephemeral'):
+            if not building:
+                reasons.append('no buildfile and no reusable package')
+            building = True
+
+        entry['action'] = 'build' if building else 'skip'
+        return entry
+
+    def _has_commits(self, component):
+        # applies the test made by lattice.component.assemble to the revision
+        # the build would check out, reading its history from the mirror or
+        # cache entry left by earlier builds; returns whether there are new
+        # commits, or None along with the reason they are unknown
+        metadata = component.get('repository')
+        if not metadata or metadata.get('type') not in Repository.implementations:
+            return None, 'no repository to query', None
+
+        repository = Repository.instantiate(metadata['type'], None, cachedir=self['repodir'])
+        try:
+            commits = repository.get_remote_commit_log(metadata,
+                self.last_manifest.get(component['name']))
+        except RuntimeError, exception:
+            error = str(exception).strip()
+            return None, 'unable to query repository', error
+        if commits is None:
+            return None, 'unknown (no local history)', None
+        return filter_commits(commits, metadata.get('ignore')) is not None, None, None
 
 class ManifestComponentAssembler(ComponentAssembler):
     def __init__(self, profile, manifest, timestamp):
@@ -0,0 +1,33 @@
+from bake import *
+from scheme import *
+
+from lattice.support.repoindex import RepositoryIndex
+
+class IndexRepository(Task):
+    name = 'lattice.repo.index'
+    description = 'incrementally generates yum and apt repository metadata for a distpath'
+    parameters = {
+        'deb': Boolean(default=True),
+        'distpath': Path(nonempty=True),
+        'rpm': Boolean(default=True),
+    }
+
+    def run(self, runtime):
+        distpath = self['distpath']
+        if not distpath.isdir():
+            raise TaskError('distpath %s does not exist' % distpath)
+
+        index = RepositoryIndex(distpath)
+        try:
+            recorded, removed, skipped = index.update()
+            runtime.report('indexed %d new or changed packages, dropped %d removed packages'
+                % (len(recorded), len(removed)))
+            for filename, reason in skipped:
+                runtime.report('skipped unreadable package %s: %s' % (filename, reason))
+
+            if self['rpm']:
+                runtime.report('wrote repodata for %d rpms' % index.write_repodata())
+            if self['deb']:
+                runtime.report('wrote Packages for %d debs' % index.write_packages())
+        finally:
+            index.close()
@@ -1,8 +1,11 @@
 from bake import *
-import tarfile
 from bake.util import get_package_data
 from scheme import *
 
+from lattice.support.archive import extract_archive, find_archive
+from lattice.support.cache import lease, leasing
+from lattice.support.repoindex import RepositoryIndex
+from lattice.support.rpmfile import RpmError, RpmWriter
 from lattice.tasks.component import ComponentTask
 from lattice.util import interpolate_env_vars
 
@@ -10,10 +13,14 @@ class BuildRpm(ComponentTask):
     name = 'lattice.rpm.build'
     description = 'builds a rpm file of a built component'
     parameters = {
+        'artifacts': Field(hidden=True),
         'cachedir': Path(nonnull=True),
         'distpath': Path(nonempty=True),
+        'native': Boolean(default=False),
         'prefix': Text(nonnull=True),
         'manifest': Field(hidden=True),
+        'members': Field(hidden=True),
+        'packages': Field(hidden=True),
         'assembler': Field(hidden=True),
     }
 
@@ -38,7 +45,9 @@ class BuildRpm(ComponentTask):
           self.arch = 'x86_64'
 
         version = component['version']
-        self.tgzname = '%s-%s.tar.bz2' % (name, version)
+        self.tgzpath = find_archive(self['distpath'], '%s-%s' % (name, version))
+        if not self.tgzpath:
+            raise TaskError('cannot find the built archive of %s-%s' % (name, version))
 
         prefix = self['prefix']
         if prefix:
@@ -59,6 +68,40 @@ class BuildRpm(ComponentTask):
 
         self.pkgname = '%s-%sp%s-1.%s.rpm' % (name, version, self.release, self.arch)
 
+        # use pkg deps if they exist
+        dependencies = component.get('package-dependencies')
+        if not dependencies:
+            dependencies = component.get('dependencies')
+
+        if dependencies and prefix:
+            dependencies = ['%s-%s' % (prefix.strip('-'), d) for d in dependencies]
+
+        try:
+            build = self.build
+        except TaskError:
+            build = {}
+
+        scripts = {}
+        for file_token, script_token, script_name in self.SCRIPTS:
+            script = None
+            if file_token in build:
+                scriptpath = path(build[file_token])
+                if scriptpath.exists():
+                    script = scriptpath.bytes()
+            elif script_token in build:
+                script = build[script_token]
+            if script:
+                scripts[script_name] = interpolate_env_vars(script, environ)
+
+        if self['native']:
+            try:
+                self._write_rpm(runtime, name, '%sp%s' % (version, self.release),
+                    dependencies or ['rpm'], scripts)
+                return
+            except RpmError, exception:
+                runtime.report('cannot write %s natively, falling back to rpmbuild: %s'
+                    % (self.pkgname, exception))
+
         self.workpath = runtime.curdir / ('build_%s_rpm' % name)
         self.workpath.makedirs_p()
 
@@ -70,14 +113,7 @@ class BuildRpm(ComponentTask):
         self.buildrootdir.mkdir_p()
         self.builddir.mkdir_p()
 
-        # use pkg deps if they exist
-        dependencies = component.get('package-dependencies')
-        if not dependencies:
-            dependencies = component.get('dependencies')
-
         if dependencies:
-            if prefix:
-                dependencies = ['%s-%s' % (prefix.strip('-'), d) for d in dependencies]
             dependencies = ', '.join(dependencies)
 
         template = get_package_data('lattice', 'templates/rpm-spec-file.tmpl')
@@ -112,26 +148,16 @@ class BuildRpm(ComponentTask):
                 if 'requires' in specline.lower():
                     newspeclines.append('Provides: %s' % provides)
             self.specpath.write_lines(newspeclines)
-        try:
-            build = self.build
-        except TaskError:
-            build = {}
         for file_token, script_token, script_name in self.SCRIPTS:
-            script = None
-            if file_token in build:
-                scriptpath = path(build[file_token])
-                if scriptpath.exists():
-                    script = scriptpath.bytes()
-            elif script_token in build:
-                script = build[script_token]
+            script = scripts.get(script_name)
             if script:
                 speccontent = ['\n', '%%%s' % script_name]
                 self.specpath.write_lines(speccontent, append=True)
-                script = interpolate_env_vars(script, environ)
                 self.specpath.write_bytes(script, append=True)
 
         runtime.chdir(self.buildrootdir)
-        self._run_tar(runtime)
+        with self._timed('rpm_unpack'):
+            self._run_tar(runtime)
         membersfile = self.builddir / 'INSTALLED_FILES'
         membersfile.write_lines(self.membernames, append=True)
 
@@ -139,10 +165,14 @@ class BuildRpm(ComponentTask):
         self._run_rpmbuild(runtime, environ)
 
     def _run_tar(self, runtime):
-        shellargs = ['tar', '-xjf', str(self['distpath'] / self.tgzname)]
-        runtime.shell(shellargs, merge_output=True)
-        opentar = tarfile.open(str(self['distpath'] / self.tgzname), 'r')
-        self.membernames = ['\"/' + name + '\"' for name in opentar.getnames()]
+        # the member list comes from the collation of the build when there
+        # was one, and otherwise from the one pass that extracts the archive
+        members = self['members']
+        if members is not None:
+            extract_archive(self.tgzpath, runtime.curdir)
+        else:
+            members = extract_archive(self.tgzpath, runtime.curdir, True)
+        self.membernames = ['\"/' + name + '\"' for name in members]
 
     def _run_rpmbuild(self, runtime, environ):
         pkgpath = self['distpath'] / self.arch / self.pkgname
@@ -156,12 +186,48 @@ class BuildRpm(ComponentTask):
                        '--define', '_rpmdir %s' % str(self['distpath']),
                        '--define', '_topdir %s' % str(self.workpath), str(self.specpath),
                        '--buildroot', self.buildrootdir]
-        runtime.shell(shellcmd,
-                      merge_output=True)
+        with self._timed('rpmbuild'):
+            runtime.shell(shellcmd,
+                          merge_output=True)
+        self._publish(runtime, pkgpath, pkgpath.read_hexhash('md5'))
+
+    def _write_rpm(self, runtime, name, version, dependencies, scripts):
+        pkgpath = self['distpath'] / self.arch / self.pkgname
+        pkgpath.parent.makedirs_p()
+
+        writer = RpmWriter(pkgpath, name, version, '1', self.arch)
+        with self._timed('rpm_write'):
+            writer.write(self.tgzpath, requires=dependencies,
+                provides=self.component.get('package-provides') or (),
+                obsoletes=self.component.get('package-obsoletes') or (),
+                scripts=scripts, summary='%s-%s' % (name, version),
+                description='Package generated by lattice.rpm.build',
+                packager='IBM <storediqsupport@us.ibm.com>', group='Applications/System',
+                license='Commercial')
+        self._publish(runtime, pkgpath, writer.md5, {'sha256': writer.sha256})
+
+    def _publish(self, runtime, pkgpath, package_hash, checksums=None):
+        self._record_written(pkgpath)
+
+        index = RepositoryIndex.open(self['distpath'])
+        if index:
+            index.record(pkgpath, checksums)
+            index.close()
 
         cachedir = self['cachedir']
         if self.manifest:
-            self.assembler.populate_manifest(self.manifest, self.component, pkgpath.read_hexhash('md5'), self.pkgname, runtime)
+            self.assembler.populate_manifest(self.manifest, self.component, package_hash, self.pkgname, runtime)
+
+        packages = self['packages']
+        if packages:
+            packages.add(package_hash, pkgpath, self.component['name'], self.component['version'])
 
         if cachedir:
-            pkgpath.copy2(cachedir)
+            # leased while it is copied, so that it is not evicted half written
+            with leasing():
+                lease(cachedir / pkgpath.basename())
+                pkgpath.copy2(cachedir)
+
+        artifacts = self['artifacts']
+        if artifacts:
+            artifacts.put_async(pkgpath.basename(), pkgpath)
@@ -1,4 +1,6 @@
+import os
 import re
+import shutil
 from uuid import uuid4
 
 from bake import path
@@ -41,3 +43,29 @@ def uniqpath(root, prefix=''):
         candidate = root / ('%s%s' % (prefix, str(uuid4()).replace('-', '')[:8]))
         if not candidate.exists():
             return candidate
+
+def merge_tree(source, target):
+    """Moves the contents of ``source`` into ``target``, leaving existing
+    files which are at least as new as their replacements alone."""
+    for root, dirs, files in os.walk(str(source)):
+        destination = os.path.normpath(os.path.join(str(target), os.path.relpath(root, str(source))))
+        if not os.path.isdir(destination):
+            os.makedirs(destination)
+
+        names = list(files)
+        for name in list(dirs):
+            if os.path.islink(os.path.join(root, name)):
+                dirs.remove(name)
+                names.append(name)
+
+        for name in names:
+            filepath = os.path.join(root, name)
+            targetpath = os.path.join(destination, name)
+            if os.path.lexists(targetpath):
+                if os.lstat(targetpath).st_mtime >= os.lstat(filepath).st_mtime:
+                    continue
+                if os.path.isdir(targetpath) and not os.path.islink(targetpath):
+                    shutil.rmtree(targetpath)
+                else:
+                    os.unlink(targetpath)
+            shutil.move(filepath, targetpath)
@@ -0,0 +1,73 @@
+import os
+import shutil
+import tarfile
+import tempfile
+from cStringIO import StringIO
+from subprocess import PIPE, Popen
+from unittest import TestCase
+
+CONTROL = '''Package: component
+Priority: optional
+Maintainer: Someone <someone@example.com>
+Architecture: all
+Version: 1.0.0
+Description: component-1.0.0
+ a longer description'''
+
+class TemporaryTestCase(TestCase):
+    """A test case with a temporary directory at ``self.root``."""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+def commit(root, name, content):
+    filepath = os.path.join(root, name)
+    if not os.path.isdir(os.path.dirname(filepath)):
+        os.makedirs(os.path.dirname(filepath))
+    with open(filepath, 'w') as openfile:
+        openfile.write(content)
+    git(root, 'add', name)
+    git(root, 'commit', '-q', '-m', 'change %s' % name)
+
+def directory(name, **attributes):
+    return dict(attributes, name=name, type=tarfile.DIRTYPE)
+
+def git(root, *tokens):
+    process = Popen(['git', '-c', 'user.name=lattice', '-c', 'user.email=lattice@example.com']
+        + list(tokens), cwd=root, stdout=PIPE, stderr=PIPE)
+    stdout, stderr = process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError(stderr)
+    return stdout.strip()
+
+def hardlink(name, linkname):
+    return {'name': name, 'type': tarfile.LNKTYPE, 'linkname': linkname}
+
+def regular(name, content, **attributes):
+    return dict(attributes, name=name, content=content)
+
+def symlink(name, linkname):
+    return {'name': name, 'type': tarfile.SYMTYPE, 'linkname': linkname}
+
+def write_tarball(filepath, entries=(), mode='w:gz'):
+    """Writes the tarball ``filepath`` with ``entries``, each a dict of
+    ``TarInfo`` attributes, along with the ``content`` of regular files."""
+    openfile = tarfile.open(str(filepath), mode)
+    try:
+        for entry in entries:
+            entry = dict(entry)
+            content = entry.pop('content', None)
+            info = tarfile.TarInfo(entry.pop('name'))
+            for attribute, value in entry.iteritems():
+                setattr(info, attribute, value)
+            if content is None:
+                openfile.addfile(info)
+            else:
+                info.size = len(content)
+                openfile.addfile(info, StringIO(content))
+    finally:
+        openfile.close()
+    return filepath
@@ -0,0 +1,95 @@
+import os
+from unittest import main, skipUnless
+
+from lattice.support import archive
+from lattice.support.archive import *
+from tests.helpers import TemporaryTestCase, regular, write_tarball
+
+def available(format):
+    return archive._find_command(FORMATS[format]['compressors']) is not None
+
+class TestArchive(TemporaryTestCase):
+    def setUp(self):
+        TemporaryTestCase.setUp(self)
+        self.source = os.path.join(self.root, 'source')
+        os.makedirs(os.path.join(self.source, 'lib'))
+        for name, content in (('lib/module.py', 'module'), ('lib/data file', 'data')):
+            with open(os.path.join(self.source, name), 'w') as openfile:
+                openfile.write(content)
+        os.symlink('module.py', os.path.join(self.source, 'lib', 'link'))
+        self.names = ['lib', 'lib/data file', 'lib/link', 'lib/module.py']
+
+    def test_bzip2(self):
+        # bzip2 falls back to python when no compressor is installed
+        self._test_round_trip('bzip2')
+
+    @skipUnless(available('gzip'), 'requires gzip')
+    def test_gzip(self):
+        self._test_round_trip('gzip')
+
+    @skipUnless(available('xz'), 'requires xz')
+    def test_xz(self):
+        self._test_round_trip('xz')
+
+    @skipUnless(available('zstd'), 'requires zstd')
+    def test_zstd(self):
+        self._test_round_trip('zstd')
+
+    def test_uncompressed(self):
+        filepath = write_tarball(os.path.join(self.root, 'component.tar'),
+            [regular('file', 'content')], 'w')
+        self.assertEqual(detect_format(filepath), None)
+        self.assertEqual(extract_archive(filepath, self._target(), True), ['file'])
+        with read_archive(filepath) as openfile:
+            self.assertEqual([member.name for member in openfile], ['file'])
+
+    def test_find_archive(self):
+        self.assertEqual(find_archive(self.root, 'component-1.0'), None)
+        for format in ('bzip2', 'gzip'):
+            open(os.path.join(self.root, 'component-1.0' + get_extension(format)), 'w').close()
+        self.assertEqual(str(find_archive(self.root, 'component-1.0')),
+            os.path.join(self.root, 'component-1.0.tar.bz2'))
+
+        open(os.path.join(self.root, 'component-1.0' + get_extension(DEFAULT_FORMAT)), 'w').close()
+        self.assertEqual(str(find_archive(self.root, 'component-1.0')),
+            os.path.join(self.root, 'component-1.0' + get_extension(DEFAULT_FORMAT)))
+
+    def test_resolve_format(self):
+        self.assertEqual(resolve_format('bzip2'), 'bzip2')
+        self.assertEqual(resolve_format(), DEFAULT_FORMAT if available(DEFAULT_FORMAT) else 'bzip2')
+        self.assertRaises(ArchiveError, resolve_format, 'lz4')
+
+    def test_failed_extraction(self):
+        filepath = os.path.join(self.root, 'component.tar.gz')
+        with open(filepath, 'wb') as openfile:
+            openfile.write('\x1f\x8b' + 'truncated')
+        self.assertRaises(ArchiveError, extract_archive, filepath, self._target())
+
+    def _test_round_trip(self, format):
+        filepath = os.path.join(self.root, 'component' + get_extension(format))
+        with ArchiveWriter(filepath, format) as writer:
+            for name in self.names:
+                writer.add(os.path.join(self.source, name), name)
+        self.assertEqual(detect_format(filepath), format)
+
+        with read_archive(filepath) as openfile:
+            contents = {}
+            for member in openfile:
+                contents[member.name] = (openfile.extractfile(member).read()
+                    if member.isfile() else member.linkname)
+        self.assertEqual(contents, {'lib': '', 'lib/data file': 'data', 'lib/link': 'module.py',
+            'lib/module.py': 'module'})
+
+        target = self._target()
+        self.assertEqual(sorted(extract_archive(filepath, target, True)), self.names)
+        self.assertEqual(os.readlink(os.path.join(target, 'lib', 'link')), 'module.py')
+        with open(os.path.join(target, 'lib', 'data file')) as openfile:
+            self.assertEqual(openfile.read(), 'data')
+
+    def _target(self):
+        target = os.path.join(self.root, 'target')
+        os.mkdir(target)
+        return target
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+import os
+import random
+from unittest import main
+
+from lattice.support.artifacts import *
+from tests.helpers import TemporaryTestCase
+
+def generate(seed, size):
+    generator = random.Random(seed)
+    return ''.join(chr(generator.randint(0, 255)) for i in xrange(size))
+
+class TestFilesystemArtifactStore(TemporaryTestCase):
+    def test_round_trip(self):
+        store = ArtifactStore.instantiate('file://' + os.path.join(self.root, 'store'))
+        self.assertIsInstance(store, FilesystemArtifactStore)
+
+        filepath = self._write('component.tar.zst', 'content')
+        self.assertFalse(store.exists('component/component.tar.zst'))
+        self.assertFalse(store.touch('component/component.tar.zst'))
+        store.put('component/component.tar.zst', filepath)
+        self.assertTrue(store.exists('component/component.tar.zst'))
+        self.assertTrue(store.touch('component/component.tar.zst'))
+
+        target = os.path.join(self.root, 'target')
+        self.assertTrue(store.get('component/component.tar.zst', target))
+        self.assertFalse(store.get('missing', os.path.join(self.root, 'missing')))
+        with open(target) as openfile:
+            self.assertEqual(openfile.read(), 'content')
+
+    def test_async(self):
+        store = ArtifactStore.instantiate(os.path.join(self.root, 'store'))
+        for name in ('a', 'b', 'c'):
+            store.put_async(name, self._write(name, name))
+        store.wait()
+        self.assertTrue(all(store.exists(name) for name in ('a', 'b', 'c')))
+
+    def test_unsupported(self):
+        self.assertRaises(ValueError, ArtifactStore.instantiate, 'ftp://host/artifacts')
+
+    def _write(self, name, content):
+        filepath = os.path.join(self.root, name)
+        with open(filepath, 'wb') as openfile:
+            openfile.write(content)
+        return filepath
+
+class TestChunkedArtifactStore(TemporaryTestCase):
+    def setUp(self):
+        TemporaryTestCase.setUp(self)
+        self.store = self._open_store()
+
+        # markers every kilobyte or so, so that chunks end on them
+        self.content = ChunkedArtifactStore.MARKER.join(generate(seed, 1000) for seed in range(40))
+
+    def test_split(self):
+        filepath = self._write('artifact', self.content)
+        chunks = list(self.store._split(filepath))
+        self.assertEqual(''.join(chunks), self.content)
+        for chunk in chunks[:-1]:
+            self.assertTrue(self.store.MINIMUM_CHUNK <= len(chunk) <= self.store.MAXIMUM_CHUNK)
+            self.assertTrue(chunk.endswith(ChunkedArtifactStore.MARKER))
+
+        # without markers, chunks are cut at the maximum size
+        filepath = self._write('artifact', 'x' * 10000)
+        self.assertEqual([len(chunk) for chunk in self.store._split(filepath)], [4096, 4096, 1808])
+
+    def test_round_trip(self):
+        self.assertFalse(self.store.exists('artifact'))
+        self.store.put('artifact', self._write('artifact', self.content))
+        self.assertTrue(self.store.exists('artifact'))
+
+        target = os.path.join(self.root, 'target')
+        self.assertTrue(self.store.get('artifact', target))
+        self.assertEqual(self._read(target), self.content)
+        self.assertEqual(sorted(os.listdir(self.root)), ['artifact', 'store', 'target'])
+
+    def test_shared_chunks(self):
+        self.store.put('first', self._write('first', self.content))
+        statistics = self.store.extract_statistics()
+        self.assertEqual(statistics['stored_chunks'], statistics['chunks'])
+        self.assertEqual(statistics['bytes'], len(self.content))
+
+        # an insertion near the start only changes the chunk it falls in
+        changed = self.content[:100] + 'inserted' + self.content[100:]
+        self.store.put('second', self._write('second', changed))
+        statistics = self.store.extract_statistics()
+        self.assertEqual(statistics['artifacts'], 1)
+        self.assertEqual(statistics['stored_chunks'], 1)
+        self.assertTrue(statistics['stored_bytes'] < len(changed) / 10)
+
+        # a fresh store, as in another process, finds the chunks in the backing store
+        store = self._open_store()
+        store.put('third', self._write('third', changed))
+        self.assertEqual(store.extract_statistics()['stored_chunks'], 0)
+
+        target = os.path.join(self.root, 'target')
+        self.assertTrue(store.get('second', target))
+        self.assertEqual(self._read(target), changed)
+
+    def test_damaged(self):
+        self.store.put('artifact', self._write('artifact', self.content))
+        chunkroot = os.path.join(self.root, 'store', 'chunks')
+        name = sorted(os.listdir(chunkroot))[0]
+        filename = os.listdir(os.path.join(chunkroot, name))[0]
+        with open(os.path.join(chunkroot, name, filename), 'wb') as openfile:
+            openfile.write('damaged')
+
+        target = os.path.join(self.root, 'target')
+        self.assertFalse(self.store.get('artifact', target))
+        self.assertFalse(self.store.get('missing', target))
+        self.assertEqual(sorted(os.listdir(self.root)), ['artifact', 'store'])
+
+    def _open_store(self):
+        store = ArtifactStore.instantiate('chunks+file://' + os.path.join(self.root, 'store'))
+        store.MINIMUM_CHUNK = 256
+        store.MAXIMUM_CHUNK = 4096
+        store.BLOCK_SIZE = 1024
+        return store
+
+    def _read(self, filepath):
+        with open(filepath, 'rb') as openfile:
+            return openfile.read()
+
+    def _write(self, name, content):
+        filepath = os.path.join(self.root, name)
+        with open(filepath, 'wb') as openfile:
+            openfile.write(content)
+        return filepath
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase, main
+
+from lattice.support import cache
+from lattice.support.artifacts import ArtifactStore
+from lattice.support.cache import CacheManager, lease, leasing, parse_size, populate
+from lattice.support.filestore import FileStore
+
+ENTRY = 'a' * 40
+
+class TestCache(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_populate(self):
+        calls = []
+        def create(staging):
+            calls.append(staging)
+            os.mkdir(staging)
+
+        entry = os.path.join(self.root, ENTRY)
+        with leasing():
+            self.assertEqual(populate(entry, create), entry)
+            self.assertEqual(populate(entry, create), entry)
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(os.path.isdir(entry))
+        self.assertFalse(os.path.exists(calls[0]))
+
+    def test_failed_populate(self):
+        def create(staging):
+            os.mkdir(staging)
+            raise RuntimeError('clone failed')
+
+        entry = os.path.join(self.root, ENTRY)
+        with leasing():
+            self.assertRaises(RuntimeError, populate, entry, create)
+        self.assertEqual(sorted(os.listdir(self.root)), [ENTRY + '.lock'])
+
+    def test_leased_directories(self):
+        entry = os.path.join(self.root, ENTRY)
+        manager = CacheManager(self.root)
+        with leasing():
+            populate(entry, self._create_entry)
+            self.assertEqual(manager.collect(max_size=0), [])
+            self.assertTrue(os.path.isdir(entry))
+
+        # the lease ends with the block, and the entry can then be evicted
+        self.assertEqual([e.path for e in manager.collect(max_size=0)], [entry])
+        self.assertEqual(os.listdir(self.root), [])
+
+    def test_leased_files(self):
+        filepath = os.path.join(self.root, 'component-1.0.0-1.noarch.rpm')
+        with open(filepath, 'w') as openfile:
+            openfile.write('package')
+
+        manager = CacheManager(self.root)
+        with leasing():
+            lease(filepath)
+            self.assertEqual(manager.collect(max_size=0), [])
+            self.assertTrue(os.path.exists(filepath))
+
+        self.assertEqual([e.path for e in manager.collect(max_size=0)], [filepath])
+        self.assertEqual(os.listdir(self.root), [])
+
+    def test_leasing_is_nested(self):
+        first, second = os.path.join(self.root, 'first'), os.path.join(self.root, 'second')
+        with leasing():
+            lease(first)
+            with leasing():
+                lease(second)
+                self.assertEqual(len(cache._leases), 2)
+            self.assertEqual(len(cache._leases), 1)
+        self.assertEqual(cache._leases, [])
+
+    def test_collect(self):
+        now = time.time()
+        for name, size, age in (('old', 10, 3600), ('recent', 20, 60), ('new', 40, 0)):
+            filepath = os.path.join(self.root, name)
+            with open(filepath, 'w') as openfile:
+                openfile.write('x' * size)
+            os.utime(filepath, (now - age, now - age))
+
+        manager = CacheManager(self.root)
+        evicted = manager.collect(max_age=600, dry_run=True)
+        self.assertEqual([os.path.basename(e.path) for e in evicted], ['old'])
+        self.assertEqual(len(os.listdir(self.root)), 3)
+
+        # the least recently used go first, until the rest fit
+        evicted = manager.collect(max_size=45)
+        self.assertEqual([os.path.basename(e.path) for e in evicted], ['old', 'recent'])
+        self.assertEqual(os.listdir(self.root), ['new'])
+
+    def test_layout(self):
+        os.makedirs(os.path.join(self.root, ENTRY, 'src'))
+        os.makedirs(os.path.join(self.root, 'mirrors', 'b' * 40 + '.git'))
+        os.makedirs(os.path.join(self.root, 'x86_64'))
+        for name in ('specifications.db', 'x86_64/component-1.0-1.x86_64.rpm', '.tmp-abcdef',
+                ENTRY + '/src/file', 'mirrors/%s.git/HEAD' % ('b' * 40)):
+            with open(os.path.join(self.root, name), 'w') as openfile:
+                openfile.write('content')
+
+        # checkouts are entries as a whole, other files individually, and
+        # mirrors and indexes never
+        entries = sorted(CacheManager(self.root).enumerate_entries(), key=lambda e: e.path)
+        self.assertEqual([os.path.relpath(e.path, self.root) for e in entries],
+            [ENTRY, 'x86_64/component-1.0-1.x86_64.rpm'])
+        self.assertEqual(entries[0].size, 7)
+
+    def test_collect_filestore(self):
+        store = FileStore(self.root)
+        for key, files in (('old', {'shared': 'shared', 'old': 'old'}),
+                ('new', {'shared': 'shared', 'new': 'new'})):
+            staging = os.path.join(self.root, '.staging')
+            os.mkdir(staging)
+            for name, content in files.iteritems():
+                with open(os.path.join(staging, name), 'w') as openfile:
+                    openfile.write(content)
+                os.utime(os.path.join(staging, name), (1234567890, 1234567890))
+            store.ingest(key, staging, sorted(files))
+            shutil.rmtree(staging)
+        self._age(store._get_manifest_path('old'), 3600)
+
+        # the shared object stays until the last manifest referring to it goes
+        manager = CacheManager(self.root)
+        evicted = manager.collect(max_age=600)
+        self.assertEqual([os.path.basename(e.path) for e in evicted], ['old.json'])
+        self.assertEqual(sorted(self._objects()), ['new', 'shared'])
+
+        # the objects removed with an entry count towards its size
+        size = os.path.getsize(str(store._get_manifest_path('new')))
+        evicted = manager.collect(max_size=0)
+        self.assertEqual([e.size for e in evicted], [size + len('new') + len('shared')])
+        self.assertEqual(self._objects(), [])
+        self.assertFalse(store.contains('new'))
+
+    def test_collect_chunks(self):
+        store = ArtifactStore.instantiate('chunks+file://' + self.root)
+        store.MINIMUM_CHUNK, store.MAXIMUM_CHUNK = 4, 8
+        for key, content in (('old', 'sharedXXold.....'), ('new', 'sharedXXnew.....')):
+            filepath = os.path.join(self.root, '.%s' % key)
+            with open(filepath, 'w') as openfile:
+                openfile.write(content)
+            store.put(key, filepath)
+            os.unlink(filepath)
+        self._age(os.path.join(self.root, 'recipes', 'old.json'), 3600)
+
+        chunks = os.path.join(self.root, 'chunks')
+        count = sum(len(files) for root, dirs, files in os.walk(chunks))
+        self.assertEqual(count, 3)
+
+        evicted = CacheManager(self.root).collect(max_age=600)
+        self.assertEqual([os.path.basename(e.path) for e in evicted], ['old.json'])
+        self.assertEqual(sum(len(files) for root, dirs, files in os.walk(chunks)), 2)
+        self.assertTrue(store.exists('new'))
+
+    def test_parse_size(self):
+        self.assertEqual(parse_size('512'), 512)
+        self.assertEqual(parse_size('1.5k'), 1536)
+        self.assertEqual(parse_size('2 GB'), 2 * 1024 ** 3)
+
+    def _age(self, filepath, age):
+        then = time.time() - age
+        os.utime(str(filepath), (then, then))
+
+    def _objects(self):
+        names = []
+        for root, dirs, files in os.walk(os.path.join(self.root, 'objects')):
+            for name in files:
+                with open(os.path.join(root, name)) as openfile:
+                    names.append(openfile.read())
+        return sorted(names)
+
+    def _create_entry(self, staging):
+        os.mkdir(staging)
+        with open(os.path.join(staging, 'file'), 'w') as openfile:
+            openfile.write('content')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+import os
+import tarfile
+from cStringIO import StringIO
+from distutils.spawn import find_executable
+from subprocess import PIPE, Popen, call
+from unittest import main, skipUnless
+
+from lattice.support.debfile import *
+from tests.helpers import CONTROL, TemporaryTestCase, regular, symlink, write_tarball
+
+def read_members(filepath):
+    members = []
+    with open(filepath, 'rb') as openfile:
+        assert openfile.read(len(AR_MAGIC)) == AR_MAGIC
+        while True:
+            header = openfile.read(AR_HEADER_SIZE)
+            if not header:
+                return members
+            name, size = header[:16].strip(), int(header[48:58])
+            members.append((name, openfile.read(size)))
+            if size % 2:
+                assert openfile.read(1) == '\n'
+
+def open_tarball(name, content):
+    if name.endswith('.xz'):
+        content = Popen(['xz', '-d', '-c'], stdin=PIPE, stdout=PIPE).communicate(content)[0]
+    return tarfile.open(fileobj=StringIO(content), mode='r:gz' if name.endswith('.gz') else 'r:')
+
+class TestDebWriter(TemporaryTestCase):
+    def setUp(self):
+        TemporaryTestCase.setUp(self)
+        self.filepath = os.path.join(self.root, 'component-1.0.0.deb')
+
+        owner = dict(uid=1000, gid=1000, uname='builder', gname='builder')
+        self.archive = write_tarball(os.path.join(self.root, 'component-1.0.0.tar.gz'), [
+            regular('usr/lib/component/module.py', 'odd', **owner),
+            regular('etc/.hidden', 'even', **owner),
+            symlink('usr/lib/component/link', 'module.py'),
+        ])
+
+    def test_members(self):
+        DebWriter(self.filepath).write(CONTROL, {'postinst': '#!/bin/sh\n'}, self.archive)
+        members = read_members(self.filepath)
+
+        self.assertEqual([name for name, content in members][:2], ['debian-binary', 'control.tar.gz'])
+        self.assertIn(members[2][0], ('data.tar.xz', 'data.tar.gz'))
+        self.assertEqual(members[0][1], '2.0\n')
+        self.assertFalse(os.path.exists(self.filepath + '.tmp'))
+
+        control = open_tarball(*members[1])
+        self.assertEqual(control.getnames(), ['.', './control', './postinst'])
+        self.assertEqual(control.getmember('./postinst').mode, 0755)
+        self.assertEqual(control.extractfile('./control').read(), CONTROL + '\n')
+
+    def test_data(self):
+        DebWriter(self.filepath).write(CONTROL, {}, self.archive)
+        data = open_tarball(*read_members(self.filepath)[2])
+
+        # parent directories missing from the tarball are supplied
+        self.assertEqual(data.getnames(), ['.', './usr', './usr/lib', './usr/lib/component',
+            './usr/lib/component/module.py', './etc', './etc/.hidden', './usr/lib/component/link'])
+        self.assertTrue(data.getmember('./usr/lib').isdir())
+        for member in data:
+            self.assertEqual((member.uid, member.gid, member.uname, member.gname), (0, 0, 'root', 'root'))
+
+        self.assertEqual(data.extractfile('./usr/lib/component/module.py').read(), 'odd')
+        self.assertEqual(data.getmember('./usr/lib/component/link').linkname, 'module.py')
+
+    def test_required_fields(self):
+        control = CONTROL.replace('Maintainer: Someone <someone@example.com>\n', '')
+        self.assertRaises(DebError, DebWriter(self.filepath).write, control, {}, self.archive)
+        self.assertFalse(os.path.exists(self.filepath))
+
+    @skipUnless(find_executable('dpkg-deb'), 'requires dpkg-deb')
+    def test_dpkg(self):
+        DebWriter(self.filepath).write(CONTROL, {'postinst': '#!/bin/sh\n'}, self.archive)
+        with open(os.devnull, 'w') as devnull:
+            self.assertEqual(call(['dpkg-deb', '--info', self.filepath], stdout=devnull), 0)
+
+        process = Popen(['dpkg-deb', '--contents', self.filepath], stdout=PIPE)
+        listing = process.communicate()[0]
+        self.assertEqual(process.returncode, 0)
+        self.assertIn('./usr/lib/component/module.py', listing)
+
+class TestControl(TemporaryTestCase):
+    def test_parse_control(self):
+        fields = parse_control(CONTROL)
+        self.assertEqual(fields['Package'], 'component')
+        self.assertEqual(fields['Maintainer'], 'Someone <someone@example.com>')
+        self.assertEqual(fields['Description'], 'component-1.0.0\n a longer description')
+
+    def test_read_control(self):
+        archive = write_tarball(os.path.join(self.root, 'empty.tar.gz'))
+        filepath = os.path.join(self.root, 'component.deb')
+        DebWriter(filepath).write(CONTROL, {}, archive)
+        self.assertEqual(read_control(filepath), CONTROL + '\n')
+
+    def test_not_a_deb(self):
+        filepath = os.path.join(self.root, 'component.deb')
+        with open(filepath, 'wb') as openfile:
+            openfile.write('not an archive')
+        self.assertRaises(DebError, read_control, filepath)
+
+    def test_no_control_member(self):
+        filepath = os.path.join(self.root, 'component.deb')
+        with open(filepath, 'wb') as openfile:
+            openfile.write(AR_MAGIC + AR_HEADER % ('debian-binary', 0, 0, 0, 0100644, 4) + '2.0\n')
+        self.assertRaises(DebError, read_control, filepath)
+
+if __name__ == '__main__':
+    main()
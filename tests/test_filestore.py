@@ -0,0 +1,98 @@
+import os
+import time
+from unittest import main
+
+from lattice.support.filestore import FileStore, locate_filestore
+from tests.helpers import TemporaryTestCase
+
+MTIME = 1234567890
+
+class TestFileStore(TemporaryTestCase):
+    def setUp(self):
+        TemporaryTestCase.setUp(self)
+        self.store = FileStore(os.path.join(self.root, 'store'))
+
+    def test_round_trip(self):
+        source = self._create_output('source', {'bin/tool': 'tool', 'lib/module.py': 'module'})
+        os.chmod(os.path.join(source, 'bin', 'tool'), 0755)
+        os.symlink('module.py', os.path.join(source, 'lib', 'link'))
+
+        self.assertFalse(self.store.contains('output'))
+        self.store.ingest('output', source, ['bin/tool', 'lib/link', 'lib/module.py'])
+        self.assertTrue(self.store.contains('output'))
+        self.assertFalse(os.path.exists(os.path.join(source, 'bin', 'tool')))
+
+        target = os.path.join(self.root, 'target')
+        self.assertEqual(self.store.materialize('output', target),
+            ['bin/tool', 'lib/link', 'lib/module.py'])
+        self.assertEqual(self._read(target, 'lib/module.py'), 'module')
+        self.assertEqual(os.readlink(os.path.join(target, 'lib', 'link')), 'module.py')
+
+        status = os.stat(os.path.join(target, 'bin', 'tool'))
+        self.assertEqual((status.st_mode & 0777, int(status.st_mtime)), (0755, MTIME))
+
+    def test_shared_objects(self):
+        self.store.ingest('first', self._create_output('first', {'module.py': 'module'}), [])
+        self.store.ingest('second', self._create_output('second', {'other.py': 'module'}), [])
+
+        objects = []
+        for root, dirs, files in os.walk(os.path.join(self.root, 'store', 'objects')):
+            objects.extend(files)
+        self.assertEqual(len(objects), 1)
+
+    def test_modified_in_place(self):
+        # a build writing to a materialized file leaves the object alone
+        self.store.ingest('output', self._create_output('source', {'module.py': 'module'}), [])
+        target = os.path.join(self.root, 'target')
+        self.store.materialize('output', target)
+        with open(os.path.join(target, 'module.py'), 'r+') as openfile:
+            openfile.write('MODULE')
+
+        other = os.path.join(self.root, 'other')
+        self.assertEqual(self.store.materialize('output', other), [])
+        self.assertEqual(self._read(other, 'module.py'), 'module')
+
+    def test_keep_newer(self):
+        self.store.ingest('output', self._create_output('source', {'a': 'stored', 'b': 'stored'}),
+            [])
+        target = self._create_output('target', {'a': 'newer', 'b': 'older'})
+        now = time.time()
+        os.utime(os.path.join(target, 'a'), (now, now))
+        os.utime(os.path.join(target, 'b'), (MTIME - 60, MTIME - 60))
+
+        self.store.materialize('output', target, True)
+        self.assertEqual(self._read(target, 'a'), 'newer')
+        self.assertEqual(self._read(target, 'b'), 'stored')
+
+    def test_damaged_object(self):
+        self.store.ingest('output', self._create_output('source', {'module.py': 'module'}), [])
+        for root, dirs, files in os.walk(os.path.join(self.root, 'store', 'objects')):
+            for name in files:
+                with open(os.path.join(root, name), 'w') as openfile:
+                    openfile.write('mod')
+
+        self.assertEqual(self.store.materialize('output', os.path.join(self.root, 'target')),
+            None)
+        self.assertFalse(self.store.contains('output'))
+
+    def test_locate_filestore(self):
+        self.assertEqual(str(locate_filestore(os.path.join(self.root, 'cache'))),
+            os.path.join(self.root, 'cache-files'))
+
+    def _create_output(self, name, files):
+        root = os.path.join(self.root, name)
+        for filename, content in files.iteritems():
+            filepath = os.path.join(root, filename)
+            if not os.path.isdir(os.path.dirname(filepath)):
+                os.makedirs(os.path.dirname(filepath))
+            with open(filepath, 'w') as openfile:
+                openfile.write(content)
+            os.utime(filepath, (MTIME, MTIME))
+        return root
+
+    def _read(self, root, name):
+        with open(os.path.join(root, name)) as openfile:
+            return openfile.read()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+import json
+import os
+import shutil
+import tempfile
+from hashlib import md5
+from unittest import TestCase, main
+
+from lattice.support import journal
+from lattice.support.journal import *
+
+HEADER = {'profile': 'product', 'version': '1.0', 'target': 'default', 'components': ['a', 'b']}
+
+class TestBuildJournal(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.journal = BuildJournal(os.path.join(self.root, 'journal.json'))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_missing(self):
+        self.assertEqual(self.journal.load(HEADER), (None, {}))
+
+    def test_round_trip(self):
+        self.journal.start(HEADER)
+        self.journal.record({'name': 'a', 'built': True})
+        self.journal.record({'name': 'b', 'built': False})
+
+        recorded, results = self.journal.load(HEADER)
+        self.assertEqual(recorded, HEADER)
+        self.assertEqual(results, {'a': {'name': 'a', 'built': True},
+            'b': {'name': 'b', 'built': False}})
+
+    def test_restart(self):
+        self.journal.start(HEADER)
+        self.journal.record({'name': 'a', 'built': True})
+        self.journal.start(HEADER)
+        self.assertEqual(self.journal.load(HEADER)[1], {})
+
+    def test_mismatch(self):
+        self.journal.start(HEADER)
+        self.assertRaises(JournalMismatch, self.journal.load, dict(HEADER, version='2.0'))
+
+    def test_interrupted_record(self):
+        # the last line was cut short when the build was interrupted
+        self.journal.start(HEADER)
+        self.journal.record({'name': 'a', 'built': True})
+        with open(self.journal.filepath, 'a') as openfile:
+            openfile.write(json.dumps({'name': 'b', 'built': True})[:10])
+        self.assertEqual(sorted(self.journal.load(HEADER)[1]), ['a'])
+
+class TestArtifacts(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.tarball = os.path.join(self.root, 'component-1.0.tar.bz2')
+        self.package = os.path.join(self.root, 'component-1.0-1.x86_64.rpm')
+        for filepath in (self.tarball, self.package):
+            with open(filepath, 'w') as openfile:
+                openfile.write(os.path.basename(filepath))
+
+        self.artifacts = [self.tarball, self.package]
+        self.stamps = json.loads(json.dumps(stamp_artifacts(self.artifacts,
+            {self.package: md5(os.path.basename(self.package)).hexdigest()})))
+
+        self.hashed = []
+        self.hash_file = journal._hash_file
+        journal._hash_file = lambda filepath: self.hashed.append(filepath) or self.hash_file(filepath)
+
+    def tearDown(self):
+        journal._hash_file = self.hash_file
+        shutil.rmtree(self.root)
+
+    def test_unchanged(self):
+        self.assertTrue(verify_artifacts(self.artifacts, self.stamps))
+        self.assertEqual(self.hashed, [])
+
+    def test_missing(self):
+        os.unlink(self.tarball)
+        self.assertFalse(verify_artifacts(self.artifacts, self.stamps))
+
+    def test_resized(self):
+        with open(self.package, 'a') as openfile:
+            openfile.write('more')
+        self.assertFalse(verify_artifacts(self.artifacts, self.stamps))
+        self.assertEqual(self.hashed, [])
+
+    def test_touched(self):
+        # the package is hashed again, since its md5 is known
+        os.utime(self.package, (0, 0))
+        self.assertTrue(verify_artifacts(self.artifacts, self.stamps))
+        self.assertEqual(self.hashed, [self.package])
+
+        with open(self.package, 'w') as openfile:
+            openfile.write(os.path.basename(self.package).upper())
+        self.assertFalse(verify_artifacts(self.artifacts, self.stamps))
+
+    def test_touched_without_checksum(self):
+        os.utime(self.tarball, (0, 0))
+        self.assertFalse(verify_artifacts(self.artifacts, self.stamps))
+        self.assertEqual(self.hashed, [])
+
+    def test_unstamped(self):
+        self.assertTrue(verify_artifacts(self.artifacts, {}))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+import os
+from unittest import main
+
+from lattice.support.debfile import DebWriter
+from lattice.support.packageindex import PackageIndex
+from tests.helpers import CONTROL, TemporaryTestCase, write_tarball
+
+class TestPackageIndex(TemporaryTestCase):
+    def setUp(self):
+        TemporaryTestCase.setUp(self)
+        self.storepath = os.path.join(self.root, 'store')
+        self.indexpath = os.path.join(self.root, 'packages.db')
+        os.mkdir(self.storepath)
+
+        archive = write_tarball(os.path.join(self.root, 'component.tar.gz'))
+        DebWriter(os.path.join(self.storepath, 'abc')).write(CONTROL, {}, archive)
+        with open(os.path.join(self.storepath, 'def'), 'wb') as openfile:
+            openfile.write('not a package')
+
+    def test_backfill(self):
+        index = PackageIndex(self.indexpath, self.storepath)
+        self.assertEqual(index.get('abc'), None)
+        self.assertEqual(index.backfill(), 2)
+
+        entry = index.get('abc')
+        self.assertEqual((entry['name'], entry['version']), ('component', '1.0.0'))
+        self.assertEqual(entry['size'], os.path.getsize(os.path.join(self.storepath, 'abc')))
+
+        # packages which cannot be parsed are still indexed, without metadata
+        entry = index.get('def')
+        self.assertEqual((entry['name'], entry['version'], entry['size']), (None, None, 13))
+        index.close()
+
+        # the index persists, and later packages are picked up when reopened
+        with open(os.path.join(self.storepath, 'ghi'), 'wb') as openfile:
+            openfile.write('')
+        index = PackageIndex(self.indexpath, self.storepath)
+        self.assertEqual(index.get('abc')['name'], 'component')
+        self.assertEqual(index.backfill(), 1)
+        self.assertEqual(index.get('ghi')['size'], 0)
+        index.close()
+
+    def test_unchanged_store(self):
+        index = PackageIndex(self.indexpath, self.storepath)
+        index.backfill()
+
+        listed = []
+        listdir = os.listdir
+        os.listdir = lambda dirpath: listed.append(dirpath) or listdir(dirpath)
+        try:
+            self.assertEqual(PackageIndex(self.indexpath, self.storepath).backfill(), 0)
+        finally:
+            os.listdir = listdir
+        self.assertEqual(listed, [])
+
+    def test_hashfile(self):
+        hashfile = os.path.join(self.root, 'hashes')
+        with open(hashfile, 'w') as openfile:
+            openfile.write('xyz\n')
+
+        index = PackageIndex(self.indexpath, self.storepath, hashfile)
+        self.assertTrue(index.contains('xyz'))
+        self.assertFalse(index.contains('abc'))
+
+        # packages in the store count once indexed
+        index.backfill()
+        self.assertTrue(index.contains('abc'))
+        self.assertFalse(index.contains('missing'))
+        self.assertEqual(PackageIndex(self.indexpath).contains('abc'), None)
+
+    def test_prefetch(self):
+        index = PackageIndex(self.indexpath, self.storepath)
+        self.assertEqual(index.prefetch(['abc', 'missing', 'def']), ['missing'])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+import os
+import time
+from unittest import TestCase, main
+
+from lattice.support.pipeline import PackagingPipeline
+from lattice.support.scheduler import JobFailed
+
+class TestPackagingPipeline(TestCase):
+    def test_groups(self):
+        pipeline = PackagingPipeline(4, poll=0.05)
+
+        # the results of a group are in submission order, however they finish
+        pipeline.submit('a', lambda: time.sleep(0.2) or 'rpm')
+        pipeline.submit('a', lambda: 'deb')
+        pipeline.submit('b', lambda: os.getpid())
+
+        completed = dict(pipeline.wait())
+        self.assertEqual(completed['a'], ['rpm', 'deb'])
+        self.assertNotEqual(completed['b'], [os.getpid()])
+        self.assertEqual(pipeline.poll_completed(), [])
+
+    def test_bounded(self):
+        pipeline = PackagingPipeline(1, poll=0.05)
+        for name in ('a', 'b', 'c'):
+            pipeline.submit(name, lambda: time.sleep(0.1))
+        self.assertEqual(len(pipeline.running), 1)
+
+        completed = pipeline.wait(['a'])
+        self.assertIn(('a', [None]), completed)
+        self.assertEqual(sorted(dict(pipeline.wait())), sorted(set('abc') - set(dict(completed))))
+
+    def test_failure(self):
+        def fail():
+            raise ValueError('broken')
+
+        pipeline = PackagingPipeline(2, poll=0.05)
+        pipeline.submit('a', fail)
+        pipeline.submit('b', lambda: 'deb')
+        try:
+            pipeline.wait()
+        except JobFailed, exception:
+            self.assertEqual(exception.name, 'a')
+            self.assertIn('ValueError: broken', exception.details)
+        else:
+            self.fail('JobFailed not raised')
+        self.assertEqual(pipeline.running, {})
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+import gzip
+import os
+from cStringIO import StringIO
+from hashlib import md5, sha1, sha256
+from unittest import main
+from xml.etree import ElementTree
+
+from lattice.support.debfile import DebWriter
+from lattice.support.repoindex import RepositoryIndex
+from lattice.support.rpmfile import RpmWriter
+from tests.helpers import CONTROL, TemporaryTestCase, regular, write_tarball
+
+COMMON = '{http://linux.duke.edu/metadata/common}'
+FILELISTS = '{http://linux.duke.edu/metadata/filelists}'
+REPO = '{http://linux.duke.edu/metadata/repo}'
+RPM = '{http://linux.duke.edu/metadata/rpm}'
+
+class TestRepositoryIndex(TemporaryTestCase):
+    def setUp(self):
+        TemporaryTestCase.setUp(self)
+        self.distpath = os.path.join(self.root, 'dist')
+        os.mkdir(self.distpath)
+
+        self.archive = write_tarball(os.path.join(self.root, 'component.tar.gz'), [
+            regular('etc/component.conf', 'conf'),
+            regular('usr/lib/component/a&b', 'odd'),
+        ])
+        self.index = RepositoryIndex(self.distpath)
+
+    def tearDown(self):
+        self.index.close()
+        TemporaryTestCase.tearDown(self)
+
+    def test_repodata(self):
+        filepath = self._write_rpm('component', requires=['python >= 2.6'])
+        self.assertEqual(self.index.update(), (['component-1.0.0-1.noarch.rpm'], [], []))
+        self.assertEqual(self.index.write_repodata(), 1)
+
+        repomd = ElementTree.parse(os.path.join(self.distpath, 'repodata', 'repomd.xml'))
+        locations = {}
+        for data in repomd.getroot().findall(REPO + 'data'):
+            href = data.find(REPO + 'location').get('href')
+            with open(os.path.join(self.distpath, href), 'rb') as openfile:
+                compressed = openfile.read()
+            self.assertEqual(data.find(REPO + 'checksum').text, sha256(compressed).hexdigest())
+            locations[data.get('type')] = gzip.GzipFile(fileobj=StringIO(compressed)).read()
+
+        self.assertEqual(sorted(locations), ['filelists', 'primary'])
+        primary = ElementTree.fromstring(locations['primary'])
+        self.assertEqual(primary.get('packages'), '1')
+
+        package = primary.find(COMMON + 'package')
+        self.assertEqual(package.find(COMMON + 'name').text, 'component')
+        self.assertEqual(package.find(COMMON + 'version').attrib,
+            {'epoch': '0', 'ver': '1.0.0', 'rel': '1'})
+        self.assertEqual(package.find(COMMON + 'location').get('href'),
+            'component-1.0.0-1.noarch.rpm')
+        with open(filepath, 'rb') as openfile:
+            self.assertEqual(package.find(COMMON + 'checksum').text,
+                sha256(openfile.read()).hexdigest())
+
+        format = package.find(COMMON + 'format')
+        requires = [(e.get('name'), e.get('flags'), e.get('ver')) for e in
+            format.find(RPM + 'requires').findall(RPM + 'entry')]
+        self.assertEqual(requires, [('python', 'GE', '2.6')])
+
+        # only files under /etc or in bin directories are listed in primary
+        files = [e.text for e in format.findall(COMMON + 'file')]
+        self.assertEqual(files, ['/etc/component.conf'])
+
+        filelists = ElementTree.fromstring(locations['filelists'])
+        files = [e.text for e in filelists.find(FILELISTS + 'package').findall(FILELISTS + 'file')]
+        self.assertIn('/usr/lib/component/a&b', files)
+
+    def test_packages(self):
+        filepath = os.path.join(self.distpath, 'component_1.0.0_all.deb')
+        DebWriter(filepath).write(CONTROL, {}, self.archive)
+        self.index.update()
+        self.assertEqual(self.index.write_packages(), 1)
+        self.assertEqual(self.index.write_repodata(), 0)
+        self.assertFalse(os.path.exists(os.path.join(self.distpath, 'repodata')))
+
+        with open(filepath, 'rb') as openfile:
+            content = openfile.read()
+        with open(os.path.join(self.distpath, 'Packages')) as openfile:
+            packages = openfile.read()
+        self.assertEqual(packages, '%s\nFilename: component_1.0.0_all.deb\nSize: %d\nMD5sum: %s\n'
+            'SHA1: %s\nSHA256: %s\n' % (CONTROL, len(content), md5(content).hexdigest(),
+            sha1(content).hexdigest(), sha256(content).hexdigest()))
+
+        with open(os.path.join(self.distpath, 'Packages.gz'), 'rb') as openfile:
+            self.assertEqual(gzip.GzipFile(fileobj=openfile).read(), packages)
+
+    def test_unreadable_packages(self):
+        self._write_rpm('component')
+        for filename in ('corrupt.rpm', 'corrupt.deb'):
+            with open(os.path.join(self.distpath, filename), 'wb') as openfile:
+                openfile.write('not a package')
+
+        recorded, removed, skipped = self.index.update()
+        self.assertEqual(recorded, ['component-1.0.0-1.noarch.rpm'])
+        self.assertEqual([filename for filename, reason in skipped], ['corrupt.deb', 'corrupt.rpm'])
+        self.assertEqual(self.index.write_repodata(), 1)
+
+        # unreadable packages are read again until they can be indexed
+        recorded, removed, skipped = self.index.update()
+        self.assertEqual((recorded, len(skipped)), ([], 2))
+
+    def test_removed_packages(self):
+        filepath = self._write_rpm('component')
+        self.index.update()
+        self.index.write_repodata()
+
+        os.unlink(filepath)
+        self.assertEqual(self.index.update(), ([], ['component-1.0.0-1.noarch.rpm'], []))
+
+        # existing repodata is rewritten so that it no longer lists the package
+        self.assertEqual(self.index.write_repodata(), 0)
+        repomd = ElementTree.parse(os.path.join(self.distpath, 'repodata', 'repomd.xml'))
+        for data in repomd.getroot().findall(REPO + 'data'):
+            href = os.path.join(self.distpath, data.find(REPO + 'location').get('href'))
+            content = gzip.GzipFile(href).read()
+            self.assertEqual(ElementTree.fromstring(content).get('packages'), '0')
+        self.assertEqual(len(os.listdir(os.path.join(self.distpath, 'repodata'))), 3)
+
+    def _write_rpm(self, name, **params):
+        filepath = os.path.join(self.distpath, '%s-1.0.0-1.noarch.rpm' % name)
+        RpmWriter(filepath, name, '1.0.0', '1', 'noarch').write(self.archive, **params)
+        return filepath
+
+if __name__ == '__main__':
+    main()
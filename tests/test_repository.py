@@ -0,0 +1,171 @@
+import os
+import shutil
+import tempfile
+from distutils.spawn import find_executable
+from unittest import TestCase, main, skipUnless
+
+from bake.path import path
+
+from lattice.support.cache import leasing
+from lattice.support.gitsession import GitSession
+from lattice.support.repository import GitRepository
+from tests.helpers import commit, git
+
+@skipUnless(find_executable('git'), 'requires git')
+class TestGitRepository(TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.upstream = os.path.join(self.workdir, 'upstream')
+        os.mkdir(self.upstream)
+        git(self.upstream, 'init', '-q')
+        for content in ('one', 'two', 'three'):
+            commit(self.upstream, 'a/file', content)
+        commit(self.upstream, 'b/file', 'four')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_rev_count_within_boundary(self):
+        # b was added after the boundary, so its history is complete
+        repository = self._clone(2)
+        self.assertEqual(repository.get_rev_count('b'), 1)
+        self.assertTrue(os.path.exists(os.path.join(repository.root, '.git', 'shallow')))
+
+    def test_rev_count_past_boundary(self):
+        repository = self._clone(2)
+        self.assertEqual(repository.get_rev_count('a'), 3)
+        self.assertFalse(os.path.exists(os.path.join(repository.root, '.git', 'shallow')))
+        self.assertEqual(repository.get_rev_count(), 4)
+
+    def test_deepened_elsewhere(self):
+        # another build sharing the checkout unshallowed it first
+        repository = self._clone(1)
+        self.assertTrue(repository._get_shallow_commits())
+        git(repository.root, 'fetch', '-q', '--unshallow', 'origin')
+
+        self.assertTrue(repository._deepen())
+        self.assertFalse(repository._deepen())
+        self.assertEqual(repository.get_rev_count(), 4)
+
+    def test_rev_count_after_fetch(self):
+        repository = self._clone(None)
+        self.assertEqual(repository.get_rev_count(), 4)
+
+        # a commit on another branch is counted once fetched, though HEAD stays
+        git(self.upstream, 'checkout', '-q', '-b', 'feature')
+        commit(self.upstream, 'c/file', 'five')
+        git(repository.root, 'fetch', '-q', 'origin')
+        self.assertEqual(repository.get_rev_count(), 5)
+
+    def _clone(self, depth):
+        root = os.path.join(self.workdir, 'clone-%s' % depth)
+        tokens = ['--depth', str(depth)] if depth else []
+        git(self.workdir, 'clone', '-q', *(tokens + ['file://' + self.upstream, root]))
+        return GitRepository(root)
+
+@skipUnless(find_executable('git'), 'requires git')
+class TestRemoteCommitLog(TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.upstream = os.path.join(self.workdir, 'upstream')
+        os.mkdir(self.upstream)
+        git(self.upstream, 'init', '-q')
+        commit(self.upstream, 'a/file', 'one')
+        self.first = git(self.upstream, 'rev-parse', 'HEAD')
+        commit(self.upstream, 'b/file', 'two')
+        git(self.upstream, 'tag', '-a', '-m', 'release', 'v1.0')
+
+        self.metadata = {'type': 'git', 'url': 'file://' + self.upstream}
+        self.repository = GitRepository(None, cachedir=path(self.workdir) / 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_without_history(self):
+        self.assertEqual(self.repository.get_remote_commit_log(self.metadata, self.first), None)
+
+        # an unchanged revision needs no history
+        head = git(self.upstream, 'rev-parse', 'HEAD')
+        self.assertEqual(self.repository.get_remote_commit_log(self.metadata, head), '')
+
+    def test_cache_entry(self):
+        with leasing():
+            self.repository.prefetch(self.metadata)
+        log = self.repository.get_remote_commit_log(self.metadata, self.first)
+        self.assertIn('change b/file', log)
+        self.assertNotIn('change a/file', log)
+
+        metadata = dict(self.metadata, subfolder='a')
+        self.assertEqual(self.repository.get_remote_commit_log(metadata, self.first), '')
+        self.assertIn('change a/file', self.repository.get_remote_commit_log(metadata))
+
+        # commits which were never fetched are not guessed at
+        commit(self.upstream, 'a/file', 'three')
+        self.assertEqual(self.repository.get_remote_commit_log(metadata, self.first), None)
+
+    def test_mirror(self):
+        metadata = dict(self.metadata, mirror=True)
+        with leasing():
+            self.repository.prefetch(metadata)
+        commit(self.upstream, 'a/file', 'three')
+        self.assertEqual(self.repository.get_remote_commit_log(metadata, self.first), None)
+
+        with leasing():
+            self.repository._update_mirror(metadata)
+        log = self.repository.get_remote_commit_log(metadata, self.first)
+        self.assertIn('change a/file', log)
+
+    def test_revisions(self):
+        head = git(self.upstream, 'rev-parse', 'HEAD')
+        metadata = dict(self.metadata, revision='v1.0')
+        self.assertEqual(self.repository._resolve_remote_revision(metadata), head)
+        self.assertEqual(self.repository.get_remote_commit_log(metadata, head), '')
+
+        # cache entries are kept per revision
+        metadata = dict(self.metadata, revision=self.first[:10])
+        self.assertEqual(self.repository.get_remote_commit_log(metadata, self.first), None)
+        with leasing():
+            self.repository.prefetch(metadata)
+        self.assertEqual(self.repository.get_remote_commit_log(metadata, self.first), '')
+
+        metadata = dict(self.metadata, branch='missing')
+        self.assertRaises(RuntimeError, self.repository.get_remote_commit_log, metadata)
+
+@skipUnless(find_executable('git'), 'requires git')
+class TestGitSession(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        git(self.root, 'init', '-q')
+        commit(self.root, 'file', 'content')
+        self.session = GitSession.get(self.root)
+
+    def tearDown(self):
+        self.session.close()
+        shutil.rmtree(self.root)
+
+    def test_read(self):
+        head = git(self.root, 'rev-parse', 'HEAD')
+        self.assertEqual(self.session.resolve('HEAD'), head)
+        self.assertEqual(self.session.read('HEAD:file'), ('blob', 'content'))
+        self.assertEqual(self.session.read('HEAD:missing'), None)
+        self.assertEqual(self.session.resolve('0' * 40), None)
+
+        # the one process keeps answering after a miss
+        self.assertEqual(self.session.read('%s:file' % head), ('blob', 'content'))
+
+    def test_sessions(self):
+        self.assertIs(GitSession.get(os.path.join(self.root, '.')), self.session)
+        self.session.close()
+        self.assertEqual(self.session.read('HEAD:file'), ('blob', 'content'))
+
+    def test_memoize(self):
+        calls = []
+        function = lambda: calls.append(1) or len(calls)
+        self.assertEqual(self.session.memoize('key', function), 1)
+        self.assertEqual(self.session.memoize('key', function), 1)
+
+        self.session.invalidate()
+        self.assertEqual(self.session.memoize('key', function), 2)
+
+if __name__ == '__main__':
+    main()
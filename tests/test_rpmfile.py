@@ -0,0 +1,274 @@
+import gzip
+import os
+import shutil
+import stat
+import tempfile
+from cStringIO import StringIO
+from distutils.spawn import find_executable
+from hashlib import md5, sha256
+from subprocess import PIPE, Popen
+from unittest import TestCase, main, skipUnless
+
+from lattice.support import rpmfile
+from lattice.support.rpmfile import *
+from lattice.support.rpmfile import _Stream, _build_cpio_header, _build_header, _extract_cpio, _open_stream
+from tests.helpers import TemporaryTestCase, directory, hardlink, regular, symlink, write_tarball
+
+def build_cpio(entries):
+    content = ''
+    for inode, name, mode, nlink, data in entries:
+        content += _build_cpio_header(inode, mode, nlink, 1234567890, len(data), name)
+        content += data + '\x00' * (-len(data) % 4)
+    return content + _build_cpio_header(0, 0, 1, 0, 0, 'TRAILER!!!')
+
+def read_header(content, signature=False):
+    package = RpmPackage.__new__(RpmPackage)
+    package.filepath = 'test.rpm'
+    openfile = StringIO(content)
+    return package._read_header(openfile, signature), openfile.tell()
+
+def stream(content):
+    openfile = StringIO(content)
+    return _Stream(lambda: openfile.read(7) or None)
+
+class TestHeader(TestCase):
+    def test_round_trip(self):
+        tags = [
+            (RPMTAG_NAME, STRING_TYPE, 'component'),
+            (RPMTAG_SUMMARY, I18NSTRING_TYPE, ['a summary']),
+            (RPMTAG_BASENAMES, STRING_ARRAY_TYPE, ['a', 'bc', '']),
+            (RPMTAG_FILEMODES, INT16_TYPE, [0100644, 040755]),
+            (RPMTAG_FILESIZES, INT32_TYPE, [0, 1, 4294967295]),
+            (RPMTAG_SOURCERPM, BIN_TYPE, '\x00\x01binary'),
+        ]
+
+        content = _build_header(tags, RPMTAG_HEADERIMMUTABLE)
+        parsed, size = read_header(content)
+        self.assertEqual(size, len(content))
+        for tag, type, value in tags:
+            self.assertEqual(parsed[tag], value)
+
+        # string arrays and integers are always lists, even of one item
+        self.assertEqual(parsed[RPMTAG_SUMMARY], ['a summary'])
+        self.assertEqual(len(parsed[RPMTAG_HEADERIMMUTABLE]), 16)
+
+    def test_alignment(self):
+        tags = [
+            (RPMTAG_NAME, STRING_TYPE, 'odd'),
+            (RPMTAG_FILEMODES, INT16_TYPE, [1]),
+            (RPMTAG_FILESIZES, INT32_TYPE, [2]),
+            (RPMTAG_VERSION, STRING_TYPE, 'x'),
+        ]
+        parsed, size = read_header(_build_header(tags, RPMTAG_HEADERIMMUTABLE))
+        self.assertEqual(parsed[RPMTAG_FILEMODES], [1])
+        self.assertEqual(parsed[RPMTAG_FILESIZES], [2])
+
+    def test_signature_padding(self):
+        content = _build_header([(SIGTAG_MD5, BIN_TYPE, 'x' * 3)], RPMTAG_HEADERSIGNATURES)
+        padded = content + '\x00' * (-len(content) % 8) + 'next'
+        parsed, size = read_header(padded, True)
+        self.assertEqual(padded[size:], 'next')
+        self.assertEqual(parsed[SIGTAG_MD5], 'xxx')
+
+    def test_corrupt_header(self):
+        self.assertRaises(RpmError, read_header, 'not a header')
+
+class TestCpio(TestCase):
+    def setUp(self):
+        self.target = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.target)
+
+    def test_round_trip(self):
+        # the content of hardlinked files follows the last of their links
+        payload = build_cpio([
+            (1, './usr', stat.S_IFDIR | 0755, 2, ''),
+            (2, './usr/file', stat.S_IFREG | 0640, 1, 'content'),
+            (3, './usr/link', stat.S_IFLNK | 0777, 1, 'file'),
+            (4, './usr/first', stat.S_IFREG | 0644, 2, ''),
+            (4, './usr/second', stat.S_IFREG | 0644, 2, 'shared'),
+        ])
+
+        members = _extract_cpio(stream(payload), self.target)
+        self.assertEqual(members, ['usr', 'usr/file', 'usr/link', 'usr/first', 'usr/second'])
+
+        root = os.path.join(self.target, 'usr')
+        with open(os.path.join(root, 'file')) as openfile:
+            self.assertEqual(openfile.read(), 'content')
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.join(root, 'file')).st_mode), 0640)
+        self.assertEqual(os.stat(os.path.join(root, 'file')).st_mtime, 1234567890)
+        self.assertEqual(os.readlink(os.path.join(root, 'link')), 'file')
+
+        first, second = os.stat(os.path.join(root, 'first')), os.stat(os.path.join(root, 'second'))
+        self.assertEqual(first.st_ino, second.st_ino)
+        with open(os.path.join(root, 'first')) as openfile:
+            self.assertEqual(openfile.read(), 'shared')
+
+    def test_keeps_newer_files(self):
+        os.makedirs(os.path.join(self.target, 'usr'))
+        filepath = os.path.join(self.target, 'usr', 'file')
+        with open(filepath, 'w') as openfile:
+            openfile.write('newer')
+
+        _extract_cpio(stream(build_cpio([(1, './usr/file', stat.S_IFREG | 0644, 1, 'older')])),
+            self.target)
+        with open(filepath) as openfile:
+            self.assertEqual(openfile.read(), 'newer')
+
+    def test_normalized_names(self):
+        payload = build_cpio([
+            (1, '.', stat.S_IFDIR | 0755, 2, ''),
+            (2, './usr/../file', stat.S_IFREG | 0644, 1, 'content'),
+            (3, 'bare', stat.S_IFREG | 0644, 1, 'bare'),
+        ])
+        self.assertEqual(_extract_cpio(stream(payload), self.target), ['file', 'bare'])
+        self.assertEqual(sorted(os.listdir(self.target)), ['bare', 'file'])
+
+    def test_escaping_names(self):
+        outside = os.path.join(os.path.dirname(self.target), 'escaped')
+        for name in ('./../escaped', '../escaped', './usr/../../escaped', '/etc/escaped'):
+            payload = build_cpio([(1, name, stat.S_IFREG | 0644, 1, 'content')])
+            self.assertRaises(RpmError, _extract_cpio, stream(payload), self.target)
+            self.assertFalse(os.path.lexists(outside))
+
+    def test_escaping_symlinks(self):
+        # a member may not be written through a symlink leading out of the root
+        outside = tempfile.mkdtemp()
+        try:
+            payload = build_cpio([
+                (1, './usr', stat.S_IFLNK | 0777, 1, outside),
+                (2, './usr/file', stat.S_IFREG | 0644, 1, 'content'),
+            ])
+            self.assertRaises(RpmError, _extract_cpio, stream(payload), self.target)
+            self.assertEqual(os.listdir(outside), [])
+        finally:
+            shutil.rmtree(outside)
+
+    def test_truncated_payload(self):
+        payload = build_cpio([(1, './file', stat.S_IFREG | 0644, 1, 'content')])
+        self.assertRaises(RpmError, _extract_cpio, stream(payload[:120]), self.target)
+
+    def test_unsupported_payload(self):
+        self.assertRaises(RpmError, _extract_cpio, stream('0' * 110), self.target)
+
+class TestStream(TestCase):
+    payload = build_cpio([(1, './file', stat.S_IFREG | 0644, 1, 'content' * 1000)])
+
+    def test_gzip(self):
+        content = StringIO()
+        with gzip.GzipFile(fileobj=content, mode='wb') as openfile:
+            openfile.write(self.payload)
+        self.assertEqual(self._decompress(content.getvalue(), 'gzip'), self.payload)
+
+    @skipUnless(rpmfile.lzma, 'requires the lzma module')
+    def test_xz(self):
+        content = rpmfile.lzma.compress(self.payload)
+        self.assertEqual(self._decompress(content, 'xz'), self.payload)
+
+    @skipUnless(rpmfile.lzma, 'requires the lzma module')
+    def test_lzma(self):
+        content = rpmfile.lzma.compress(self.payload, rpmfile.lzma.FORMAT_ALONE)
+        self.assertEqual(self._decompress(content, 'lzma'), self.payload)
+
+    def test_unsupported(self):
+        self.assertRaises(RpmError, _open_stream, StringIO(''), 'lz4')
+
+    def _decompress(self, content, compressor):
+        stream = _open_stream(StringIO(content), compressor)
+        try:
+            return stream.read(len(self.payload))
+        finally:
+            stream.close()
+
+class TestRpmWriter(TemporaryTestCase):
+    def setUp(self):
+        TemporaryTestCase.setUp(self)
+        self.filepath = os.path.join(self.root, 'component-1.0.0-1.noarch.rpm')
+        self.archive = write_tarball(os.path.join(self.root, 'component-1.0.0.tar.gz'), [
+            directory('usr/lib/component', mode=0755),
+            regular('usr/lib/component/module.py', 'content', mode=0644, mtime=1234567890),
+            symlink('usr/lib/component/link', 'module.py'),
+        ])
+
+        self.writer = RpmWriter(self.filepath, 'component', '1.0.0', '1', 'noarch')
+        self.writer.write(self.archive, requires=['python >= 2.6'], provides=['library'],
+            scripts={'post': 'ldconfig'}, summary='a component')
+
+    def test_round_trip(self):
+        package = RpmPackage(self.filepath)
+        self.assertEqual((package.name, package.version), ('component', '1.0.0'))
+        self.assertEqual(package.tags[RPMTAG_SUMMARY], ['a component'])
+        self.assertEqual(package.tags[RPMTAG_POSTIN], 'ldconfig')
+        self.assertIn('python', package.tags[RPMTAG_REQUIRENAME])
+        self.assertIn('/bin/sh', package.tags[RPMTAG_REQUIRENAME])
+        self.assertEqual(package.tags[RPMTAG_PROVIDENAME], ['component', 'library'])
+        # files are listed in sorted order, as rpm expects
+        self.assertEqual(package.tags[RPMTAG_BASENAMES], ['component', 'link', 'module.py'])
+
+        target = os.path.join(self.root, 'target')
+        members = package.extract(target)
+        self.assertEqual(members, ['usr/lib/component', 'usr/lib/component/module.py',
+            'usr/lib/component/link'])
+
+        filepath = os.path.join(target, 'usr/lib/component/module.py')
+        with open(filepath) as openfile:
+            self.assertEqual(openfile.read(), 'content')
+        self.assertEqual(os.stat(filepath).st_mtime, 1234567890)
+        self.assertEqual(os.readlink(os.path.join(target, 'usr/lib/component/link')), 'module.py')
+
+    def test_digests(self):
+        with open(self.filepath, 'rb') as openfile:
+            content = openfile.read()
+        self.assertEqual(self.writer.md5, md5(content).hexdigest())
+        self.assertEqual(self.writer.sha256, sha256(content).hexdigest())
+        self.assertFalse(os.path.exists(self.filepath + '.tmp'))
+        self.assertFalse(os.path.exists(self.filepath + '.payload'))
+
+    def test_signature(self):
+        package = RpmPackage(self.filepath)
+        with open(self.filepath, 'rb') as openfile:
+            content = openfile.read()
+
+        # the signature header is padded so that the header is aligned
+        self.assertEqual(package.header_offset % 8, 0)
+        header = content[package.header_offset:package.payload_offset]
+        signed = content[package.header_offset:]
+
+        signature = package.signature
+        self.assertEqual(signature[SIGTAG_MD5], md5(signed).digest())
+        self.assertEqual(signature[SIGTAG_SHA256], sha256(header).hexdigest())
+        self.assertEqual(signature[SIGTAG_SIZE], [len(signed)])
+
+        with open(self.filepath, 'rb') as openfile:
+            openfile.seek(package.payload_offset)
+            stream = _open_stream(openfile, package.compressor)
+            try:
+                size = sum(len(block) for block in iter(stream._read, None))
+            finally:
+                stream.close()
+        self.assertEqual(signature[SIGTAG_PAYLOADSIZE], [size])
+
+    def test_hardlinks(self):
+        archive = write_tarball(os.path.join(self.root, 'hardlinks.tar.gz'),
+            [regular('file', ''), hardlink('link', 'file')])
+
+        filepath = os.path.join(self.root, 'hardlinks.rpm')
+        self.assertRaises(RpmError, RpmWriter(filepath, 'hardlinks', '1', '1', 'noarch').write, archive)
+        for suffix in ('', '.tmp', '.payload'):
+            self.assertFalse(os.path.exists(filepath + suffix))
+
+    @skipUnless(find_executable('rpm'), 'requires rpm')
+    def test_rpm(self):
+        process = Popen(['rpm', '-K', '--nosignature', self.filepath], stdout=PIPE)
+        output = process.communicate()[0]
+        self.assertEqual(process.returncode, 0, output)
+
+        process = Popen(['rpm', '-qpl', self.filepath], stdout=PIPE)
+        listing = process.communicate()[0]
+        self.assertEqual(process.returncode, 0)
+        self.assertEqual(listing.split(), ['/usr/lib/component', '/usr/lib/component/link',
+            '/usr/lib/component/module.py'])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+import os
+import shutil
+import tarfile
+import tempfile
+from multiprocessing import Lock
+from unittest import TestCase, main
+
+from lattice.support.scheduler import DependencyScheduler, JobFailed
+from lattice.support.snapshot import Snapshot
+
+# a small profile: b depends on a, and both add to the shared site.pth,
+# while c and d are independent; c removes a file left in BUILDPATH
+PROFILE = [
+    ('a', [], {'append': 'lib/site.pth'}),
+    ('b', ['a'], {'append': 'lib/site.pth'}),
+    ('c', [], {'remove': 'share/stale'}),
+    ('d', [], {}),
+]
+
+class TestDependencyScheduler(TestCase):
+    def test_order(self):
+        scheduler = DependencyScheduler(1, poll=0.05)
+        for name, dependencies, payload in PROFILE:
+            scheduler.add(name, dependencies, name)
+
+        completed = []
+        scheduler.run(lambda payload: payload.upper(),
+            lambda name, result: completed.append((name, result)))
+        self.assertEqual(completed, [('a', 'A'), ('b', 'B'), ('c', 'C'), ('d', 'D')])
+
+    def test_dependencies(self):
+        scheduler = DependencyScheduler(4, poll=0.05)
+        for name, dependencies, payload in PROFILE:
+            scheduler.add(name, dependencies + ['unknown'], name)
+
+        completed = []
+        scheduler.run(lambda payload: payload, lambda name, result: completed.append(name))
+        self.assertEqual(sorted(completed), ['a', 'b', 'c', 'd'])
+        self.assertTrue(completed.index('a') < completed.index('b'))
+
+    def test_failure(self):
+        def execute(payload):
+            if payload == 'a':
+                raise ValueError('broken')
+            return payload
+
+        scheduler = DependencyScheduler(1, poll=0.05)
+        for name, dependencies, payload in PROFILE:
+            scheduler.add(name, dependencies, name)
+
+        completed = []
+        try:
+            scheduler.run(execute, lambda name, result: completed.append(name))
+        except JobFailed, exception:
+            self.assertEqual(exception.name, 'a')
+            self.assertIn('ValueError: broken', exception.details)
+        else:
+            self.fail('JobFailed not raised')
+        self.assertNotIn('b', completed)
+
+    def test_unsatisfiable(self):
+        scheduler = DependencyScheduler(2, poll=0.05)
+        scheduler.add('a', ['b'])
+        scheduler.add('b', ['a'])
+        self.assertRaises(JobFailed, scheduler.run, lambda payload: None,
+            lambda name, result: None)
+
+    def test_ready(self):
+        scheduler = DependencyScheduler(2, poll=0.05)
+        for name, dependencies, payload in PROFILE:
+            scheduler.add(name, [], name)
+
+        # d is held back until everything before it has completed
+        completed = []
+        ready = lambda name: name != 'd' or len(completed) == 3
+        scheduler.run(lambda payload: payload, lambda name, result: completed.append(name),
+            ready)
+        self.assertEqual(completed[-1], 'd')
+
+class TestParallelBuilds(TestCase):
+    """Builds the profile into one BUILDPATH as lattice.component.assemble
+    does, with the build and its collation serialized by the build lock."""
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_jobs(self):
+        serial = self._build_profile(1)
+        parallel = self._build_profile(4)
+        self.assertEqual(parallel, serial)
+
+        tarballs, tree = serial
+        self.assertEqual(sorted(tarballs['b']), ['bin/b', 'lib/b.pth', 'lib/site.pth'])
+        self.assertEqual(tarballs['b']['lib/site.pth'], 'a\nb\n')
+        self.assertEqual(tree['bin/c'], '#!%s/bin/python\n' % os.path.join(self.workdir, 'build'))
+        self.assertNotIn('share/stale', tree)
+
+    def _build_profile(self, jobs):
+        # each run builds at the same BUILDPATH, as successive builds do
+        buildpath = os.path.join(self.workdir, 'build')
+        distpath = os.path.join(self.workdir, 'dist-%d' % jobs)
+        if os.path.exists(buildpath):
+            shutil.rmtree(buildpath)
+        for dirname in ('bin', 'lib', 'share'):
+            os.makedirs(os.path.join(buildpath, dirname))
+        os.mkdir(distpath)
+        with open(os.path.join(buildpath, 'share', 'stale'), 'w') as openfile:
+            openfile.write('stale')
+
+        snapshot = Snapshot(buildpath, os.path.join(self.workdir, 'build-%d.snapshot' % jobs))
+        snapshot.update()
+
+        lock = Lock()
+        scheduler = DependencyScheduler(jobs, poll=0.05)
+        for name, dependencies, payload in PROFILE:
+            scheduler.add(name, dependencies, dict(payload, name=name))
+        scheduler.run(lambda payload: self._build(snapshot, lock, payload, distpath),
+            lambda name, result: None)
+
+        tarballs = {}
+        for name, dependencies, payload in PROFILE:
+            tarballs[name] = self._read_tarball(os.path.join(distpath, '%s.tar.gz' % name))
+        return tarballs, self._read_tree(buildpath)
+
+    def _build(self, snapshot, lock, payload, distpath):
+        name = payload['name']
+        with lock:
+            snapshot.update()
+            buildpath = str(snapshot.root)
+
+            # paths into BUILDPATH are embedded in the output
+            self._write(buildpath, 'bin/%s' % name, '#!%s/bin/python\n' % buildpath)
+            self._write(buildpath, 'lib/%s.pth' % name, '%s/lib/%s\n' % (buildpath, name))
+            if payload.get('append'):
+                self._write(buildpath, payload['append'], '%s\n' % name, 'a')
+            if payload.get('remove'):
+                os.unlink(os.path.join(buildpath, payload['remove']))
+
+            now = snapshot.update()
+            now.tar(os.path.join(distpath, '%s.tar.gz' % name), 'gzip')
+
+    def _read_tarball(self, filepath):
+        contents = {}
+        with tarfile.open(filepath) as archive:
+            for member in archive.getmembers():
+                if member.isfile():
+                    contents[member.name] = archive.extractfile(member).read()
+                else:
+                    contents[member.name] = None
+        return contents
+
+    def _read_tree(self, root):
+        contents = {}
+        for dirpath, dirnames, filenames in os.walk(root):
+            for filename in filenames:
+                filepath = os.path.join(dirpath, filename)
+                with open(filepath) as openfile:
+                    contents[os.path.relpath(filepath, root)] = openfile.read()
+        return contents
+
+    def _write(self, root, name, content, mode='w'):
+        with open(os.path.join(root, name), mode) as openfile:
+            openfile.write(content)
+
+if __name__ == '__main__':
+    main()
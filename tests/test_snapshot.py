@@ -0,0 +1,106 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase, main
+
+from lattice.support.snapshot import Snapshot
+
+class TestSnapshot(TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.root = os.path.join(self.workdir, 'root')
+        self.indexpath = os.path.join(self.workdir, 'root.snapshot')
+        os.makedirs(os.path.join(self.root, 'lib', 'site-packages'))
+        self._write('lib/site-packages/easy-install.pth', 'first\n')
+        self._write('lib/module.py', 'module')
+
+        self.snapshot = Snapshot(self.root, self.indexpath)
+        self.assertEqual(len(self.snapshot.update()), 0)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_unchanged(self):
+        changes = self.snapshot.update()
+        self.assertEqual((len(changes), changes.created), (0, []))
+
+    def test_added(self):
+        os.mkdir(os.path.join(self.root, 'bin'))
+        self._write('bin/tool', 'tool')
+        os.symlink('tool', os.path.join(self.root, 'bin', 'alias'))
+
+        changes = self.snapshot.update()
+        self.assertEqual(changes.directories, ['bin'])
+        self.assertEqual(changes.files, ['bin/tool'])
+        self.assertEqual(changes.links, ['bin/alias'])
+        self.assertEqual(sorted(changes.created), ['bin', 'bin/alias', 'bin/tool'])
+
+    def test_modified_in_place(self):
+        # appending leaves the mtime of the directory alone
+        dirpath = os.path.join(self.root, 'lib', 'site-packages')
+        mtime = os.stat(dirpath).st_mtime
+        self._write('lib/site-packages/easy-install.pth', 'second\n', 'a')
+        self.assertEqual(os.stat(dirpath).st_mtime, mtime)
+
+        changes = self.snapshot.update()
+        self.assertEqual(changes.files, ['lib/site-packages/easy-install.pth'])
+        self.assertEqual(changes.created, [])
+        self.assertEqual(len(self.snapshot.update()), 0)
+
+    def test_rewritten_with_same_size(self):
+        filepath = os.path.join(self.root, 'lib', 'module.py')
+        status = os.stat(filepath)
+        self._write('lib/module.py', 'MODULE')
+        os.utime(filepath, (status.st_atime, status.st_mtime + 10))
+        os.utime(os.path.dirname(filepath), None)
+
+        self.assertEqual(self.snapshot.update().files, ['lib/module.py'])
+
+    def test_deleted(self):
+        os.unlink(os.path.join(self.root, 'lib', 'module.py'))
+        self.assertEqual(len(self.snapshot.update()), 0)
+
+        # once forgotten, the same name is created again
+        self._write('lib/module.py', 'module')
+        changes = self.snapshot.update()
+        self.assertEqual((changes.files, changes.created), (['lib/module.py'], ['lib/module.py']))
+
+    def test_replaced(self):
+        filepath = os.path.join(self.root, 'lib', 'module.py')
+        staging = filepath + '.tmp'
+        with open(staging, 'w') as openfile:
+            openfile.write('replacement')
+        os.rename(staging, filepath)
+
+        changes = self.snapshot.update()
+        self.assertEqual((changes.files, changes.created), (['lib/module.py'], []))
+
+        os.unlink(filepath)
+        os.mkdir(filepath)
+        changes = self.snapshot.update()
+        self.assertEqual(changes.directories, ['lib/module.py'])
+        self.assertEqual(changes.created, ['lib/module.py'])
+
+    def test_persisted_index(self):
+        self._write('lib/added.py', 'added')
+        self.snapshot.update()
+
+        # a fresh snapshot picks up the saved index rather than starting over
+        snapshot = Snapshot(self.root, self.indexpath)
+        self.assertEqual(len(snapshot.update()), 0)
+
+        self._write('lib/site-packages/easy-install.pth', 'second\n', 'a')
+        self.assertEqual(Snapshot(self.root, self.indexpath).update().files,
+            ['lib/site-packages/easy-install.pth'])
+
+        # an index recorded for another root is ignored
+        other = os.path.join(self.workdir, 'other')
+        shutil.copytree(self.root, other)
+        self.assertEqual(len(Snapshot(other, self.indexpath).update()), 0)
+
+    def _write(self, name, content, mode='w'):
+        with open(os.path.join(self.root, name), mode) as openfile:
+            openfile.write(content)
+
+if __name__ == '__main__':
+    main()
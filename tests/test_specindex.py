@@ -0,0 +1,94 @@
+import json
+import os
+from distutils.spawn import find_executable
+from unittest import main, skipUnless
+
+from bake.path import path
+
+from lattice.support.repository import GitRepository
+from lattice.support.specification import Specification
+from lattice.support.specindex import SpecificationIndex
+from tests.helpers import TemporaryTestCase, commit, git
+
+def specification(*names):
+    # json is also yaml
+    return json.dumps({'components': [{'name': name} for name in names]})
+
+class TestSpecificationIndex(TemporaryTestCase):
+    def setUp(self):
+        TemporaryTestCase.setUp(self)
+        self.index = SpecificationIndex(os.path.join(self.root, 'specifications.db'))
+
+    def tearDown(self):
+        self.index.close()
+        TemporaryTestCase.tearDown(self)
+
+    def test_content(self):
+        self.assertEqual(self.index.get_content('a' * 40), None)
+        self.index.set_content('a' * 40, {'components': [{'name': 'a'}]})
+        self.assertEqual(self.index.get_content('a' * 40), {'components': [{'name': 'a'}]})
+
+    def test_tags(self):
+        self.index.set_tags('/repository', {'1.0.0': ('1' * 40, 'a' * 40),
+            '1.1.0': ('2' * 40, None)})
+        self.index.set_tags('/other', {'1.0.0': ('3' * 40, 'b' * 40)})
+        self.assertEqual(self.index.get_tags('/repository'), {'1.0.0': ('1' * 40, 'a' * 40),
+            '1.1.0': ('2' * 40, None)})
+
+        # tags are replaced as a whole, per repository
+        self.index.set_tags('/repository', {'1.1.0': ('4' * 40, 'c' * 40)})
+        self.assertEqual(self.index.get_tags('/repository'), {'1.1.0': ('4' * 40, 'c' * 40)})
+        self.assertEqual(self.index.get_tags('/other'), {'1.0.0': ('3' * 40, 'b' * 40)})
+
+@skipUnless(find_executable('git'), 'requires git')
+class TestIndexedEnumeration(TemporaryTestCase):
+    def setUp(self):
+        TemporaryTestCase.setUp(self)
+        self.upstream = os.path.join(self.root, 'upstream')
+        os.mkdir(self.upstream)
+        git(self.upstream, 'init', '-q')
+        commit(self.upstream, 'lattice.yaml', specification('a'))
+        git(self.upstream, 'tag', '1.0.0')
+        commit(self.upstream, 'README', 'readme')
+        git(self.upstream, 'tag', '1.0.1')
+
+        self.repository = GitRepository(self.upstream, cachedir=path(self.root))
+        # counts the blobs read from yaml, rather than the contents parsed
+        self.parsed = []
+        self.unserialize = Specification.__dict__['unserialize']
+        def unserialize(cls, content, format='yaml'):
+            if format:
+                self.parsed.append(content)
+            return self.unserialize.__func__(cls, content, format)
+        Specification.unserialize = classmethod(unserialize)
+
+    def tearDown(self):
+        Specification.unserialize = self.unserialize
+        TemporaryTestCase.tearDown(self)
+
+    def test_shared_blobs(self):
+        # both tags and HEAD share one specification blob, parsed once
+        components = self.repository.enumerate_components()
+        self.assertEqual(sorted(components['a']), ['1.0.0', '1.0.1', 'HEAD'])
+        self.assertEqual(len(self.parsed), 1)
+
+        self.repository.enumerate_components()
+        self.assertEqual(len(self.parsed), 1)
+
+    def test_new_tags(self):
+        self.repository.enumerate_components()
+        commit(self.upstream, 'lattice.yaml', specification('a', 'b'))
+        git(self.upstream, 'tag', '1.1.0')
+
+        components = self.repository.enumerate_components()
+        self.assertEqual(sorted(components['b']), ['1.1.0', 'HEAD'])
+        self.assertEqual(len(self.parsed), 2)
+
+        # a moved tag is resolved again
+        git(self.upstream, 'tag', '-f', '1.0.0', '1.1.0')
+        components = self.repository.enumerate_components()
+        self.assertEqual(sorted(components['b']), ['1.0.0', '1.1.0', 'HEAD'])
+        self.assertEqual(len(self.parsed), 2)
+
+if __name__ == '__main__':
+    main()